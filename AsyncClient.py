@@ -0,0 +1,363 @@
+# Headless asyncio client library for bots and integration probes, next to the Tk
+# client in chatWindow.py.
+#
+# A ChatSession is one connection. It needs no display and no thread of its own,
+# so any number of them share one event loop:
+#
+#   sessions = [ChatSession('127.0.0.1', 50000, 'probe{0}'.format(i)) for i in range(100)]
+#   await asyncio.gather(*(session.run() for session in sessions))
+#
+# A bot subclasses ChatSession and overrides the on_* callbacks, they run on the
+# loop and must not block. Sessions ask for the binary protocol of Protocol.py, the
+# only way to tell chat lines, notices and replies apart in the stream. Against a
+# server that refuses it every read is one message, as in the GUI. Text messages of
+# both modes are interpreted by ClientEvents.interpret like the GUI does.
+#
+# send() only queues a message, so messages sent in a row leave in one write. In
+# text mode that needs a server started with --framing line, with raw framing the
+# server could read them as one message. request() sends a command followed by a
+# /ping and returns the text that came back before the /pong, so any number of
+# requests can be in flight and each gets its own reply. A lost connection is
+# opened again after a growing delay, the session registers and joins its channels
+# again, and the requests that were in flight fail with ConnectionError.
+#
+#   python AsyncClient.py --port 50000 --command /time --command "/ison alice"
+#   python AsyncClient.py --port 50000 --sessions 200 --echo
+import argparse
+import asyncio
+import collections
+import random
+import ClientEvents
+import Protocol
+
+CONNECT_TIMEOUT = 10.0 # seconds to connect, negotiate and register
+REQUEST_TIMEOUT = 10.0
+RECONNECT_DELAY = 0.5 # first delay before reconnecting, doubled after every failed attempt
+MAX_RECONNECT_DELAY = 30.0
+MAX_MESSAGE_LENGTH = 1 << 20 # longest frame payload accepted from the server
+READ_SIZE = 65536
+
+
+class RegistrationError(ConnectionError):
+    pass
+
+
+class ChatSession:
+    # framing is the --framing of the server, it only matters for what is sent as text
+    def __init__(self, host, port, username, framing='raw', binary=True, compress=False, reconnect=True,
+                 reconnectDelay=RECONNECT_DELAY, maxReconnectDelay=MAX_RECONNECT_DELAY):
+        self.host = host
+        self.port = port
+        self.username = username.lower() # the server lowercases everything it reads
+        self.framing = framing
+        self.wantBinary = binary
+        self.compress = compress # ask for deflated frames
+        self.reconnect = reconnect
+        self.reconnectDelay = reconnectDelay
+        self.maxReconnectDelay = maxReconnectDelay
+        self.channels = [] # joined again after a reconnect
+        self.binary = False # set while the server speaks the binary protocol with us
+        self.state = Protocol.ClientState(self.username) # names, channels and members in binary mode
+        self.members = set() # text mode: the users of the channel joined last, as the GUI shows them
+        self.reader = None
+        self.writer = None
+        self.decoder = None
+        self.incoming = None # the receive() generator of the current connection
+        self.requests = collections.deque() # (future, replies, fenced) in the order their answers come back
+        self.unfenced = False # something was sent whose replies a request must not take for its own
+        self.connected = asyncio.Event() # set while the session is registered
+        self.closing = False
+        self.connects = 0 # successful connections, more than one means the session reconnected
+
+    # callbacks for bots
+
+    # registered, the channels are being joined again
+    def on_connect(self):
+        pass
+
+    # a chat line, channel is None for a /privmsg to this session
+    def on_message(self, channel, username, text):
+        pass
+
+    def on_notice(self, username, text):
+        pass
+
+    def on_join(self, channel, username):
+        pass
+
+    def on_part(self, channel, username):
+        pass
+
+    # replies and notices that no request is waiting for
+    def on_text(self, text):
+        pass
+
+    def on_disconnect(self, reason):
+        pass
+
+    # serves the session until close(), reconnecting whenever the connection is lost
+    async def run(self):
+        delay = self.reconnectDelay
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.open(), CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as error:
+                reason = error
+            else:
+                delay = self.reconnectDelay
+                self.connects += 1
+                self.on_connect()
+                reason = await self.read_loop()
+            self.drop(reason)
+            if self.closing or not self.reconnect:
+                break
+            # with jitter, so that a restarted server is not hit by every bot at the same moment
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self.maxReconnectDelay)
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.binary = False
+        rest = b''
+        if self.wantBinary:
+            self.write(Protocol.make_offer([Protocol.DEFLATE] if self.compress else []))
+            answer, rest = await self.read_answer()
+            if Protocol.parse_offer(answer) is not None:
+                self.binary = True
+                self.decoder = Protocol.FrameDecoder(MAX_MESSAGE_LENGTH)
+                self.state = Protocol.ClientState(self.username)
+        self.incoming = self.receive(rest)
+
+        self.write(self.username)
+        welcome = 'Welcome {0},'.format(self.username)
+        while True:
+            kind, channel, sender, payload = await self.incoming.__anext__()
+            if kind != Protocol.TEXT:
+                self.dispatch(kind, channel, sender, payload)
+                continue
+            text = payload.decode('utf8', errors='replace')
+            if welcome in text:
+                break
+            if 'already exists' in text:
+                raise RegistrationError("username {0} is taken".format(self.username))
+        self.connected.set()
+        for channel in self.channels:
+            self.send('/join ' + channel)
+
+    # the server's answer to the offer, and what came after it
+    async def read_answer(self):
+        marker = Protocol.NEGOTIATE.encode('utf8')
+        buffer = b''
+        while True:
+            start = buffer.find(marker)
+            end = buffer.find(b'\n', start) if start >= 0 else -1
+            if end >= 0:
+                return buffer[start:end].decode('utf8', errors='replace'), buffer[end + 1:]
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("the server closed the connection")
+            buffer += data
+
+    # yields (type, channel id, sender id, payload): the frames in binary mode, every read as a TEXT frame in text mode
+    async def receive(self, data=b''):
+        while True:
+            if data and self.binary:
+                for frame in self.decoder.frames(data):
+                    yield frame
+            elif data:
+                yield Protocol.TEXT, 0, 0, data
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("the server closed the connection")
+
+    # returns why the connection ended
+    async def read_loop(self):
+        try:
+            while True:
+                reason = self.dispatch(*await self.incoming.__anext__())
+                if reason is not None:
+                    return reason
+        except OSError as error:
+            return error
+
+    # returns ClientEvents.QUIT or SQUIT when the server ends the session, None otherwise
+    def dispatch(self, kind, channel, sender, payload):
+        if kind == Protocol.TEXT or kind == Protocol.CONTROL:
+            return self.dispatch_text(payload.decode('utf8', errors='replace'))
+        kind, channelName, username, text = self.state.apply(kind, channel, sender, payload)
+        if kind == Protocol.CHAT:
+            self.on_message(channelName, username, text)
+        elif kind == Protocol.NOTICE:
+            self.on_notice(username, text)
+        elif kind == Protocol.JOIN:
+            self.on_join(channelName, username)
+        elif kind == Protocol.PART:
+            self.on_part(channelName, username)
+        return None
+
+    def dispatch_text(self, message):
+        # text mode: a control message may come in one read with the replies around it
+        for part in (ClientEvents.split(message) if not self.binary else (message,)):
+            reason = self.dispatch_part(part)
+            if reason is not None:
+                return reason
+        return None
+
+    def dispatch_part(self, message):
+        kind, value = ClientEvents.interpret(message)
+        if kind == ClientEvents.QUIT or kind == ClientEvents.SQUIT:
+            return kind
+        if kind == ClientEvents.PING:
+            self.write('/pong')
+            return None
+        if kind == ClientEvents.PONG and self.requests and self.requests[0][2]:
+            future, replies, fenced = self.requests.popleft()
+            if future is None:
+                for reply in replies:
+                    self.on_text(reply)
+            elif not future.done():
+                future.set_result(''.join(replies))
+            return None
+        if kind == ClientEvents.JOINED and not self.binary:
+            self.members = set(value[1])
+        elif kind == ClientEvents.LEFT and not self.binary:
+            self.members.discard(value[1])
+
+        if not self.requests:
+            self.on_text(message)
+        elif self.requests[0][2]:
+            self.requests[0][1].append(message)
+        else:
+            # not fenced: the next message is the reply
+            future, replies, fenced = self.requests.popleft()
+            if not future.done():
+                future.set_result(message)
+        return None
+
+    def drop(self, reason):
+        self.connected.clear()
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = self.incoming = None
+        requests, self.requests = self.requests, collections.deque()
+        for future, replies, fenced in requests:
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError("the connection was lost: {0}".format(reason)))
+        self.on_disconnect(reason)
+
+    # queues a chat line or command, it is written together with whatever else is sent before the next drain()
+    def send(self, text):
+        self.write(text)
+        self.unfenced = True
+
+    def write(self, text):
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError("the session is not connected")
+        if self.binary:
+            self.writer.write(Protocol.encode_client_message(text))
+        elif self.framing == 'line':
+            self.writer.write(text.encode('utf8') + b'\n')
+        else:
+            self.writer.write(text.encode('utf8'))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    # sends a command and returns the text the server answered it with
+    async def request(self, command, timeout=REQUEST_TIMEOUT):
+        future = asyncio.get_running_loop().create_future()
+        fenced = self.binary or self.framing == 'line' # the /ping could be read as part of the command otherwise
+        if fenced and self.unfenced:
+            # the replies to what was sent since the last request go to on_text
+            self.requests.append((None, [], True))
+            self.write('/ping')
+        self.requests.append((future, [], fenced))
+        self.write(command)
+        if fenced:
+            self.write('/ping')
+        self.unfenced = False
+        await self.drain()
+        return await asyncio.wait_for(future, timeout)
+
+    def join(self, channel):
+        if channel not in self.channels:
+            self.channels.append(channel)
+        if self.connected.is_set():
+            self.send('/join ' + channel)
+
+    def part(self, channel):
+        if channel in self.channels:
+            self.channels.remove(channel)
+        if self.connected.is_set():
+            self.send('/part ' + channel)
+
+    def say(self, text):
+        self.send(text)
+
+    # target may be several comma separated usernames
+    def privmsg(self, target, text):
+        self.send('/privmsg {0} {1}'.format(target, text))
+
+    async def close(self):
+        self.closing = True
+        if self.writer is not None and not self.writer.is_closing():
+            try:
+                self.send('/quit')
+                await self.drain()
+            except OSError:
+                pass
+            self.writer.close()
+
+
+# answers every private message with the same text, an example bot and a probe that private messages work
+class EchoBot(ChatSession):
+    def on_message(self, channel, username, text):
+        if channel is None and username != self.username:
+            self.privmsg(username, text)
+
+
+async def probe(args, index):
+    username = args.username if args.sessions == 1 else '{0}{1}'.format(args.username, index)
+    sessionClass = EchoBot if args.echo else ChatSession
+    session = sessionClass(args.host, args.port, username, framing=args.framing, binary=args.protocol == 'binary', reconnect=args.echo)
+    task = asyncio.ensure_future(session.run())
+    ready = asyncio.ensure_future(session.connected.wait())
+    await asyncio.wait((task, ready), timeout=CONNECT_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+    if not session.connected.is_set():
+        ready.cancel()
+        task.cancel()
+        print("{0}: could not connect to {1}:{2}".format(username, args.host, args.port))
+        return
+    for channel in args.join:
+        session.join(channel)
+    for command in args.command:
+        reply = await session.request(command)
+        print("{0}: {1}\n{2}".format(username, command, reply.rstrip('\n')))
+    if not args.echo:
+        await session.close()
+    await task
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50000)
+    parser.add_argument('--username', default='probe', help='the sessions are numbered after it when there are several')
+    parser.add_argument('--sessions', type=int, default=1, help='sessions run on the one event loop')
+    parser.add_argument('--framing', choices=('raw', 'line'), default='raw', help='must match the --framing of the server')
+    parser.add_argument('--protocol', choices=('text', 'binary'), default='binary')
+    parser.add_argument('--join', action='append', default=[], help='channel to join, can be repeated')
+    parser.add_argument('--command', action='append', default=[], help='command to send and print the reply of, can be repeated')
+    parser.add_argument('--echo', action='store_true', help='stay connected and answer private messages until interrupted')
+    args = parser.parse_args()
+
+    async def run_all():
+        await asyncio.gather(*(probe(args, index) for index in range(args.sessions)))
+
+    try:
+        asyncio.run(run_all())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,687 @@
+# Micro-benchmarks for the chat server hot paths.
+#
+#   python Benchmarks.py            - run all benchmarks
+#   python Benchmarks.py dispatch   - run only the named benchmark(s)
+import argparse
+import contextlib
+import io
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import socket
+import sys
+import ChannelLog
+import Commands
+import Compression
+import Keepalive
+import OutboundQueue
+import Protocol
+import RateLimit
+import SearchIndex
+import UserListModel
+import UserRegistry
+
+MEMORY_BUDGET = 2048 # bytes per idle connection, see bench_memory
+SEARCH_BUDGET = 0.010 # seconds for the slowest /search query, see bench_search
+
+
+# average seconds per call of function(item) over items, the fastest of repeat runs
+def timed(function, items, repeat=1):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return best / len(items)
+
+
+def report(name, seconds, unit='op'):
+    print("{0:<45} {1:>10.1f} ns/{2}".format(name, seconds * 1e9, unit))
+
+
+# cost per message of the old substring if/elif chain against a dict lookup, the best of
+# repeat runs each, single runs vary too much to compare the two
+def bench_dispatch(messages=100000, repeat=7):
+    oldCommands = ['/quit', '/list', '/help', '/join', '/die', '/info', '/time', '/kill', '/ison', '/mode',
+                   '/nick', '/pass', '/version', '/topic', '/rules', '/setname', '/users', '/ping']
+    registry = Commands.CommandRegistry()
+    for name in oldCommands:
+        registry.register(name, lambda server, user, command: None)
+
+    # the old handlers split the line into its arguments again, at least once
+    def substring_chain(chatMessage):
+        for name in oldCommands:
+            if name in chatMessage:
+                return name, chatMessage.split()
+        return None
+
+    def dict_dispatch(chatMessage):
+        parsedCommand = Commands.parse(chatMessage)
+        if parsedCommand is None:
+            return None
+        command = registry.lookup(parsedCommand.name)
+        if command is not None:
+            command(None, None, parsedCommand)
+        return parsedCommand.name
+
+    samples = ['hello everyone, how is it going today?', '/ping', '/join lobby', '/ison alice bob']
+    for sample in samples:
+        lines = [sample] * messages
+        report("dispatch substring chain: " + sample[:16], timed(substring_chain, lines, repeat), 'msg')
+        report("dispatch dict lookup:     " + sample[:16], timed(dict_dispatch, lines, repeat), 'msg')
+
+
+class FakeSocket:
+    __slots__ = ('fd',)
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class FakeUser:
+    def __init__(self, socket, username='', nickname=''):
+        self.socket = socket
+        self.username = username
+        self.nickname = nickname
+        self.password = self.usertype = self.status = self.realname = ''
+
+
+# lookup, rename and removal with 50k users: linear list scans against the indexed registry
+def bench_user_registry(count=50000, lookups=2000):
+    users = [FakeUser(FakeSocket(i + 10), 'user{0}'.format(i), 'nick{0}'.format(i)) for i in range(count)]
+    registry = UserRegistry.UserRegistry()
+    start = time.perf_counter()
+    for user in users:
+        registry.add(user)
+    report("registry add ({0} users)".format(count), (time.perf_counter() - start) / count, 'user')
+
+    names = ['user{0}'.format(i * (count // lookups)) for i in range(lookups)]
+
+    def list_scan(name):
+        for user in users:
+            if user.username == name:
+                return user
+
+    report("lookup by username, list scan", timed(list_scan, names[:200]), 'lookup')
+    report("lookup by username, registry", timed(registry.get_by_username, names), 'lookup')
+    report("lookup by nickname, registry", timed(registry.get_by_nickname, [n.replace('user', 'nick') for n in names]), 'lookup')
+    report("lookup by fd, registry", timed(registry.get_by_fd, [i + 10 for i in range(lookups)]), 'lookup')
+
+    renamed = users[:lookups]
+    report("atomic rename of username, registry", timed(lambda user: registry.rename_username(user, user.username + 'x'), renamed), 'rename')
+
+    victims = users[-200:]
+    report("remove, list.remove", timed(users.remove, list(victims)), 'remove')
+    report("remove, registry", timed(registry.remove, victims), 'remove')
+
+
+# one chat line broadcast to a channel of 5k members
+def bench_fanout(members=5000, rounds=20):
+    stats = OutboundQueue.QueueStats()
+    queues = [OutboundQueue.OutboundQueue(stats=stats) for _ in range(members)]
+    chatMessage = 'hello everyone, this is a message of a typical length for a chat line\n'
+
+    def per_member(_):
+        # what Channel.broadcast_message does: format and encode the line again for every member
+        for queue in queues:
+            queue.push("{0} {1}".format('sender:', chatMessage).encode('utf8'))
+
+    def encode_once(_):
+        payload = "{0}: {1}".format('sender', chatMessage).encode('utf8')
+        for queue in queues:
+            queue.push(payload)
+
+    def drain():
+        for queue in queues:
+            queue.take(maxChunks=len(queue))
+
+    report("fan-out to {0}, encode per member".format(members), timed(per_member, range(rounds)), 'broadcast')
+    drain()
+    report("fan-out to {0}, encode once".format(members), timed(encode_once, range(rounds)), 'broadcast')
+
+    # writing out a backlog of queued messages: one send per message against one sendmsg per batch
+    left, right = socket.socketpair()
+    left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    payload = "{0}: {1}".format('sender', chatMessage).encode('utf8')
+    batch = [payload] * OutboundQueue.MAX_WRITE_BATCH
+
+    def drain_peer():
+        right.setblocking(False)
+        try:
+            while right.recv(1 << 20):
+                pass
+        except BlockingIOError:
+            pass
+
+    def send_each(_):
+        for chunk in batch:
+            left.sendall(chunk)
+        drain_peer()
+
+    def send_vectored(_):
+        left.sendmsg(batch)
+        drain_peer()
+
+    report("write {0} queued messages, sendall each".format(len(batch)), timed(send_each, range(2000)), 'batch')
+    report("write {0} queued messages, one sendmsg".format(len(batch)), timed(send_vectored, range(2000)), 'batch')
+    left.close()
+    right.close()
+
+
+# appending chat lines to a channel log, fsync per message against group commit, and replaying the tail
+def bench_channel_log(messages=20000, history=200000):
+    directory = tempfile.mkdtemp(prefix='chatlog-')
+    payload = 'sender: hello everyone, this is a message of a typical length for a chat line\n'.encode('utf8')
+    try:
+        journal = ChannelLog.ChannelJournal(os.path.join(directory, 'fsync-each'))
+
+        def append_fsync_each(_):
+            journal.append(payload)
+            journal.flush()
+
+        report("append + fsync per message", timed(append_fsync_each, range(500)), 'msg')
+        journal.close()
+
+        log = ChannelLog.ChannelLog(directory)
+        report("append, group commit every {0} ms".format(ChannelLog.FSYNC_INTERVAL * 1000), timed(lambda _: log.append('group', payload), range(messages)), 'msg')
+        start = time.perf_counter()
+        log.flush()
+        report("flush of the remaining appends", time.perf_counter() - start, 'flush')
+
+        for _ in range(history):
+            log.append('history', payload)
+        log.flush()
+        report("replay last 50 of {0}".format(history), timed(lambda _: log.replay('history', last=50), range(200)), 'replay')
+        since = log.journal('history').lastTime - 0.001
+        report("replay since a time, from {0}".format(history), timed(lambda _: log.replay('history', since=since), range(200)), 'replay')
+
+        for number in range(ChannelLog.MAX_OPEN_JOURNALS * 4):
+            log.append('channel{0}'.format(number), payload)
+        log.flush()
+        opened = sum(journal.file is not None for journal in log.journals.values())
+        print("{0} of {1} channel journals keep their files open, at most {2}".format(opened, len(log.journals), ChannelLog.MAX_OPEN_JOURNALS))
+        log.close()
+        return opened <= ChannelLog.MAX_OPEN_JOURNALS
+    finally:
+        shutil.rmtree(directory)
+
+
+# cost per message of the rate limit check, admitted and over the limit
+def bench_rate_limit(messages=200000):
+    limiter = RateLimit.RateLimiter()
+    unlimited = RateLimit.RateLimiter({name: (0, 0) for name in RateLimit.DEFAULT_LIMITS})
+    for sample in ('hello everyone, how is it going today?', '/ping', '/users'):
+        limits = unlimited.for_connection()
+        report("rate limit check, limits off: " + sample[:10], timed(lambda chatMessage: unlimited.check(limits, chatMessage), [sample] * messages), 'msg')
+        limits = limiter.for_connection()
+        report("rate limit check, defaults:   " + sample[:10], timed(lambda chatMessage: limiter.check(limits, chatMessage), [sample] * messages), 'msg')
+    report("channel bucket", timed(limiter.admit_channel, ['lobby'] * messages), 'msg')
+    report("accept bucket per address, 1000 addresses", timed(RateLimit.RateLimiter({'accept': (5, 20)}).admit_address,
+                                                                ['10.0.{0}.{1}'.format(i // 250 % 4, i % 250) for i in range(messages)]), 'accept')
+
+
+# keepalive deadlines of 100k connections: a scan of every connection per tick against the timer wheel
+def bench_keepalive(connections=100000, interval=60.0, ticks=600):
+    tick = Keepalive.TICK
+    wheel = Keepalive.TimerWheel(tick)
+    start = wheel.current * tick
+    timers = []
+    for index in range(connections):
+        timer = Keepalive.Timer()
+        wheel.schedule(timer, start + interval * index / connections)
+        timers.append(timer)
+
+    def scan(now):
+        return [timer for timer in timers if timer.deadline <= now]
+
+    report("scan {0} deadlines".format(connections), timed(scan, [start + tick * step for step in range(1, 21)]), 'tick')
+
+    def advance(now):
+        for timer in wheel.advance(now):
+            wheel.schedule(timer, now + interval)
+
+    # every tick expires and reschedules connections / (interval / tick) timers
+    report("timer wheel, {0} timers".format(connections), timed(advance, [start + tick * step for step in range(1, ticks + 1)]), 'tick')
+    report("timer wheel schedule", timed(lambda timer: wheel.schedule(timer, start + interval * 2), timers), 'op')
+
+
+# leaving every channel on disconnect, a scan of all channels against the user -> channels index,
+# and /who masks compiled every time against the pattern cache
+def bench_membership(channels=10000, memberships=3, users=2000):
+    members = {'channel{0}'.format(index): UserRegistry.MemberSet() for index in range(channels)}
+    index = {}
+    people = [FakeUser(FakeSocket(fd), 'user{0}'.format(fd)) for fd in range(users)]
+    for number, user in enumerate(people):
+        for offset in range(memberships):
+            name = 'channel{0}'.format((number * 7 + offset * 131) % channels)
+            members[name].append(user)
+            index.setdefault(user, set()).add(name)
+
+    def scan_channels(user):
+        for channel in members.values():
+            if user in channel:
+                channel.discard(user)
+
+    def indexed(user):
+        for name in index.pop(user, ()):
+            members[name].discard(user)
+
+    report("leave on disconnect, scan {0} channels".format(channels), timed(scan_channels, people[:200]), 'user')
+    report("leave on disconnect, index", timed(indexed, people[200:]), 'user')
+
+    names = [user.username for user in people]
+    masks = ['user1*', '*99', 'user?5*'] * 100
+    compile_mask = UserRegistry.mask_pattern.__wrapped__
+    report("/who mask, compiled per query", timed(lambda mask: compile_mask(mask), masks), 'query')
+    report("/who mask, pattern cache", timed(lambda mask: UserRegistry.mask_pattern(mask), masks), 'query')
+    report("/who mask, match {0} names".format(users), timed(lambda mask: [name for name in names if UserRegistry.mask_pattern(mask).match(name)], masks), 'query')
+
+
+# the GUI chat window fed 10k messages per second by a socket thread: one insert per message (the old
+# update_chat_window) against the queue drained once per frame, with the scrollback kept bounded
+def bench_chat_window(rate=10000, seconds=3):
+    try:
+        import tkinter
+        import chatWindow
+        root = tkinter.Tk()
+    except Exception as error:
+        print("chat window benchmark skipped, it needs tkinter, a display and the GUI modules: {0}".format(error))
+        return
+    window = chatWindow.ChatWindow(root)
+    line = 'sender: hello everyone, this is a message of a typical length for a chat line\n'
+    textArea = window.messageTextArea
+
+    def insert_each(_):
+        textArea.configure(state='normal')
+        textArea.insert(tkinter.END, line)
+        textArea.configure(state='disabled')
+        root.update_idletasks()
+
+    report("insert per message", timed(insert_each, range(rate)), 'msg')
+    window.clear_chat_window()
+
+    done = threading.Event()
+    gaps = []
+
+    def feeder():
+        perMillisecond = max(1, rate // 1000)
+        deadline = time.perf_counter()
+        for _ in range(seconds * 1000):
+            for _ in range(perMillisecond):
+                window.post(window.update_chat_window, line)
+            deadline += 0.001
+            time.sleep(max(0.0, deadline - time.perf_counter()))
+        done.set()
+
+    last = [time.perf_counter()]
+
+    def heartbeat():
+        now = time.perf_counter()
+        gaps.append(now - last[0])
+        last[0] = now
+        if done.is_set() and window.pending.empty():
+            root.quit()
+        else:
+            root.after(5, heartbeat)
+
+    cpuStart = time.thread_time()
+    threading.Thread(target=feeder, daemon=True).start()
+    root.after(5, heartbeat)
+    root.mainloop()
+    messages = rate * seconds
+    report("batched per frame, {0} msg/s for {1} s".format(rate, seconds), (time.thread_time() - cpuStart) / messages, 'msg')
+    report("longest main loop stall", max(gaps), 'stall')
+    print("lines kept in the chat window: {0} of {1}".format(int(textArea.index('end-1c').split('.')[0]), messages))
+    root.destroy()
+
+
+# stands in for tkinter.Listbox so the user list can be measured without a display, get copies like Tk does
+class FakeListbox:
+    def __init__(self):
+        self.items = []
+
+    def get(self, first, last):
+        return tuple(self.items)
+
+    def insert(self, index, *items):
+        index = len(self.items) if index == 'end' else index
+        self.items[index:index] = items
+
+    def delete(self, first, last=None):
+        if last == 'end':
+            del self.items[first:]
+        else:
+            del self.items[first:(first if last is None else last) + 1]
+
+
+# the GUI user list on a /join of a big channel and under join/leave churn: the old scan of the
+# Listbox per user against the sorted model that patches the Listbox once per frame
+def bench_user_list(members=5000, churn=2000, perFrame=20):
+    names = ['user{0}'.format(index) for index in range(members)]
+
+    def scan_join(_):
+        listbox = FakeListbox()
+        for user in names:
+            if user not in listbox.get(0, 'end'):
+                listbox.insert('end', user)
+
+    def model_join(_):
+        listbox = FakeListbox()
+        model = UserListModel.UserListModel()
+        model.clear()
+        for user in names:
+            model.add(user)
+        model.flush(listbox)
+
+    report("join {0} members, Listbox scan".format(members), timed(scan_join, range(1)), 'join')
+    report("join {0} members, model".format(members), timed(model_join, range(20)), 'join')
+
+    events = [('leave' if index % 2 else 'join', names[index * 7919 % members]) for index in range(churn)]
+    listbox = FakeListbox()
+    listbox.insert('end', *names)
+
+    def scan_event(event):
+        kind, user = event
+        if kind == 'join':
+            if user not in listbox.get(0, 'end'):
+                listbox.insert('end', user)
+        elif user in listbox.get(0, 'end'):
+            listbox.delete(listbox.get(0, 'end').index(user))
+
+    report("join/leave in {0}, Listbox scan".format(members), timed(scan_event, events), 'event')
+
+    model = UserListModel.UserListModel()
+    model.update(joined=names)
+    modelListbox = FakeListbox()
+    model.flush(modelListbox)
+
+    def model_frame(frame):
+        for kind, user in frame:
+            if kind == 'join':
+                model.add(user)
+            else:
+                model.remove(user)
+        model.flush(modelListbox)
+
+    frames = [events[index:index + perFrame] for index in range(0, churn, perFrame)]
+    report("join/leave in {0}, model".format(members), timed(model_frame, frames) / perFrame, 'event')
+    assert modelListbox.items == model.names
+
+
+# what a client does with every message it gets: the substring checks and splits of the GUI's
+# text protocol against decoding frames and applying them to the id tables. The frames cost
+# about as much, what they buy is that a chat line can not be taken for a join or a leave.
+def bench_protocol(messages=100000, members=1000):
+    names = ' '.join('user{0}'.format(index) for index in range(members))
+    text = [b'user7: see you later, i left my keys at home\n'] * (messages - 2) + \
+           ['\n\n> user9 has joined the channel lobby!\n|{0}'.format(names).encode('utf8'), b'\n> user9 has left the channel lobby\n']
+
+    def parse_text(data):
+        message = data.decode('utf8')
+        if 'joined' in message:
+            return message.split('|')[1].split(' ')
+        if 'left' in message:
+            return message.split(' ')[2]
+        return message.partition(': ') # sender and text, a client can not tell a chat line from a notice for sure
+
+    state = Protocol.ClientState('user0')
+    setup = [Protocol.encode_frame(Protocol.CHANNEL, 1, 0, b'lobby')] + \
+            [Protocol.encode_frame(Protocol.NAME, 0, index + 1, 'user{0}'.format(index).encode('utf8')) for index in range(members)]
+    decoder = Protocol.FrameDecoder(1 << 20)
+    for frame in decoder.frames(b''.join(setup)):
+        state.apply(*frame)
+    frames = [Protocol.encode_frame(Protocol.CHAT, 1, 8, b'see you later, i left my keys at home')] * (messages - 2) + \
+             [Protocol.encode_frame(Protocol.JOIN, 1, 10), Protocol.encode_frame(Protocol.PART, 1, 10)]
+
+    def parse_frame(data):
+        for frame in decoder.frames(data):
+            state.apply(*frame)
+
+    report("client, text protocol", timed(parse_text, text), 'msg')
+    report("client, binary protocol", timed(parse_frame, frames), 'msg')
+    chunk = b''.join(frames[:1000])
+    report("client, binary protocol, 1000 frames per read", timed(parse_frame, [chunk] * (messages // 1000)) / 1000, 'msg')
+
+
+# ratio and CPU cost of the per-frame deflate, and what compressing a broadcast once saves
+def bench_compression(members=1000, rounds=200):
+    names = ' '.join('user{0}'.format(index) for index in range(members))
+    page = ''.join("    #channel{0}: {1} user(s)\n".format(index, index % 40 + 1) for index in range(100))
+    payloads = {
+        'join notice, {0} members'.format(members): '\n\n> user9 has joined the channel lobby!\n|{0}'.format(names).encode('utf8'),
+        '/list page of 100 channels': ("\n\n> Current channels available are: \n" + page).encode('utf8'),
+        'chat line, 300 bytes': ('user7: ' + 'see you later, i left my keys at home. ' * 8).encode('utf8'),
+    }
+    for name, payload in payloads.items():
+        stats = Compression.CompressionStats()
+        deflated = Compression.Deflater(stats).compress(payload) or payload
+        print("{0:<45} {1:>6} -> {2:>6} bytes".format(name, len(payload), len(deflated)))
+
+    payload = payloads['chat line, 300 bytes']
+    report("deflate a chat line", timed(lambda data: Compression.Deflater(Compression.CompressionStats()).compress(data), [payload] * rounds * 10), 'msg')
+    report("inflate a chat line", timed(lambda data: Compression.inflate(data, 1 << 20), [Compression.Deflater(Compression.CompressionStats()).compress(payload)] * rounds * 10), 'msg')
+
+    # a broadcast to all members, compressed per member as a stream per connection would, or once
+    def per_member(data):
+        for _ in range(members):
+            compressor = Compression.new_compressor()
+            compressor.compress(data) + compressor.flush()
+
+    deflater = Compression.Deflater(Compression.CompressionStats())
+    report("broadcast, compressed per member", timed(per_member, [payload] * (rounds // 20)) / members, 'member')
+    report("broadcast, compressed once, cached per member", timed(lambda data: [deflater.compress(data) for _ in range(members)], [payload] * (rounds // 20)) / members, 'member')
+
+
+# stress test of the shared state: threads join, part, chat and /kill each other in a few channels
+# at once, afterwards every membership has to be in both indexes and no thread may have failed.
+# Returns False otherwise, tests/test_membership.py runs the same check with fewer operations.
+def bench_churn(threads=16, operations=5000, channels=8, population=200):
+    import random
+    import ChatServer
+    server = ChatServer.Server('127.0.0.1', 0)
+    server.serverSocket.close()
+    fds = itertools.count(100)
+    names = ['#churn{0}'.format(index) for index in range(channels)]
+
+    def new_user():
+        user = server.add_user(FakeSocket(next(fds)))
+        server.users.rename_username(user, 'churner{0}'.format(user.socket.fd))
+        user.registered = True
+        return user
+
+    people = [new_user() for _ in range(population)]
+    errors = []
+
+    def worker(seed):
+        generator = random.Random(seed)
+        try:
+            for _ in range(operations):
+                index = generator.randrange(len(people))
+                user = people[index]
+                action = generator.random()
+                if action < 0.4:
+                    server.join(user, Commands.parse('/join ' + generator.choice(names)))
+                elif action < 0.7:
+                    server.part(user, Commands.parse('/part ' + generator.choice(names)))
+                elif action < 0.95:
+                    server.send_message(user, 'hello\n')
+                else:
+                    server.disconnect_user(user)
+                    people[index] = new_user()
+        except Exception as error:
+            errors.append(error)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # the server prints every disconnect
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    broken = 0
+    for name in names:
+        channel = server.channels.get(name)
+        for member in (channel.users if channel is not None else ()):
+            if member not in server.users or name not in server.users_channels_map.get(member, ()):
+                broken += 1
+    for user, joined in server.users_channels_map.items():
+        for name in joined:
+            if user not in server.users or user not in server.channels[name].users:
+                broken += 1
+    report("churn, {0} threads".format(threads), elapsed / (threads * operations), 'op')
+    print("{0} failed thread(s), {1} broken membership(s)".format(len(errors), broken))
+    for error in errors[:3]:
+        print("    {0}: {1}".format(type(error).__name__, error))
+    return not errors and not broken
+
+
+# hands everything queued to nobody, like a SocketWriter whose client reads at once
+class DrainingWriter:
+    def notify(self, queuedSocket):
+        while queuedSocket.queue:
+            queuedSocket.queue.take()
+
+
+# bytes the server keeps per idle connection: registered, in one channel, nothing queued.
+# Returns (bytes per connection, the server, the measured users, tracemalloc's statistics).
+def measure_connection_memory(connections):
+    import gc
+    import tracemalloc
+    import ChatServer
+    server = ChatServer.Server('127.0.0.1', 0)
+    server.serverSocket.close()
+    writer = DrainingWriter()
+    fds = itertools.count(100)
+
+    def connect():
+        user = server.add_user(OutboundQueue.QueuedSocket(FakeSocket(next(fds)), server.new_outbound_queue(), writer))
+        server.receive(user, 'idler{0}'.format(user.socket.socket.fd).encode('utf8'))
+        server.receive(user, b'/join #lobby')
+        return user
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        warmup = [connect() for _ in range(50)] # the channel, caches and interned strings every connection shares
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        idle = [connect() for _ in range(connections)]
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+    growth = after.compare_to(before, 'lineno')
+    return sum(stat.size_diff for stat in growth) / connections, server, warmup + idle, growth
+
+
+# Threaded mode adds a receive buffer of Framing.IDLE_RECV_BUFFER_SIZE on top. Returns
+# False when a connection costs more than MEMORY_BUDGET.
+def bench_memory(connections=2000):
+    import Framing
+    perConnection, server, users, growth = measure_connection_memory(connections)
+    print("{0:<45} {1:>10.0f} bytes/connection (budget {2}, threaded mode adds {3})".format(
+        "idle connection", perConnection, MEMORY_BUDGET, Framing.IDLE_RECV_BUFFER_SIZE))
+    for stat in growth[:5]:
+        frame = stat.traceback[0]
+        print("    {0:>6.0f}  {1}:{2}".format(stat.size_diff / connections, os.path.basename(frame.filename), frame.lineno))
+    if len(server.users) != len(users):
+        print("connections were lost during the run")
+        return False
+    if hasattr(users[-1], '__dict__'):
+        print("connections carry an attribute dict")
+        return False
+    if perConnection > MEMORY_BUDGET:
+        print("over the memory budget")
+        return False
+    return True
+
+
+# indexing rate and query latency with a million messages spread over 50 channels,
+# words drawn from a Zipf-like vocabulary. Returns False when a query is slower than SEARCH_BUDGET.
+def bench_search(messages=1000000, channels=50, authors=2000, vocabulary=50000, repeat=20):
+    import random
+    generator = random.Random(1)
+    words = ['word{0}'.format(rank) for rank in range(vocabulary)]
+    pool = generator.choices(words, [1.0 / (rank + 1) for rank in range(vocabulary)], k=200000)
+    lines = [' '.join(pool[start:start + generator.randint(3, 12)]) for start in range(0, len(pool) - 12, 7)]
+    directory = tempfile.mkdtemp()
+    index = SearchIndex.SearchIndex(directory)
+    try:
+        items = [('#chan{0}'.format(number % channels), 'user{0}'.format(number * 7 % authors), lines[number % len(lines)]) for number in range(messages)]
+        report("index {0} messages".format(messages), timed(lambda item: index.add(*item), items), 'msg')
+        while index.frozen:
+            time.sleep(0.1)
+        print("{0} segment(s) on disk, levels {1}".format(len(index.segments), [segment.level for segment in index.segments]))
+
+        slowest = 0.0
+        for text, channelName in (('word0', None), ('word0', '#chan3'), ('word5 word9', None), ('"word0 word1"', None), ('from:user77', None),
+                                  ('from:user77 word0', '#chan7'), ('word20000 word1', None), ('nomatch', None), ('', '#chan9'),
+                                  ('word3 since:{0}'.format(time.time() - 1), None)):
+            query = SearchIndex.parse_query(text, channelName)
+            seconds = timed(lambda _: index.search(query), range(repeat))
+            slowest = max(slowest, seconds)
+            report("search {0} {1}".format(channelName or '*', text)[:45], seconds, 'query')
+    finally:
+        index.close()
+        shutil.rmtree(directory)
+    if slowest > SEARCH_BUDGET:
+        print("a query took more than {0} ms".format(SEARCH_BUDGET * 1000))
+        return False
+    return True
+
+
+BENCHMARKS = {
+    'search': bench_search,
+    'memory': bench_memory,
+    'channellog': bench_channel_log,
+    'chatwindow': bench_chat_window,
+    'membership': bench_membership,
+    'userlist': bench_user_list,
+    'protocol': bench_protocol,
+    'churn': bench_churn,
+    'compression': bench_compression,
+    'keepalive': bench_keepalive,
+    'ratelimit': bench_rate_limit,
+    'fanout': bench_fanout,
+    'dispatch': bench_dispatch,
+    'users': bench_user_registry,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default: ' + ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {0}".format(name))
+
+    failed = []
+    for name in args.names or sorted(BENCHMARKS):
+        print("\n== {0} ==".format(name))
+        if BENCHMARKS[name]() is False: # benchmarks with a budget return False when they exceed it
+            failed.append(name)
+
+    if failed:
+        sys.exit("over budget: " + ', '.join(failed))
+
+if __name__ == "__main__":
+    main()
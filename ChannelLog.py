@@ -0,0 +1,327 @@
+# Persistent message history of the channels (--log-dir).
+#
+# Every channel has a directory, '#' and the quoted channel name, with an
+# append-only log split into segments:
+#
+#   <first sequence number>.log   records, one after the other
+#   <first sequence number>.idx   sparse index: (sequence, time, offset) of every
+#                                 INDEX_INTERVAL bytes of records
+#
+# A record is a fixed header followed by the encoded payload that was broadcast:
+#
+#   length:u32  sequence:u64  time:f64  crc32:u32  payload
+#
+# Appending only queues the record. A flusher thread writes everything queued in
+# one write() and makes it durable with one fsync() per FSYNC_INTERVAL, so a burst
+# of messages costs a single disk flush (group commit). Replaying the last N
+# messages, or the messages since a time, looks the starting point up in the
+# index and reads the segments through mmap from there, never the whole log.
+# Only the MAX_OPEN_JOURNALS channels written last keep their files open, the
+# others reopen them on their next write.
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+
+RECORD_HEADER = struct.Struct('<IQdI')
+INDEX_ENTRY = struct.Struct('<QdQ')
+SEGMENT_SIZE = 16 << 20 # bytes before a new segment is started
+INDEX_INTERVAL = 4096 # bytes of records between two index entries
+FSYNC_INTERVAL = 0.005 # seconds appends are collected before they are flushed to disk
+REPLAY_COUNT = 20 # messages replayed on /join when no count is given
+MAX_REPLAY_COUNT = 500 # most messages one /join replays, whatever count or time it asks for
+MAX_OPEN_JOURNALS = 64 # channels whose log and index stay open between writes
+
+
+# 'hh:mm' or 'hh:mm:ss' of today, or a unix time, None if it is neither
+def parse_time(text):
+    if text.replace('.', '', 1).isdigit():
+        return float(text)
+    try:
+        parts = [int(part) for part in text.split(':')]
+    except ValueError:
+        return None
+    if len(parts) not in (2, 3) or not 0 <= parts[0] < 24 or not all(0 <= part < 60 for part in parts[1:]):
+        return None
+    now = time.localtime()
+    return time.mktime((now.tm_year, now.tm_mon, now.tm_mday) + tuple(parts + [0] * (3 - len(parts))) + (0, 0, -1))
+
+
+class Segment:
+    def __init__(self, path, base):
+        self.base = base # sequence number of the first record
+        self.logPath = path + '.log'
+        self.indexPath = path + '.idx'
+        self.size = 0 # bytes of complete records
+        self.nextSequence = base
+        self.lastTime = 0.0
+        self.sequences = [] # sparse index, kept in memory for bisect
+        self.times = []
+        self.offsets = []
+        self.indexedUpTo = -INDEX_INTERVAL # offset of the last index entry
+
+    def add_index(self, sequence, timestamp, offset):
+        self.sequences.append(sequence)
+        self.times.append(timestamp)
+        self.offsets.append(offset)
+        self.indexedUpTo = offset
+        return INDEX_ENTRY.pack(sequence, timestamp, offset)
+
+    def load(self):
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath, 'rb') as indexFile:
+                data = indexFile.read()
+            for entry in range(len(data) // INDEX_ENTRY.size):
+                self.add_index(*INDEX_ENTRY.unpack_from(data, entry * INDEX_ENTRY.size))
+        self.recover()
+
+    # finds the end of the last complete record after the last index entry, a torn write is cut off
+    def recover(self):
+        offset = self.offsets[-1] if self.offsets else 0
+        missing = []
+        with open(self.logPath, 'rb') as logFile:
+            logFile.seek(offset)
+            data = logFile.read()
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            length, sequence, timestamp, checksum = RECORD_HEADER.unpack_from(data, position)
+            end = position + RECORD_HEADER.size + length
+            if end > len(data) or zlib.crc32(data[position + RECORD_HEADER.size:end]) != checksum:
+                break
+            if offset + position - self.indexedUpTo >= INDEX_INTERVAL:
+                missing.append(self.add_index(sequence, timestamp, offset + position))
+            self.nextSequence = sequence + 1
+            self.lastTime = timestamp
+            position = end
+        self.size = offset + position
+        if self.size < os.path.getsize(self.logPath):
+            os.truncate(self.logPath, self.size)
+        if missing:
+            with open(self.indexPath, 'ab') as indexFile:
+                indexFile.write(b''.join(missing))
+
+    # records from the indexed position at or before `sequence`
+    def start_for_sequence(self, sequence):
+        index = bisect.bisect_right(self.sequences, sequence) - 1
+        return self.offsets[index] if index >= 0 else 0
+
+    def start_for_time(self, timestamp):
+        index = bisect.bisect_left(self.times, timestamp) - 1
+        return self.offsets[index] if index >= 0 else 0
+
+    # yields (sequence, time, payload) from byte `offset` on, read through mmap
+    def read(self, offset, size):
+        if size <= offset:
+            return
+        with open(self.logPath, 'rb') as logFile:
+            with mmap.mmap(logFile.fileno(), size, access=mmap.ACCESS_READ) as view:
+                while offset + RECORD_HEADER.size <= size:
+                    length, sequence, timestamp, checksum = RECORD_HEADER.unpack_from(view, offset)
+                    start = offset + RECORD_HEADER.size
+                    yield sequence, timestamp, view[start:start + length]
+                    offset = start + length
+
+
+# The log of one channel.
+class ChannelJournal:
+    def __init__(self, directory, segmentSize=SEGMENT_SIZE, retainSegments=0):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.retainSegments = retainSegments # 0 keeps every segment
+        self.lock = threading.Lock()
+        self.pending = [] # packed records not written yet
+        self.pendingRecords = [] # (sequence, time, payload) of the same records, for replay
+        self.writing = [] # records being written by flush(), still replayed from memory
+        self.ioLock = threading.Lock() # held by flush() while it writes and fsyncs
+        self.lastTime = 0.0
+        self.lastWrite = 0.0 # time.monotonic() of the last write, the least recent ones are released first
+        self.file = None # opened by the first flush() that has records to write
+        self.dirty = False # written but not fsynced
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        for name in sorted(os.listdir(directory), key=lambda name: int(name.split('.')[0]) if name[0].isdigit() else -1):
+            if name.endswith('.log'):
+                base = int(name[:-4])
+                self.segments.append(Segment(os.path.join(directory, str(base)), base))
+        for segment in self.segments:
+            segment.load()
+        if self.segments:
+            self.lastTime = self.segments[-1].lastTime
+            self.nextSequence = self.segments[-1].nextSequence
+        else:
+            self.nextSequence = 0
+        self.open_segment(self.segments[-1] if self.segments else None)
+        self.drop_old_segments()
+
+    def open_segment(self, segment):
+        if segment is None:
+            segment = Segment(os.path.join(self.directory, str(self.nextSequence)), self.nextSequence)
+            self.segments.append(segment)
+        self.close_files()
+
+    def close_files(self):
+        if self.file is not None:
+            self.file.close()
+            self.indexFile.close()
+            self.file = self.indexFile = None
+
+    def append(self, payload):
+        with self.lock:
+            # keep the times in order so the index can be searched by time
+            timestamp = self.lastTime = max(time.time(), self.lastTime)
+            sequence = self.nextSequence
+            self.nextSequence += 1
+            self.pending.append(RECORD_HEADER.pack(len(payload), sequence, timestamp, zlib.crc32(payload)) + payload)
+            self.pendingRecords.append((sequence, timestamp, payload))
+
+    # writes and fsyncs the queued records, appends only wait for the swap of the queue, never for the disk
+    def flush(self):
+        with self.ioLock:
+            with self.lock:
+                records, self.pending = self.pending, []
+                self.writing, self.pendingRecords = self.pendingRecords, []
+            if records:
+                segment = self.segments[-1]
+                offset, indexedUpTo = segment.size, segment.indexedUpTo
+                entries = []
+                for record, (sequence, timestamp, payload) in zip(records, self.writing):
+                    if offset - indexedUpTo >= INDEX_INTERVAL:
+                        entries.append((sequence, timestamp, offset))
+                        indexedUpTo = offset
+                    offset += len(record)
+                if self.file is None:
+                    self.file = open(segment.logPath, 'ab', buffering=0)
+                    self.indexFile = open(segment.indexPath, 'ab', buffering=0)
+                self.file.write(b''.join(records))
+                if entries:
+                    self.indexFile.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+                with self.lock:
+                    for entry in entries:
+                        segment.add_index(*entry)
+                    segment.size = offset
+                    segment.nextSequence = self.writing[-1][0] + 1
+                    self.writing = []
+                self.dirty = True
+                self.lastWrite = time.monotonic()
+            if self.dirty:
+                os.fsync(self.file.fileno())
+                os.fsync(self.indexFile.fileno())
+                self.dirty = False
+            if self.segments[-1].size >= self.segmentSize:
+                with self.lock:
+                    self.open_segment(None)
+                    self.drop_old_segments()
+
+    def drop_old_segments(self):
+        while self.retainSegments and len(self.segments) > self.retainSegments:
+            segment = self.segments.pop(0)
+            for path in (segment.logPath, segment.indexPath):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    # gives the file descriptors back until the next write
+    def release(self):
+        with self.ioLock:
+            if not self.dirty:
+                self.close_files()
+
+    def close(self):
+        self.flush()
+        self.close_files()
+
+    # (sequence, time, payload) of the records that match, oldest first
+    def replay(self, last=None, since=None):
+        with self.lock:
+            segments = [(segment, segment.size) for segment in self.segments]
+            pending = self.writing + self.pendingRecords
+            first = max(0, self.nextSequence - last) if last is not None else None
+
+        if first is not None:
+            bases = [segment.base for segment, size in segments]
+            start = max(0, bisect.bisect_right(bases, first) - 1)
+        else:
+            firstTimes = [segment.times[0] if segment.times else float('inf') for segment, size in segments]
+            start = max(0, bisect.bisect_left(firstTimes, since) - 1)
+
+        if first is not None:
+            matches = lambda record: record[0] >= first
+        else:
+            matches = lambda record: record[1] >= since
+        records = []
+        for segment, size in segments[start:]:
+            offset = segment.start_for_sequence(first) if first is not None else segment.start_for_time(since)
+            records.extend(record for record in segment.read(offset, size) if matches(record))
+        records.extend(record for record in pending if matches(record))
+        return records
+
+
+# The journals of every channel and the thread that flushes them.
+class ChannelLog:
+    def __init__(self, directory, segmentSize=SEGMENT_SIZE, fsyncInterval=FSYNC_INTERVAL, retainSegments=0, maxOpenJournals=MAX_OPEN_JOURNALS):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.fsyncInterval = fsyncInterval
+        self.retainSegments = retainSegments
+        self.maxOpenJournals = maxOpenJournals
+        self.lock = threading.Lock()
+        self.journals = {} # channel name -> ChannelJournal
+        self.ready = threading.Event()
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.flush_loop, name='ChannelLog', daemon=True)
+        self.thread.start()
+
+    def journal(self, channelName):
+        journal = self.journals.get(channelName)
+        if journal is None:
+            with self.lock:
+                journal = self.journals.get(channelName)
+                if journal is None:
+                    path = self.journal_path(channelName)
+                    journal = self.journals[channelName] = ChannelJournal(path, self.segmentSize, self.retainSegments)
+        return journal
+
+    # the prefix keeps names like '.' and '..' inside the log directory, and apart from the worker-N directories of --workers
+    def journal_path(self, channelName):
+        return os.path.join(self.directory, '#' + urllib.parse.quote(channelName, safe=''))
+
+    def append(self, channelName, payload):
+        if not self.closed:
+            self.journal(channelName).append(payload)
+            self.ready.set()
+
+    def replay(self, channelName, last=None, since=None):
+        return self.journal(channelName).replay(last, since)
+
+    def flush_loop(self):
+        while not self.closed:
+            self.ready.wait()
+            time.sleep(self.fsyncInterval) # let more appends pile up for the same fsync
+            self.ready.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            journals = list(self.journals.values())
+        for journal in journals:
+            journal.flush()
+        opened = [journal for journal in journals if journal.file is not None]
+        if len(opened) > self.maxOpenJournals:
+            opened.sort(key=lambda journal: journal.lastWrite)
+            for journal in opened[:len(opened) - self.maxOpenJournals]:
+                journal.release()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.ready.set()
+            self.thread.join()
+            with self.lock:
+                for journal in self.journals.values():
+                    journal.close()
@@ -0,0 +1,133 @@
+import asyncio
+
+
+# Gives a transport the small part of the socket API that Server and Channel use,
+# so the command handlers work the same in threaded and asyncio mode. Data goes
+# straight to the transport until it asks us to pause, after that it waits in the
+# bounded OutboundQueue where the slow consumer policy applies.
+class TransportSocket:
+    __slots__ = ('transport', 'queue', 'paused')
+
+    def __init__(self, transport, queue):
+        self.transport = transport
+        self.queue = queue
+        self.paused = False
+
+    def sendall(self, data):
+        if self.transport.is_closing():
+            return
+        if not self.paused and not len(self.queue):
+            self.transport.write(data)
+            self.queue.stats.add(sent=len(data))
+        elif not self.queue.push(data if type(data) is bytes else bytes(data)):
+            self.transport.abort()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def flush(self):
+        while not self.paused and len(self.queue):
+            chunks = self.queue.take()
+            self.transport.writelines(chunks)
+            self.queue.stats.add(sent=sum(len(chunk) for chunk in chunks))
+
+    def close(self):
+        self.transport.close()
+
+    def abort(self):
+        self.transport.abort()
+
+    def fileno(self):
+        sock = self.transport.get_extra_info('socket')
+        return sock.fileno() if sock is not None else -1
+
+    def getpeername(self):
+        return self.transport.get_extra_info('peername')
+
+
+# One instance per connection. It only keeps the server and the user, so an idle
+# connection costs little more than the transport itself.
+class ClientProtocol(asyncio.Protocol):
+    __slots__ = ('server', 'user', 'socket')
+
+    # user is set for a session handed over by /restart
+    def __init__(self, server, user=None):
+        self.server = server
+        self.user = user
+        self.socket = None
+
+    def connection_made(self, transport):
+        # the transport buffers up to the low watermark itself, anything beyond waits in our queue
+        transport.set_write_buffer_limits(high=self.server.outboundLowWater)
+        self.socket = TransportSocket(transport, self.server.new_outbound_queue(threadSafe=False))
+        if self.user is None:
+            peer = transport.get_extra_info('peername')
+            if peer and not self.server.admit_address(peer[0]):
+                transport.abort()
+                return
+            self.user = self.server.add_user(self.socket)
+            self.server.greet_user(self.user)
+        else:
+            transport.pause_reading() # until every restored session has its transport, see resume()
+
+    # continues a session handed over by /restart
+    def resume(self):
+        pendingInput = self.server.resume_user(self.user, self.socket)
+        if pendingInput:
+            self.data_received(pendingInput)
+        if not self.socket.transport.is_closing():
+            self.socket.transport.resume_reading()
+
+    def data_received(self, data):
+        if self.server.exit_signal.is_set() or self.user is None:
+            return
+
+        if not self.server.receive(self.user, data):
+            self.user.socket.close()
+
+    def pause_writing(self):
+        self.socket.paused = True
+
+    def resume_writing(self):
+        self.socket.paused = False
+        self.socket.flush()
+
+    def connection_lost(self, exc):
+        # /quit and /kill already removed the user
+        if self.user in self.server.users:
+            self.server.remove_user(self.user)
+
+
+async def serve(server, backlog, poll_interval=1):
+    loop = asyncio.get_running_loop()
+    server.loop = loop
+    server.serverSocket.setblocking(False)
+    server.listener = await loop.create_server(lambda: ClientProtocol(server), sock=server.serverSocket, backlog=backlog)
+    server.keepalive.start(loop)
+    resumed = []
+    for user in list(server.users):
+        if hasattr(user, 'resume'):
+            transport, protocol = await loop.connect_accepted_socket(lambda user=user: ClientProtocol(server, user), user.socket)
+            resumed.append(protocol)
+    for protocol in resumed:
+        protocol.resume()
+    for clientSocket in server.adopted:
+        await loop.connect_accepted_socket(lambda: ClientProtocol(server), clientSocket)
+    server.adopted = []
+
+    while not server.exit_signal.is_set():
+        await asyncio.sleep(poll_interval)
+
+    server.listener.close()
+    for user in list(server.users):
+        server.send_control(user, '/squit')
+        user.socket.close()
+    await asyncio.sleep(0) # let the transports flush and close
+
+
+def run(server, backlog):
+    try:
+        asyncio.run(serve(server, backlog))
+    except KeyboardInterrupt:
+        server.exit_signal.set()
@@ -1,44 +1,66 @@
+import hmac
+import itertools
+import os
 import socket
 import sys
 import threading
 import Channel
-import User
 import Util
+import ChatEventLoop
+import Commands
+import Framing
+import UserRegistry
+import OutboundQueue
+import WorkerBus
+import ServerLink
+import ResponseCache
+import Metrics
+import ChannelLog
+import WarmRestart
+import RateLimit
+import Keepalive
+import Protocol
+import Compression
+import SearchIndex
 import datetime
+import time
+import traceback
 import argparse
 
 
 class Server:
-    SERVER_CONFIG = {"MAX_CONNECTIONS": 15}
+    SERVER_CONFIG = {"MAX_CONNECTIONS": 15, "BACKLOG": 1024}
     HELP_MESSAGE = """\n> The list of commands available are:
 
     /HELP                                                           - Show the instructions
-    /JOIN [channel_name] [password]                                 - To create or switch to a channel.
+    /JOIN [channel_name] [count | since hh:mm]                      - To create or join a channel, your messages go there, and see its last messages.
     /QUIT                                                           - Exits the program.
     /LIST                                                           - Lists all available channels.
 
     /AWAY [messege]                                                 - mode - send everything as a privet message 
-    /CONNECT [target server] [port] [remote server]                 - connect to a remote server
-    /DIE                                                            - shut down server
+    /CONNECT [target server] [port] [remote server]                 - operators only, link to a remote server
+    /DIE                                                            - operators only, shut down server
     /INFO                                                           - Returns information about the <target> server, or the current server if <target> is omitted
     /INVITE [nickname] [channel]                                    - Invite a client to an invite-only channel
     /ISON [nicknames]                                               - Queries the server to see if the clients in the space-separated list <nicknames> are currently on the network.
     /KICK  [channel] [client]                                       - Eject a client from the channel
-    /KILL [client]                                                  - forcibly remove client form server
+    /KILL [client]                                                  - operators only, forcibly remove client form server
     /KNOCK [channel]                                                - send a invite-request to a private channel
-    /MODE                                                           - Change the channels mode
+    /MODE [+flags | -flags] [channel]                               - channel creator and operators only, change the channels mode, +i makes it invite only
     /NICK  [nickname]                                               - change user nickname to [nickname] 
-    /NOTICE [target user] [messege]                                 - private message, no auto reply
-    /PART   [channel]                                               - user leaves specified channel
+    /NOTICE [target,...] [messege]                                  - private message, no auto reply and no error replies
+    /PART   [channel]                                               - user leaves specified channel, or the current one
     /OPER [username] [password]                                     - authenticates user as operator
     /PASS [password]                                                - set a connection password
     /PING                                                           - test the connection with server
     /PONG                                                           - reply to the PING command
-    /PRIVMSG [target] [message]                                     - private message to [target] 
-    /RESTART                                                        - restart server
+    /PRIVMSG [target,...] [message]                                 - private message to one or more comma separated users
+    /RESTART                                                        - operators only, restart server, client connections stay open, server links are dropped
     /RULES                                                          - request server rules
+    /SEARCH [channel | *] [query]                                   - find messages in a channel or in all of them, query: words "a phrase" from:user since:hh:mm until:hh:mm
     /SETNAME                                                        - allows to re-set a real name
     /SILENCE                                                        - FIXME - not gonna do it
+    /STATS                                                          - returns server metrics
     /TIME                                                           - returns server time
     /TOPIC                                                          - Change the channel topic in a mode
     /USER [username] [hostname] [realname]                          - This command is used at the beginning of a connection to specify the username, hostname, real name and initial user modes of the connecting client 
@@ -46,23 +68,70 @@ class Server:
     /USERIP   [nickname]                                            - returns IP of [nickname]
     /USERS                                                          - return info on all of the users on the server
     /VERSION                                                        - returns server info    
-    /WALLOPS [messege]                                              - send messege to all operators
-    /WHO [name]                                                     - return a list of users who match [name]
+    /WALLOPS [messege]                                              - operators only, send messege to all operators
+    /WHO [name | channel]                                           - return a list of users who match [name], * and ? are wildcards
     /WHOIS [nickname]                                               - returns info on nickname masks\n\n
     """.encode('utf8')
 
     WELCOME_MESSAGE = "\n> Welcome to our chat app!!!\n".encode('utf8')
 
-    def __init__(self, host=socket.gethostbyname('localhost'), port=50000, allowReuseAddress=True, timeout=3):
+    def __init__(self, host=socket.gethostbyname('localhost'), port=50000, allowReuseAddress=True, timeout=3, framing='raw', maxMessageLength=Framing.MAX_MESSAGE_LENGTH,
+                 outboundHighWater=OutboundQueue.HIGH_WATERMARK, outboundLowWater=OutboundQueue.LOW_WATERMARK, slowConsumerPolicy=OutboundQueue.DROP_OLDEST,
+                 reusePort=False, serverId=None, listenSocket=None, rateLimits=None,
+                 pingInterval=Keepalive.PING_INTERVAL, pingTimeout=Keepalive.PING_TIMEOUT, compression=True, operPasswords=None):
         self.address = (host, port)
+        self.serverId = (serverId or '{0}:{1}'.format(host, port)).lower() # names this node on the worker bus and server links
+        self.bus = None # WorkerBus.BusClient when running as one of several workers
+        self.remote = WorkerBus.RemoteState() # users and channel members that live in other workers
+        self.loop = None # the asyncio loop in event loop mode
+        self.links = ServerLink.LinkManager(self) # links to other servers made with /connect
+        self.framing = framing # how incoming bytes are split into messages, see Framing.py
+        self.maxMessageLength = maxMessageLength
+        self.outboundHighWater = outboundHighWater # per connection send queue limits, see OutboundQueue.py
+        self.outboundLowWater = outboundLowWater
+        self.slowConsumerPolicy = slowConsumerPolicy
+        self.outboundStats = OutboundQueue.QueueStats()
+        self.socketWriter = None # drains the send queues in threaded mode
         self.channels = {} # Channel Name -> Channel
-        self.users_channels_map = {} # User Name -> Channel Name
+        self.users_channels_map = {} # User -> tuple of Channel Names, the members of a channel are in Channel.users
+        # Client threads, link threads and /kill change memberships concurrently. A change
+        # holds the lock of the user, then the one of the channel; readers never lock,
+        # they get tuples from users_channels_map and snapshots from Channel.users.
+        # A user is in a handful of channels, so a tuple is searched as fast as a set
+        # and takes a fraction of its memory.
+        self.userLocks = UserRegistry.LockStripes()
+        self.channelLocks = UserRegistry.LockStripes() # also guards creating the channel
         self.client_thread_list = [] # A list of all threads that are either running or have finished their task.
-        self.users = [] # A list of all the users who are connected to the server.
+        self.users = UserRegistry.UserRegistry() # All connected users, indexed by username, nickname and socket fd.
+        self.operators = UserRegistry.MemberSet() # the users who passed /oper, /wallops goes to them only
+        self.operPasswords = dict(operPasswords or {}) # operator name -> password for /oper
         self.exit_signal = threading.Event()
+        self.listener = None # asyncio server when running in event loop mode
         self.START_TIME = str(datetime.datetime.today())
         self.SERVER_VERSION = '0.5' # random number
         self.RULES = 'No rules'
+        self.responses = ResponseCache.ResponseCache() # encoded replies of /list, /users, /info, ... and the generations they depend on
+        self.commands = Commands.CommandRegistry() # '/name' -> handler, extend with self.commands.register()
+        self.register_default_commands()
+        self.compressionStats = Compression.CompressionStats() # ratio and CPU cost of compression, for /stats
+        self.metrics = Metrics.ServerMetrics(self) # counters and histograms served by /stats and --metrics-port
+        self.channelLog = None # ChannelLog.ChannelLog with the history of every channel when --log-dir is given
+        self.replayCount = ChannelLog.REPLAY_COUNT # messages shown on /join without a count
+        self.searchIndex = None # SearchIndex.SearchIndex of everything said in the channels when --search or --search-dir is given
+        self.restartCommand = None # argv that starts a new copy of this server for /restart, set by main()
+        self.handover = None # WarmRestart.Handover while /restart passes the connections on
+        self.adopted = [] # connections a restart handed over before they were greeted
+        self.rateLimiter = RateLimit.RateLimiter(rateLimits) # token buckets per connection, command class, channel and source address
+        self.keepalive = Keepalive.Keepalive(self, pingInterval, pingTimeout) # pings silent connections and reaps the dead ones
+        self.userIds = Protocol.Interner() # usernames and channel names behind the ids of the binary protocol
+        self.channelIds = Protocol.Interner()
+        self.deflater = Compression.Deflater(self.compressionStats) if compression else None # for binary connections that asked for deflate
+        if listenSocket is not None:
+            # the listening socket of the server this one replaces, already bound and listening
+            self.serverSocket = listenSocket
+            self.serverSocket.settimeout(timeout)
+            return
+
         try:
             self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         except socket.error as errorMessage:
@@ -74,172 +143,688 @@ class Server:
         if allowReuseAddress:
             self.serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        if reusePort:
+            # several worker processes bind the same port and the kernel spreads the connections over them
+            self.serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         try:
             self.serverSocket.bind(self.address)
         except socket.error as errorMessage:
             sys.stderr.write('Failed to bind to address {0} on port {1}. Error - {2}'.format(self.address[0], self.address[1], errorMessage))
             raise
 
-    def start_listening(self, defaultGreeting="\n> Welcome to our chat app!!! What is your full name?\n"):
-        self.serverSocket.listen(Server.SERVER_CONFIG["MAX_CONNECTIONS"])
+    def start_listening(self, defaultGreeting="\n> Welcome to our chat app!!! What is your full name?\n", backlog=None):
+        if backlog is None:
+            backlog = Server.SERVER_CONFIG["MAX_CONNECTIONS"]
+        self.serverSocket.listen(backlog)
+        self.socketWriter = OutboundQueue.SocketWriter(self.outboundStats)
+        self.socketWriter.start()
+        self.keepalive.start()
+        # sessions handed over by /restart all get their sockets back before any of them processes input
+        resumed = []
+        for user in list(self.users):
+            if hasattr(user, 'resume'):
+                user.socket.setblocking(True)
+                queuedSocket = OutboundQueue.QueuedSocket(user.socket, self.new_outbound_queue(), self.socketWriter)
+                resumed.append((user, self.resume_user(user, queuedSocket)))
+        for user, pendingInput in resumed:
+            self.start_client_thread(user, pendingInput)
+        for clientSocket in self.adopted:
+            self.accept_client(clientSocket)
+        self.adopted = []
 
         try:
             while not self.exit_signal.is_set():
                 try:
-                    print("Waiting for a client to establish a connection\n")
                     clientSocket, clientAddress = self.serverSocket.accept()
+                    if self.handover is not None:
+                        self.handover.accept(clientSocket)
+                        continue
+                    if not self.admit_address(clientAddress[0]):
+                        clientSocket.close()
+                        continue
                     print("Connection established with IP address {0} and port {1}\n".format(clientAddress[0], clientAddress[1]))
-                    user = User.User(clientSocket)
-                    user.status = 'Online'
-                    self.users.append(user)
-                    self.welcome_user(user)
-                    clientThread = threading.Thread(target=self.client_thread, args=(user,))
-                    clientThread.start()
-                    self.client_thread_list.append(clientThread)
+                    self.accept_client(clientSocket)
                 except socket.timeout:
                     pass
+                except OSError:
+                    # the listening socket was closed by /die
+                    if not self.exit_signal.is_set():
+                        raise
         except KeyboardInterrupt:
             self.exit_signal.set()
 
+        for user in self.users:
+            self.send_control(user, '/squit')
+            user.socket.close()
+
         for client in self.client_thread_list:
             if client.is_alive():
                 client.join()
 
+    def accept_client(self, clientSocket):
+        user = self.add_user(OutboundQueue.QueuedSocket(clientSocket, self.new_outbound_queue(), self.socketWriter))
+        self.start_client_thread(user)
+
+    def start_client_thread(self, user, pendingInput=None):
+        clientThread = threading.Thread(target=self.client_thread, args=(user, Framing.RECV_BUFFER_SIZE, pendingInput))
+        clientThread.start()
+        self.client_thread_list.append(clientThread)
+
+    # runs every connection inside a single asyncio event loop instead of a thread per client
+    def start_event_loop(self, backlog=None):
+        if backlog is None:
+            backlog = Server.SERVER_CONFIG["BACKLOG"]
+        ChatEventLoop.run(self, backlog)
+
+    def new_outbound_queue(self, threadSafe=True):
+        return OutboundQueue.OutboundQueue(self.outboundHighWater, self.outboundLowWater, self.slowConsumerPolicy, self.outboundStats, threadSafe)
+
+    def add_user(self, clientSocket):
+        self.metrics.accepts.inc()
+        user = UserRegistry.ConnectedUser(clientSocket)
+        user.status = 'Online'
+        user.registered = False # set once the user picked a username
+        user.channel = None # channel that chat lines go to, the one joined last
+        user.decoder = Framing.create_decoder(self.framing, self.maxMessageLength)
+        user.session = None # Protocol.Session once the connection switched to the binary protocol
+        user.limits = self.rateLimiter.for_connection()
+        self.keepalive.watch(user)
+        self.users.add(user)
+        self.responses.bump('users')
+        self.welcome_user(user)
+        return user
+
+    # a session handed over by /restart: sends what the old server could not send any more and
+    # returns the input it had not processed yet
+    def resume_user(self, user, wrappedSocket):
+        if user.session is not None:
+            user.socket = Protocol.FramedSocket(wrappedSocket, self.deflater if user.session.compress else None)
+        else:
+            user.socket = wrappedSocket
+        output, pendingInput = user.resume
+        del user.resume
+        if output:
+            wrappedSocket.sendall(output) # already framed
+        return pendingInput
+
     def welcome_user(self, user):
         user.socket.sendall(Server.WELCOME_MESSAGE)
 
-    def client_thread(self, user, size=4096):
-       # username = Util.generate_username(user.socket.recv(size).decode('utf8')).lower()
-        username = None
+    def greet_user(self, user):
+        user.socket.sendall("\n> Press SEND\n".encode('utf8'))
 
-        while not username:
-            user.socket.sendall("\n> Press SEND\n".encode('utf8'))
-            username = user.socket.recv(size).decode('utf8').lower()
-            print('+' + username + '+')
-            if username == "enter message.":
-                user.socket.sendall("\n> Please enter the username you wish to use\n".encode('utf8'))
-                username = user.socket.recv(size).decode('utf8').lower()
-            if username in self.users:
-                user.socket.sendall("\n> The username provided already exists, please choose a different username\n".encode('utf8'))
-                username = None
+    # returns True once the user has picked a valid username
+    def register_username(self, user, username):
+        if username == "enter message.":
+            user.socket.sendall("\n> Please enter the username you wish to use\n".encode('utf8'))
+            return False
+        if not username:
+            self.greet_user(user)
+            return False
+        if self.remote.name_taken(username) or not self.users.rename_username(user, username):
+            user.socket.sendall("\n> The username provided already exists, please choose a different username\n".encode('utf8'))
+            self.greet_user(user)
+            return False
 
-
-        user.username = username
+        user.signon = time.time()
+        self.responses.bump('users')
+        self.publish({'type': 'user_online', 'username': user.username, 'nickname': user.nickname, 'signon': user.signon})
 
         welcomeMessage = '\n> Welcome {0}, type /help for a list of helpful commands.\n\n'.format(user.username).encode('utf8')
         user.socket.sendall(welcomeMessage)
+        return True
 
-        while True:
-            chatMessage = user.socket.recv(size).decode('utf8').lower()
+    # pendingInput is the unprocessed input of a session resumed after /restart, None for a new connection
+    def client_thread(self, user, size=Framing.RECV_BUFFER_SIZE, pendingInput=None):
+       # username = Util.generate_username(user.socket.recv(size).decode('utf8')).lower()
+        if pendingInput is None:
+            self.greet_user(user)
+        # one recv can carry many messages, but an idle connection does not need 64 KiB
+        # waiting for them: the buffer starts small and grows once a read fills it
+        buffer = bytearray(min(size, Framing.IDLE_RECV_BUFFER_SIZE))
+        view = memoryview(buffer)
 
-            if self.exit_signal.is_set():
+        connected = not pendingInput or self.receive(user, pendingInput)
+        while connected:
+            try:
+                received = user.socket.recv_into(buffer)
+            except OSError:
+                # the connection was reset or dropped by its send queue
                 break
 
-            if not chatMessage:
+            if self.exit_signal.is_set():
                 break
 
-            if '/quit' in chatMessage:
-                self.quit(user)
+            if not received:
                 break
-            elif '/list' in chatMessage:
-                self.list_all_channels(user)
-            elif '/help' in chatMessage:
-                self.help(user)
-            elif '/join' in chatMessage:
-                self.join(user, chatMessage)
-            # solution commands
-            elif '/die' in chatMessage:  # DONE
-                self.server_shutdown()
-            elif '/info' in chatMessage:  # DONE
-                # returns info about server
-                self.serv_info(user)
-            elif '/time' in chatMessage:
-                # give server time
-                message = ("Server time = " + str(datetime.datetime.today()) + "\n").encode('utf8')
-                user.socket.sendall(message)
-            elif '/kill' in chatMessage:
-                # use a given method
-                user.socket.sendall(self.kill_usr(chatMessage).encode('utf8'))
-            elif '/ison' in chatMessage:
-                # check if user is online
-                user.socket.sendall(self.is_on(chatMessage).encode('utf8'))
-            elif '/mode' in chatMessage:
-                # will simplify and only allow /mode to change the mode of the channel
-                user.socket.sendall(self.mode_ch(chatMessage).encode('utf8'))
-            elif '/nick' in chatMessage:
-                # change the nickname of the user
-                user.socket.sendall(self.nick_change(user, chatMessage).encode('utf8'))
-            elif '/pass' in chatMessage:
-                user.socket.sendall(self.pass_change(user, chatMessage).encode('utf8'))
-            elif '/version' in chatMessage:
-                # send the server version info
-                user.socket.sendall(self.SERVER_VERSION.encode('utf8'))
-            elif '/topic' in chatMessage:
-                user.socket.sendall(self.topic_set(chatMessage).encode('utf8'))
-            elif '/rules' in chatMessage:
-                user.socket.sendall(self.RULES.encode('utf8'))
-            elif '/setname' in chatMessage:
-                # change user's username
-                user.socket.sendall(self.setname(user, chatMessage).encode('utf8'))
-            elif '/users' in chatMessage:
-                # show all users on the server
-                user.socket.sendall(self.users_all().encode('utf8'))
-            elif '/ping' in chatMessage:
-                user.socket.sendall('/pong'.encode('utf8'))
-            else:
-                self.send_message(user, chatMessage + '\n')
+
+            data = view[:received]
+            if self.handover is not None:
+                # /restart is handing the connection over, hold() only returns if that failed
+                data = self.handover.hold(user, data)
+            connected = self.receive(user, data)
+            if received == len(buffer) and received < size:
+                buffer = bytearray(size)
+                view = memoryview(buffer)
 
         if self.exit_signal.is_set():
-            user.socket.sendall('/squit'.encode('utf8'))
+            self.send_control(user, '/squit')
 
+        if user in self.users:
+            self.remove_user(user)
         user.socket.close()
 
+    # feeds bytes read from the connection through its decoder, returns False when the connection should be closed
+    def receive(self, user, data):
+        self.metrics.bytesIn.inc(len(data))
+        user.keepalive.lastActivity = time.monotonic()
+        if not self.process_messages(user, user.decoder.feed(data)):
+            return False
+
+        if user.decoder.dropped:
+            user.socket.sendall("\n> {0} message(s) longer than {1} bytes were dropped\n".format(user.decoder.dropped, self.maxMessageLength).encode('utf8'))
+            user.decoder.dropped = 0
+        return True
+
+    # runs decoded messages through the rate limits and handles them, returns False when the connection should be closed
+    def process_messages(self, user, messages):
+        for chatMessage in messages:
+            chatMessage = chatMessage.lower()
+
+            action, delay = self.rateLimiter.check(user.limits, chatMessage)
+            if action is not RateLimit.ADMIT:
+                self.metrics.rateLimited.inc(label=action)
+                if action == RateLimit.DISCONNECT:
+                    user.socket.sendall("\n> Disconnected for flooding\n".encode('utf8'))
+                    return False
+                if action == RateLimit.DROP:
+                    if not user.limits.warned:
+                        user.limits.warned = True
+                        user.socket.sendall("\n> You are sending too fast, your messages are dropped\n".encode('utf8'))
+                    continue
+                if self.loop is not None:
+                    self.defer(user, delay, chatMessage, messages)
+                    return True
+                user.limits.deferred = chatMessage # handed over if /restart comes in the meantime
+                time.sleep(delay) # on the client thread, nothing is read from the connection meanwhile
+                if self.handover is not None:
+                    self.handover.resumed.wait() # only returns if the restart failed
+                user.limits.deferred = None
+
+            if not user.registered:
+                if chatMessage.startswith(Protocol.NEGOTIATE):
+                    rest = user.decoder.pending() # what the client sent after its offer is framed already
+                    if self.negotiate(user, chatMessage.strip()):
+                        return self.process_messages(user, user.decoder.feed(rest))
+                    continue
+                user.registered = self.register_username(user, chatMessage)
+            elif self.exit_signal.is_set() or not self.handle_message(user, chatMessage):
+                return False
+        return True
+
+    # '/protocol binary 1 [deflate]' before the username switches the connection to the frames of Protocol.py
+    def negotiate(self, user, offer):
+        if user.session is not None:
+            return False
+        options = Protocol.parse_offer(offer)
+        if options is None:
+            user.socket.sendall((Protocol.REFUSAL + '\n').encode('utf8'))
+            return False
+        compress = Protocol.DEFLATE in options and self.deflater is not None
+        user.socket.sendall((Protocol.make_offer([Protocol.DEFLATE] if compress else []) + '\n').encode('utf8'))
+        user.session = Protocol.Session(compress=compress)
+        user.socket = Protocol.FramedSocket(user.socket, self.deflater if compress else None)
+        user.decoder = Protocol.FrameDecoder(self.maxMessageLength)
+        return True
+
+    # /ping, /pong, /quit and /squit, a line of its own in text mode (see ClientEvents.split), a CONTROL frame in binary mode
+    def send_control(self, user, name):
+        if user.session is None:
+            user.socket.sendall((name + '\n').encode('utf8'))
+        else:
+            user.socket.send_frame(Protocol.encode_frame(Protocol.CONTROL, 0, 0, name.encode('utf8')))
+
+    # asyncio mode: the message and the rest of its read wait for the delay, and nothing more is read meanwhile
+    def defer(self, user, delay, chatMessage, messages):
+        user.limits.deferred = chatMessage
+        user.socket.transport.pause_reading()
+        self.loop.call_later(delay, self.resume_deferred, user, messages)
+
+    def resume_deferred(self, user, messages):
+        transport = user.socket.transport
+        if transport.is_closing():
+            return
+        if self.handover is not None:
+            # /restart hands the deferred message over, or carries on with it if the restart fails
+            self.loop.call_later(RateLimit.MAX_DELAY, self.resume_deferred, user, messages)
+            return
+        chatMessage, user.limits.deferred = user.limits.deferred, None
+        if not self.process_messages(user, itertools.chain((chatMessage,), messages)):
+            user.socket.close()
+        elif user.limits.deferred is None:
+            transport.resume_reading()
+
+    # new connections per source address, checked before anything is allocated for them
+    def admit_address(self, address):
+        if self.rateLimiter.admit_address(address):
+            return True
+        self.metrics.rateLimited.inc(label='accept')
+        return False
+
+    # processes one chat line, returns False when the connection should be closed
+    def handle_message(self, user, chatMessage):
+        with self.metrics.dispatch.time():
+            return self.dispatch(user, chatMessage)
+
+    def dispatch(self, user, chatMessage):
+        parsedCommand = Commands.parse(chatMessage)
+
+        if parsedCommand is None:
+            self.metrics.messages.inc(label='chat')
+            self.send_message(user, chatMessage + '\n')
+            return True
+
+        command = self.commands.lookup(parsedCommand.name)
+        self.metrics.messages.inc(label=parsedCommand.name if command is not None else 'unknown')
+        if command is None:
+            user.socket.sendall("\n> Unknown command {0}, type /help for a list of helpful commands.\n".format(parsedCommand.name).encode('utf8'))
+            return True
+
+        try:
+            return command(self, user, parsedCommand) is not False
+        except OSError:
+            raise
+        except Exception:
+            # a broken handler costs the command, not the session
+            sys.stderr.write('Command {0} failed:\n{1}'.format(parsedCommand.name, traceback.format_exc()))
+            user.socket.sendall('\n> Error, command {0} failed\n'.format(parsedCommand.name).encode('utf8'))
+            return True
+
+    def register_default_commands(self):
+        commands = self.commands
+        commands.register('/quit', lambda server, user, command: server.quit(user))
+        commands.register('/list', lambda server, user, command: server.list_all_channels(user, ResponseCache.page_number(command)))
+        commands.register('/help', lambda server, user, command: server.help(user))
+        commands.register('/join', lambda server, user, command: server.join(user, command))
+        commands.register('/part', user_reply(Server.part))
+        commands.register('/who', lambda server, user, command: server.who(user, command))
+        commands.register('/whois', user_reply(Server.whois))
+        commands.register('/invite', user_reply(Server.invite))
+        commands.register('/privmsg', lambda server, user, command: server.private_message(user, command))
+        commands.register('/notice', lambda server, user, command: server.private_message(user, command, notice=True))
+        commands.register('/wallops', lambda server, user, command: server.wallops(user, command))
+        commands.register('/oper', user_reply(Server.oper))
+        commands.register('/search', user_reply(Server.search))
+        # solution commands
+        commands.register('/die', operator_only(lambda server, user, command: server.server_shutdown()))
+        commands.register('/info', lambda server, user, command: server.serv_info(user))
+        commands.register('/time', lambda server, user, command: server.server_time(user))
+        commands.register('/kill', operator_only(text_reply(Server.kill_usr)))
+        commands.register('/ison', text_reply(Server.is_on))
+        # will simplify and only allow /mode to change the mode of the channel
+        commands.register('/mode', user_reply(Server.mode_ch))
+        commands.register('/nick', user_reply(Server.nick_change))
+        commands.register('/pass', user_reply(Server.pass_change))
+        commands.register('/version', lambda server, user, command: user.socket.sendall(server.cached_text('version', server.SERVER_VERSION)))
+        commands.register('/topic', text_reply(Server.topic_set))
+        commands.register('/rules', lambda server, user, command: user.socket.sendall(server.cached_text('rules', server.RULES)))
+        commands.register('/setname', user_reply(Server.set_name))
+        commands.register('/users', lambda server, user, command: server.list_users(user, ResponseCache.page_number(command)))
+        commands.register('/connect', operator_only(text_reply(Server.connect_server)))
+        commands.register('/stats', lambda server, user, command: user.socket.sendall(server.metrics.render().encode('utf8')))
+        commands.register('/restart', operator_only(lambda server, user, command: server.restart(user)))
+        commands.register('/ping', lambda server, user, command: server.send_control(user, '/pong'))
+        commands.register('/pong', lambda server, user, command: None) # answer to a keepalive /ping, the input itself counts
+
+    # hands every connection to a new copy of this server and exits, see WarmRestart.py
+    def restart(self, user):
+        if self.restartCommand is None:
+            user.socket.sendall("\nError, /restart is not available in --workers mode\n".encode('utf8'))
+            return
+        if self.handover is not None:
+            return
+        user.socket.sendall("\n> Restarting the server, you stay connected\n".encode('utf8'))
+        self.handover = WarmRestart.Handover(self, self.restartCommand)
+        if self.loop is not None:
+            self.loop.create_task(self.handover.run_async())
+        else:
+            self.handover.run()
+
     def quit(self, user):
-        user.socket.sendall('/quit'.encode('utf8'))
+        self.send_control(user, '/quit')
         self.remove_user(user)
+        return False
 
-    def list_all_channels(self, user):
-        if len(self.channels) == 0:
-            chatMessage = "\n> No rooms available. Create your own by typing /join [channel_name]\n".encode('utf8')
-            user.socket.sendall(chatMessage)
-        else:
-            chatMessage = '\n\n> Current channels available are: \n'
-            for channel in self.channels:
-                chatMessage += "    \n" + channel + ": " + str(len(self.channels[channel].users)) + " user(s)"
-            chatMessage += "\n"
-            user.socket.sendall(chatMessage.encode('utf8'))
+    def list_all_channels(self, user, page=1):
+        pages = self.responses.get('list', ('channels', 'remote'), self.build_channel_list)
+        user.socket.sendall(ResponseCache.select_page(pages, page))
+
+    def build_channel_list(self):
+        counts = self.remote.channel_counts()
+        for channel in list(self.channels):
+            counts[channel] = counts.get(channel, 0) + len(self.channels[channel].users)
+
+        if len(counts) == 0:
+            return ["\n> No rooms available. Create your own by typing /join [channel_name]\n".encode('utf8')]
+        entries = ["    \n" + channel + ": " + str(counts[channel]) + " user(s)" for channel in counts]
+        return ResponseCache.paginate('\n\n> Current channels available are: \n', entries, '/list')
+
+    # replies that only change with the server configuration
+    def cached_text(self, key, text):
+        return self.responses.get((key, text), (), lambda: text.encode('utf8'))
 
     def help(self, user):
         user.socket.sendall(Server.HELP_MESSAGE)
 
-    def join(self, user, chatMessage):
-        isInSameRoom = False
+    def join(self, user, command):
+        if not command.args:
+            self.help(user)
+            return
+        channelName = command.args[0]
+
+        channel = self.channels.get(channelName)
+        if channel is not None and self.is_invite_only(channel) and user not in channel.users and user.username not in channel.invited:
+            user.socket.sendall("\n> {0} is invite only, a member has to /invite you first\n".format(channelName).encode('utf8'))
+            return
+
+        channel = self.get_channel(channelName, user)
+        isInSameRoom = not self.add_membership(user, channel)
+        user.channel = channelName # switching to a channel you are in just makes it the current one
+        if isInSameRoom:
+            user.socket.sendall("\n> You are already in channel: {0}".format(channelName).encode('utf8'))
+        else:
+            channel.invited.discard(user.username)
+            with self.channelLocks(channelName):
+                # the notices of a join and a part in the same channel can not overtake each other
+                channel.welcome_user(user.username)
+                self.announce(channel, Protocol.JOIN, user, exclude=user)
+            self.send_members(user, channel)
+            self.responses.bump('channels')
+            self.publish({'type': 'join', 'username': user.username, 'channel': channelName})
+
+        self.replay_history(user, channelName, command.args[1:], isInSameRoom)
+
+    # creator: the user whose /join makes the channel, it may change the channel's mode
+    def get_channel(self, channelName, creator=None):
+        channel = self.channels.get(channelName)
+        if channel is None:
+            with self.channelLocks(channelName):
+                channel = self.channels.get(channelName)
+                if channel is None:
+                    channelName = sys.intern(channelName) # every membership and log entry shares the one string
+                    channel = Channel.Channel(channelName)
+                    channel.users = UserRegistry.MemberSet() # O(1) membership tests and removals
+                    channel.invited = set() # usernames that may join while the channel is invite only
+                    channel.modes = set() # mode letters set with /mode, channel.mode shows them as '+i'
+                    channel.framed = UserRegistry.MemberSet() # the members in binary mode, they get typed frames
+                    channel.creator = creator # the user object, a rename does not hand it to someone else
+                    self.channels[channelName] = channel
+        return channel
+
+    def is_invite_only(self, channel):
+        return 'i' in channel.modes
+
+    # both directions of the membership index, returns False if the user already was a member
+    # or was removed from the server meanwhile
+    def add_membership(self, user, channel):
+        with self.userLocks(user):
+            channels = self.users_channels_map.get(user, ())
+            if channel.channel_name in channels or user not in self.users:
+                return False
+            self.users_channels_map[user] = channels + (channel.channel_name,)
+            with self.channelLocks(channel.channel_name):
+                channel.users.append(user)
+                if user.session is not None:
+                    channel.framed.append(user)
+        return True
+
+    # returns False if the user was not a member, the other members are told about the user leaving
+    def remove_membership(self, user, channelName):
+        with self.userLocks(user):
+            channels = self.users_channels_map.get(user)
+            if not channels or channelName not in channels:
+                return False
+            channels = tuple(name for name in channels if name != channelName)
+            if channels:
+                self.users_channels_map[user] = channels
+            else:
+                del self.users_channels_map[user]
+            self.leave_channel(user, self.channels[channelName])
+            if user.channel == channelName:
+                user.channel = next(iter(channels), None)
+        if user.session is not None:
+            self.send_typed(user, *self.typed_frame(Protocol.PART, self.channels[channelName], user.username))
+        return True
+
+    def leave_channel(self, user, channel):
+        with self.channelLocks(channel.channel_name):
+            if user not in channel.users:
+                return
+            channel.remove_user_from_channel(user)
+            channel.framed.discard(user)
+            self.announce(channel, Protocol.PART, user)
+
+    # binary protocol: (frame, channel id, sender id) about a user in channel
+    def typed_frame(self, kind, channel, username, payload=b''):
+        channelId = self.channelIds.intern(channel.channel_name)
+        senderId = self.userIds.intern(username)
+        return Protocol.encode_frame(kind, channelId, senderId, payload), channelId, senderId
 
-        if len(chatMessage.split()) >= 2:
-            channelName = chatMessage.split()[1]
+    # JOIN or PART to the members in binary mode, the others learn it from the notices of Channel
+    def announce(self, channel, kind, user, exclude=None):
+        if len(channel.framed):
+            typed = self.typed_frame(kind, channel, user.username)
+            for member in channel.framed:
+                if member is not exclude:
+                    self.send_typed(member, *typed)
 
-            if user.username in self.users_channels_map: # Here we are switching to a new channel.
-                if self.users_channels_map[user.username] == channelName:
-                    user.socket.sendall("\n> You are already in channel: {0}".format(channelName).encode('utf8'))
-                    isInSameRoom = True
-                else: # switch to a new channel
-                    oldChannelName = self.users_channels_map[user.username]
-                    self.channels[oldChannelName].remove_user_from_channel(user) # remove them from the previous channel
+    def send_typed(self, user, frame, channelId=0, senderId=0):
+        self.introduce(user, channelId, senderId)
+        user.socket.send_frame(frame)
 
-            if not isInSameRoom:
-                if not channelName in self.channels:
-                    newChannel = Channel.Channel(channelName)
-                    self.channels[channelName] = newChannel
+    # sends the CHANNEL and NAME frames for the ids a connection has not seen yet
+    def introduce(self, user, channelId=0, senderId=0):
+        session = user.session
+        # an id counts as known once its frame is queued, so no other thread can send a frame that uses it first
+        if channelId and channelId not in session.channels:
+            user.socket.send_frame(Protocol.encode_frame(Protocol.CHANNEL, channelId, 0, self.channelIds.name(channelId).encode('utf8')))
+            session.channels.add(channelId)
+        if senderId and senderId not in session.names:
+            user.socket.send_frame(Protocol.encode_frame(Protocol.NAME, 0, senderId, self.userIds.name(senderId).encode('utf8')))
+            session.names.add(senderId)
 
-                self.channels[channelName].users.append(user)
-                self.channels[channelName].welcome_user(user.username)
-                self.users_channels_map[user.username] = channelName
+    def send_members(self, user, channel):
+        if user.session is None:
+            return
+        memberIds = []
+        for member in channel.users:
+            memberId = self.userIds.intern(member.username)
+            self.introduce(user, 0, memberId)
+            memberIds.append(memberId)
+        channelId = self.channelIds.intern(channel.channel_name)
+        payload = b''.join(Protocol.MEMBER.pack(memberId) for memberId in memberIds)
+        frame = Protocol.encode_frame(Protocol.MEMBERS, channelId, 0, payload)
+        if user.session.compress:
+            frame = Protocol.compress_frame(frame, self.deflater)
+        self.send_typed(user, frame, channelId)
+
+    def part(self, user, command):
+        if len(command.args) > 1:
+            return 'Error, input is incorrect: /part [channel]\n'
+        channelName = command.args[0] if command.args else user.channel
+        if channelName is None:
+            return 'Error, you are not in any channel\n'
+        if not self.remove_membership(user, channelName):
+            return 'Error, you are not in channel ' + channelName + '\n'
+        self.responses.bump('channels')
+        self.publish({'type': 'part', 'username': user.username, 'channel': channelName})
+        if user.channel is not None:
+            return 'You have left the channel ' + channelName + ', your messages go to ' + user.channel + ' now\n'
+        return 'You have left the channel ' + channelName + '\n'
+
+    # '/who' lists everyone, '/who [channel]' the members of a channel, '/who [mask]' the users whose
+    # username or nickname matches; a name without wildcards is looked up in the index
+    def who(self, user, command):
+        if len(command.args) > 1:
+            user.socket.sendall("\nError, input is incorrect: /who [name | channel]\n".encode('utf8'))
+            return
+        mask = command.args[0] if command.args else '*'
+
+        entries = []
+        remoteMembers = self.remote.channel_members(mask)
+        if mask in self.channels or remoteMembers:
+            channel = self.channels.get(mask)
+            for member in (channel.users if channel is not None else ()):
+                entries.append(self.who_entry(member.username, member.nickname, member.status))
+            for origin, username, nickname, signon in remoteMembers:
+                entries.append(self.who_entry(username, nickname, 'Online on ' + origin))
+        elif not UserRegistry.is_mask(mask):
+            target, record = self.find_user(mask)
+            if target is not None:
+                entries.append(self.who_entry(target.username, target.nickname, target.status))
+            elif record is not None:
+                entries.append(self.who_entry(record[1], record[2], 'Online on ' + record[0]))
         else:
-            self.help(user.socket)
+            match = UserRegistry.mask_pattern(mask).match
+            for member in self.users:
+                if member.registered and (match(member.username) or (member.nickname and match(member.nickname))):
+                    entries.append(self.who_entry(member.username, member.nickname, member.status))
+            for origin, username, nickname, signon in self.remote.user_records():
+                if match(username) or (nickname and match(nickname)):
+                    entries.append(self.who_entry(username, nickname, 'Online on ' + origin))
+
+        header = "\n> {0} user(s) matching {1}:\n".format(len(entries), mask)
+        user.socket.sendall((header + ''.join(entries) + "> End of /who\n").encode('utf8'))
+
+    # (registered local user, None) or (None, remote record) for a name, (None, None) if nobody has it.
+    # Usernames are looked up before nicknames, a nickname can not shadow the user who has the same username
+    def find_user(self, name):
+        target = self.users.get_by_username(name)
+        if target is not None and target.registered:
+            return target, None
+        record = self.remote.get_user(name)
+        if record is not None:
+            return None, record
+        target = self.users.get_by_nickname(name)
+        if target is not None and target.registered:
+            return target, None
+        return None, self.remote.get_by_nickname(name)
+
+    def who_entry(self, username, nickname, status):
+        return "    {0} ({1}) - {2}\n".format(username, nickname or 'no nickname', status)
+
+    def whois(self, user, command):
+        if len(command.args) != 1:
+            return 'Error, input is incorrect: /whois [nickname]\n'
+        name = command.args[0]
+        target, record = self.find_user(name)
+        if target is not None:
+            idle = int(time.monotonic() - target.keepalive.lastActivity)
+            channels = ' '.join(sorted(self.users_channels_map.get(target, ()))) or 'none'
+            return ''.join(('\n> ', target.username, ' (', target.nickname or 'no nickname', ')\nReal name = ', target.realname, '\nStatus = ', target.status,
+                            '\nChannels = ', channels, '\nSigned on = ', time.ctime(target.signon), ', idle ', str(idle), ' second(s)\nServer = ', self.serverId, '\n'))
+        if record is not None:
+            origin, username, nickname, signon = record
+            channels = ' '.join(self.remote.channels_of(username)) or 'none'
+            return ''.join(('\n> ', username, ' (', nickname or 'no nickname', ')\nChannels = ', channels, '\nSigned on = ', time.ctime(signon),
+                            '\nServer = ', origin, '\n'))
+        return 'User ' + name + ' not found\n'
+
+    # members can invite others into their channels, an invitation lets the user in while the channel is invite only (/mode +i)
+    def invite(self, user, command):
+        if len(command.args) != 2:
+            return 'Error, input is incorrect: /invite [nickname] [channel]\n'
+        name, channelName = command.args
+        channel = self.channels.get(channelName)
+        if channel is None or user not in channel.users:
+            return 'Error, you are not in channel ' + channelName + '\n'
+        target, record = self.find_user(name)
+        if target is not None:
+            if target in channel.users:
+                return target.username + ' is already in channel ' + channelName + '\n'
+            self.deliver_invite(target, user.username, channel)
+            return 'Invited ' + target.username + ' to ' + channelName + '\n'
+        if record is None:
+            return 'User ' + name + ' not found\n'
+        self.publish({'type': 'invite', 'username': record[1], 'channel': channelName, 'by': user.username})
+        return 'Invited ' + record[1] + ' to ' + channelName + '\n'
+
+    def deliver_invite(self, target, inviter, channel):
+        channel.invited.add(target.username)
+        target.socket.sendall("\n> {0} invites you to {1}, type /join {1}\n".format(inviter, channel.channel_name).encode('utf8'))
+
+    # sends the last messages of a channel, '/join [channel] 50' or '/join [channel] since 14:30' (or a unix time)
+    def replay_history(self, user, channelName, options, explicitOnly=False):
+        if self.channelLog is None or (explicitOnly and not options):
+            return
+        last, since = self.replayCount, None
+        if len(options) == 1 and options[0].isdecimal():
+            last = int(options[0])
+        elif len(options) == 2 and options[0] == 'since':
+            since = ChannelLog.parse_time(options[1])
+            if since is None:
+                user.socket.sendall("\nError, input is incorrect: /join [channel] since [hh:mm | unix time]\n".encode('utf8'))
+                return
+        elif options:
+            user.socket.sendall("\nError, input is incorrect: /join [channel] [count | since hh:mm]\n".encode('utf8'))
+            return
+        if since is None and last <= 0:
+            return
+
+        last = min(last, ChannelLog.MAX_REPLAY_COUNT) if since is None else None
+        records = self.channelLog.replay(channelName, last=last, since=since)[-ChannelLog.MAX_REPLAY_COUNT:]
+        if records:
+            header = "\n> Last {0} message(s) in {1}:\n".format(len(records), channelName).encode('utf8')
+            user.socket.sendall(header + b''.join(payload for sequence, timestamp, payload in records) + b"> End of history\n")
+
+    # members, operators and everybody for channels that are not invite only
+    def can_read(self, user, channelName):
+        channel = self.channels.get(channelName)
+        return channel is None or not self.is_invite_only(channel) or user in channel.users or user.usertype == 'operator'
+
+    # '/search [channel | *] [query]', see SearchIndex.parse_query for what a query can hold
+    def search(self, user, command):
+        if self.searchIndex is None:
+            return 'Error, search is not enabled on this server\n'
+        if not command.args:
+            return 'Error, input is incorrect: /search [channel | *] [words] ["phrase"] [from:user] [since:hh:mm] [until:hh:mm]\n'
+        channelName = command.args[0]
+        if channelName != '*' and not self.can_read(user, channelName):
+            return 'Error, you are not in channel ' + channelName + '\n'
+        try:
+            query = SearchIndex.parse_query(command.rest(1), None if channelName == '*' else channelName)
+        except ValueError as error:
+            return 'Error, input is incorrect: {0}\n'.format(error)
+
+        with self.metrics.search.time():
+            results = self.searchIndex.search(query, SearchIndex.RESULT_LIMIT, lambda name: self.can_read(user, name))
+        if not results:
+            return '\n> No messages found\n'
+        lines = ['\n> {0} message(s) found, newest first:\n'.format(len(results))]
+        for timestamp, resultChannel, author, message in results:
+            lines.append('[{0}] {1} {2}: {3}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)), resultChannel, author, message))
+        lines.append('> End of search results\n')
+        return ''.join(lines)
 
     def send_message(self, user, chatMessage):
-        if user.username in self.users_channels_map:
-            self.channels[self.users_channels_map[user.username]].broadcast_message(chatMessage, "{0}: ".format(user.username))
+        channelName = user.channel # read once, a /kill from another thread may reset it
+        if channelName is not None:
+            channel = self.channels[channelName]
+            if not self.rateLimiter.admit_channel(channel.channel_name):
+                self.metrics.rateLimited.inc(label='channel')
+                user.socket.sendall("\n> {0} is too busy right now, your message was not sent\n".format(channel.channel_name).encode('utf8'))
+                return
+            payload = "{0}: {1}".format(user.username, chatMessage)
+            encoded = payload.encode('utf8')
+            text = chatMessage.rstrip('\n')
+            typed = self.typed_frame(Protocol.CHAT, channel, user.username, text.encode('utf8')) if len(channel.framed) else None
+            self.broadcast(channel, encoded, typed=typed)
+            if self.channelLog is not None:
+                self.channelLog.append(channel.channel_name, encoded)
+            if self.searchIndex is not None:
+                self.searchIndex.add(channel.channel_name, user.username, text)
+            self.publish({'type': 'message', 'channel': channel.channel_name, 'payload': payload, 'username': user.username, 'text': text})
         else:
             chatMessage = """\n> You are currently not in any channels:
 
@@ -248,150 +833,508 @@ Use /join [channel name] to join a channel.\n\n""".encode('utf8')
 
             user.socket.sendall(chatMessage)
 
+    def broadcast(self, channel, payload, exclude=None, typed=None):
+        with self.metrics.broadcast.time():
+            self.deliver(channel.users, payload, exclude, typed)
+
+    # hands the same encoded payload to every member's send queue, nothing is formatted or copied per member;
+    # typed is the (frame, channel id, sender id) for members in binary mode, they get payload as TEXT without it.
+    # The frame is made and compressed at most once, whatever the number of members.
+    def deliver(self, members, payload, exclude=None, typed=None):
+        frame, channelId, senderId = typed if typed is not None else (None, 0, 0)
+        frames = [None, None] # for members in binary mode without and with compression
+        for member in members:
+            if member is exclude:
+                continue
+            session = member.session
+            if session is None:
+                member.socket.sendall(payload)
+                continue
+            framed = frames[session.compress]
+            if framed is None:
+                framed = frame if frame is not None else Protocol.text_frame(payload)
+                if session.compress:
+                    framed = Protocol.compress_frame(framed, self.deflater)
+                frames[session.compress] = framed
+            self.send_typed(member, framed, channelId, senderId)
+
+    # '/privmsg [target,...] [message]': targets are looked up by nickname, then by username, and the
+    # message is written straight to their connections in one delivery; the users of other workers and
+    # linked servers get it through a single event. A /notice gets no reply at all, not even an error.
+    def private_message(self, user, command, notice=False):
+        if len(command.args) < 2:
+            if not notice:
+                user.socket.sendall("\nError, input is incorrect: /privmsg [target,...] [message]\n".encode('utf8'))
+            return
+        message = command.rest(1).rstrip('\n')
+        local, remote, missing = [], [], []
+        for name in dict.fromkeys(command.args[0].split(',')):
+            target, record = self.find_user(name)
+            if target is not None:
+                local.append(target)
+            elif record is not None:
+                remote.append(record[1])
+            elif name:
+                missing.append(name)
+
+        self.deliver_private(user.username, local, message, notice)
+        if remote:
+            self.publish({'type': 'privmsg', 'from': user.username, 'targets': remote, 'text': message, 'notice': notice})
+        if notice:
+            return
+        reply = ''
+        if local or remote:
+            reply = "-> *{0}* {1}\n".format(','.join([target.username for target in local] + remote), message)
+        if missing:
+            reply += "Error, no such user: {0}\n".format(', '.join(missing))
+        user.socket.sendall(reply.encode('utf8'))
+
+    def deliver_private(self, sender, targets, text, notice=False):
+        if not targets:
+            return
+        payload = ("-{0}- {1}\n" if notice else "*{0}* {1}\n").format(sender, text).encode('utf8')
+        typed = None
+        for target in targets:
+            if target.session is not None:
+                senderId = self.userIds.intern(sender)
+                typed = (Protocol.encode_frame(Protocol.NOTICE if notice else Protocol.CHAT, 0, senderId, text.encode('utf8')), 0, senderId)
+                break
+        self.deliver(targets, payload, typed=typed)
+
+    def wallops(self, user, command):
+        if user not in self.operators:
+            user.socket.sendall("\nError, only operators can send /wallops, see /oper\n".encode('utf8'))
+            return
+        if not command.args:
+            user.socket.sendall("\nError, input is incorrect: /wallops [message]\n".encode('utf8'))
+            return
+        message = command.rest().rstrip('\n')
+        self.deliver_wallops(user.username, message)
+        self.publish({'type': 'wallops', 'from': user.username, 'text': message})
+
+    def deliver_wallops(self, sender, text):
+        if len(self.operators):
+            self.deliver(self.operators, "!{0}! {1}\n".format(sender, text).encode('utf8'))
+
+    def oper(self, user, command):
+        if len(command.args) != 2:
+            return 'Error, input is incorrect: /oper [username] [password]\n'
+        name, given = command.args
+        password = self.operPasswords.get(name)
+        if password is None or not hmac.compare_digest(password.encode('utf8'), given.encode('utf8')):
+            return 'Error, wrong operator name or password\n'
+        with self.userLocks(user):
+            if user not in self.users:
+                return ''
+            user.usertype = 'operator'
+            self.operators.append(user)
+        self.responses.bump('users')
+        return 'You are now an operator\n'
+
     # my methods
     # send server infop to cient
     def serv_info(self, user):
+        user.socket.sendall(self.responses.get('info', ('links',), self.build_info))
 
-        message = ("Server version = " + self.SERVER_VERSION + "\nServer start time = " + self.START_TIME + "\n").encode('utf8')
-        # self.send_message(user, message)
+    def build_info(self):
+        return ("Server version = " + self.SERVER_VERSION + "\nServer start time = " + self.START_TIME + "\n" +
+                "Server name = " + self.serverId + "\nLinked servers = " + ' '.join(self.links.linked_servers()) + "\n").encode('utf8')
+
+    # give server time
+    def server_time(self, user):
+        message = ("Server time = " + str(datetime.datetime.today()) + "\n").encode('utf8')
         user.socket.sendall(message)
 
     # kill function with client name
-    def kill_usr(self, text):
-        if len(text.split()) <= 2:
-            userName = text.split()[1]
-            # print (userName + '\n')
-            i = 0
-            while i < len(self.users):
-                # print(self.users[i].username)
-                u = self.users[i].username
-                if userName == u:
-                    self.remove_user(self.users[i])
-                    return 'User ' + u + ' has been removed\n'
-                i += 1
-            return 'User' + userName + ' not found\n'
+    def kill_usr(self, command):
+        if len(command.args) == 1:
+            userName = command.args[0]
+            target = self.users.get_by_username(userName)
+            if target is not None:
+                self.disconnect_user(target)
+                return 'User ' + target.username + ' has been removed\n'
+            remoteUser = self.remote.get_user(userName)
+            if remoteUser is not None:
+                if self.bus is None:
+                    return 'Error, ' + remoteUser[1] + ' is on server ' + remoteUser[0] + ', only its operators can remove it\n'
+                # the worker that owns the user removes it and tells everyone else
+                self.publish({'type': 'kill', 'username': remoteUser[1]})
+                return 'User ' + remoteUser[1] + ' has been removed\n'
+            return 'User ' + userName + ' not found\n'
         else:
             return 'Error, input is incorrect: /kill [client name]\n'
 
     # is_on method
-    def is_on (self, text):
-        if len(text.split()) == 2:
-            userName = text.split()[1]
-            # print (userName + '\n')
-            i = 0
-            while i < len(self.users):
-                # print(self.users[i].username)
-                if userName == self.users[i].nickname:
-                    return 'User ' + userName + ' is connected\n'
-                i += 1
-            else:
-                return userName + " not found\n"
+    def is_on (self, command):
+        if command.args:
+            reply = ''
+            for userName in command.args:
+                # users who never set a nickname are known by their username
+                if self.users.get_by_nickname(userName) or self.users.get_by_username(userName) or \
+                        self.remote.has_nickname(userName) or self.remote.has_user(userName):
+                    reply += 'User ' + userName + ' is connected\n'
+                else:
+                    reply += userName + " not found\n"
+            return reply
 
         else:
             return 'Error, input is incorrect: /ison [client name]\n'
 
     # define a mode method for switching the mode of the channel
-    def mode_ch (self, text):
-        if len(text.split()) == 3:
-            newMode = text.split()[1] # what to change the mode to
-            channel = text.split()[2] # the name of the channel
-            # need to fine correct channel
-            i = 0
-            while i < len(self.channels):
-                if self.channels[channel]:
-                    self.channels[channel].mode = newMode
-                    return channel + ' mode has changed to ' + newMode
-                i += 1
-            else:
-                return channel + " not found\n"
+    # members of the channel only, and of those its creator and the operators
+    def mode_ch (self, user, command):
+        if len(command.args) == 2:
+            channelName = command.args[1]
+            channel = self.channels.get(channelName)
+            if channel is None:
+                return channelName + " not found\n"
+            if user not in channel.users:
+                return 'Error, you are not a member of ' + channelName + '\n'
+            if user is not channel.creator and user.usertype != 'operator':
+                return 'Error, only the creator of ' + channelName + ' and operators can change its mode\n'
+            modes = apply_mode_flags(channel.modes, command.args[0])
+            if modes is None:
+                return 'Error, input is incorrect: /mode [+flags | -flags] [channel]\n'
+            channel.modes = modes
+            channel.mode = '+' + ''.join(sorted(modes)) if modes else ''
+            return channelName + ' mode has changed to ' + (channel.mode or 'none') + '\n'
 
         else:
-            return 'Error, input is incorrect: /mode [mode] [channel]\n'
+            return 'Error, input is incorrect: /mode [+flags | -flags] [channel]\n'
+
+    # link this server, or the server named [remote server], to another server
+    def connect_server(self, command):
+        parse = command.args
+        if len(parse) not in (2, 3) or not parse[1].isdigit():
+            return 'Error, input is incorrect: /connect [target server] [port] [remote server]\n'
+        host, port = parse[0], int(parse[1])
+
+        if len(parse) == 3 and parse[2] != self.serverId:
+            if self.links.route_to(parse[2]) is None:
+                return 'Error, server ' + parse[2] + ' is not linked\n'
+            self.links.forward({'type': 'connect', 'origin': self.serverId, 'target': parse[2], 'host': host, 'port': port})
+            return 'Asked ' + parse[2] + ' to link to ' + host + ':' + str(port) + '\n'
+
+        if self.bus is not None:
+            return 'Error, server links are not available in --workers mode\n'
+        try:
+            self.links.connect(host, port)
+        except OSError as errorMessage:
+            return 'Error, could not link to ' + host + ':' + str(port) + ' - ' + str(errorMessage) + '\n'
+        return 'Linking to ' + host + ':' + str(port) + '\n'
 
     # define a method for changing users nickname
-    def nick_change(self, user, text):
-        nick = text.split()
-        if len(nick) == 2:
-            user.nickname = nick[1]
-            return 'Nickname has been changed to ' + nick[1] + '\n'
+    def nick_change(self, user, command):
+        if len(command.args) == 1:
+            nickname = command.args[0]
+            if self.remote.name_taken(nickname) or not self.users.rename_nickname(user, nickname):
+                return 'Error, nickname ' + nickname + ' is already in use\n'
+            self.responses.bump('users')
+            self.publish({'type': 'nick', 'username': user.username, 'nickname': user.nickname})
+            return 'Nickname has been changed to ' + nickname + '\n'
         else:
             return 'Error, input is incorrect: /nick [new nickname]\n'
 
     # define a method that will change the connection password
-    def pass_change (self, user, text):
-        parse = text.split()
-        if len(parse) == 2 and len(user.username) >= 1:
-            user.password = parse[1]
+    def pass_change (self, user, command):
+        if len(command.args) == 1 and len(user.username) >= 1:
+            user.password = command.args[0]
+            self.responses.bump('users')
             return "Password has been changed\n"
         else:
             return 'Error, user undefined or input is incorrect: /pass [new password]\n'
 
     # define method for changing a channels topic
-    def topic_set(self, text):
-        messege = text.split()
-        if len(text.split()) >= 3:
-            channel = messege[1]
-            topic = ' '.join(messege[2:len(text.split())])
-            i = 0
-            while i < len(self.channels):
-                if self.channels[channel]:
-                    self.channels[channel].topic = topic
-                    return 'Channel ' + channel + ' -> topic has been changed to ' + self.channels[channel].topic + '\n'
-                else:
-                    return 'Error, channel with a name ' + channel + ' was not found\n'
+    def topic_set(self, command):
+        if len(command.args) >= 2:
+            channel = command.args[0]
+            topic = command.rest(1).rstrip()
+            target = self.channels.get(channel)
+            if target is None:
+                return 'Error, channel with a name ' + channel + ' was not found\n'
+            target.topic = topic
+            return 'Channel ' + channel + ' -> topic has been changed to ' + target.topic + '\n'
         else:
             return 'Error, user undefined or input is incorrect: /topic [channel] [topic]\n'
 
     # define method to re-set username
-    def set_name (self, user, text):
-        nick = text.split()
-        if len(nick) == 2:
-            user.username = nick[1]
+    def set_name (self, user, command):
+        if len(command.args) == 1:
+            oldName = user.username
+            if self.remote.name_taken(command.args[0]) or not self.users.rename_username(user, command.args[0]):
+                return 'Error, username ' + command.args[0] + ' is already in use\n'
+            self.responses.bump('users')
+            self.publish({'type': 'rename', 'username': oldName, 'new': user.username})
             return 'Username has been changed to ' + user.username + '\n'
         else:
             return 'Error, input is incorrect: /setname [new username]\n'
 
     # define method for that show all users that are online
     def users_all(self):
-        i = 0
-        usersAll = ''
-        while i < len(self.users):
-            # usersAll +=  'User socket = '  + self.users[i].socket() + '\n' - soccet is an object
-            usersAll +=  'User name = ' + self.users[i].username + '\n'
-            usersAll +=  'User nickname = ' + self.users[i].nickname + '\n'
-            usersAll +=  'Password = ' + self.users[i].password + '\n'
-            usersAll +=  'User type = ' + self.users[i].usertype + '\n'
-            usersAll +=  'Status = ' + self.users[i].status + '\n'
-            usersAll +=  'Real name = ' + self.users[i].realname
-            usersAll +=  '\n\n'
-            i += 1
-        print(usersAll)
-        return usersAll
+        return ''.join(self.user_entries())
+
+    def user_entries(self):
+        entries = []
+        for user in self.users:
+            # 'User socket = ' + user.socket() - soccet is an object
+            entries.append(''.join(('User name = ', user.username, '\nUser nickname = ', user.nickname, '\nPassword = ', user.password,
+                                    '\nUser type = ', user.usertype, '\nStatus = ', user.status, '\nReal name = ', user.realname, '\n\n')))
+        for origin, username, nickname, signon in self.remote.user_records():
+            entries.append(''.join(('User name = ', username, '\nUser nickname = ', nickname, '\nStatus = Online on ', origin, '\n\n')))
+        return entries
+
+    def list_users(self, user, page=1):
+        pages = self.responses.get('users', ('users', 'remote'), lambda: ResponseCache.paginate('', self.user_entries(), '/users', footer=''))
+        user.socket.sendall(ResponseCache.select_page(pages, page))
 
     #
     #
     #
+    # O(number of channels the user is in)
+    # runs on the thread of the user and on the one of a /kill or a link at the same time, only one of them
+    # gets the user out of the registry and its channels
     def remove_user(self, user):
-        if user.username in self.users_channels_map:
-            self.channels[self.users_channels_map[user.username]].remove_user_from_channel(user)
-            del self.users_channels_map[user.username]
+        with self.userLocks(user):
+            removed = self.users.remove(user)
+            channels = self.users_channels_map.pop(user, ())
+            self.operators.discard(user)
+            user.channel = None
+        for channelName in channels:
+            self.leave_channel(user, self.channels[channelName])
         user.status = 'Offline'
-        self.users.remove(user)
+        self.keepalive.forget(user)
+        self.responses.bump('users', 'channels')
+        if removed and user.registered:
+            self.publish({'type': 'user_offline', 'username': user.username})
         print("Client: {0} has left\n".format(user.username))
 
-    def server_shutdown(self):
+    # a connection that did not answer the keepalive /ping, its thread or transport removes the user once it is aborted
+    def reap_user(self, user):
+        self.metrics.reaped.inc()
+        print("Client: {0} did not answer the keepalive ping\n".format(user.username))
+        user.socket.abort()
+
+    # runs callback on the thread that owns the connections
+    def call_soon(self, callback, *args):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(callback, *args)
+        else:
+            callback(*args)
+
+    def connect_bus(self, path):
+        self.bus = WorkerBus.BusClient(self, path).start()
+
+    def publish(self, event):
+        event['origin'] = self.serverId
+        if self.bus is not None:
+            self.bus.publish(event)
+        self.links.forward(event)
+
+    # user_online and join events for the users of this server, sent to a newly linked server
+    def local_burst_events(self):
+        events = []
+        for user in self.users:
+            if user.registered:
+                events.append({'type': 'user_online', 'origin': self.serverId, 'username': user.username, 'nickname': user.nickname, 'signon': user.signon})
+                for channelName in self.users_channels_map.get(user, ()):
+                    events.append({'type': 'join', 'origin': self.serverId, 'username': user.username, 'channel': channelName})
+        return events
+
+    def forget_origin(self, origin):
+        self.remote.drop_origin(origin)
+        self.responses.bump('remote')
+
+    # applies an event published by another worker
+    def apply_remote_event(self, event):
+        kind = event['type']
+        if kind == 'message':
+            encoded = event['payload'].encode('utf8')
+            channel = self.channels.get(event['channel'])
+            if channel is not None:
+                typed = None
+                if len(channel.framed) and 'username' in event:
+                    typed = self.typed_frame(Protocol.CHAT, channel, event['username'], event['text'].encode('utf8'))
+                self.broadcast(channel, encoded, typed=typed)
+            if self.channelLog is not None:
+                # every node keeps the whole history, a user may join the channel here later
+                self.channelLog.append(event['channel'], encoded)
+            if self.searchIndex is not None and 'text' in event:
+                self.searchIndex.add(event['channel'], event['username'], event['text'])
+        elif kind == 'kill':
+            target = self.users.get_by_username(event['username'])
+            if target is not None:
+                self.disconnect_user(target)
+        elif kind == 'invite':
+            target = self.users.get_by_username(event['username'])
+            if target is not None:
+                self.deliver_invite(target, event['by'], self.get_channel(event['channel']))
+        elif kind == 'privmsg':
+            targets = [self.users.get_by_username(name) for name in event['targets']]
+            self.deliver_private(event['from'], [target for target in targets if target is not None and target.registered], event['text'], event.get('notice', False))
+        elif kind == 'wallops':
+            self.deliver_wallops(event['from'], event['text'])
+        elif kind == 'die':
+            self.server_shutdown(propagate=False)
+        else:
+            self.remote.apply(event)
+            self.responses.bump('remote')
+
+    def disconnect_user(self, user):
+        self.remove_user(user)
+        self.send_control(user, '/quit')
+        user.socket.close()
+
+    def server_shutdown(self, propagate=True):
+        if propagate and not self.exit_signal.is_set():
+            self.publish({'type': 'die'})
         print("Shutting down chat server.\n")
-        self.serverSocket.close()
+        self.exit_signal.set()
+        if self.channelLog is not None:
+            self.channelLog.close()
+        if self.searchIndex is not None:
+            self.searchIndex.close()
+        self.links.close()
+        if self.listener is not None:
+            self.listener.close() # the event loop owns the listening socket
+        else:
+            self.serverSocket.close()
+
+# adapters for the older handlers that take the message text and return the reply
+def text_reply(method):
+    return lambda server, user, command: user.socket.sendall(method(server, command).encode('utf8'))
+
+def user_reply(method):
+    return lambda server, user, command: user.socket.sendall(method(server, user, command).encode('utf8'))
+
+# a copy of modes with the changes of '+i', '-i' or '+i-t' applied, None if text is not such a change
+def apply_mode_flags(modes, text):
+    if len(text) < 2 or text[0] not in '+-':
+        return None
+    modes = set(modes)
+    adding = True
+    for letter in text:
+        if letter in '+-':
+            adding = letter == '+'
+        elif not letter.isalpha():
+            return None
+        elif adding:
+            modes.add(letter)
+        else:
+            modes.discard(letter)
+    return modes
+
+# commands that act on the whole server or on other users need a successful /oper first
+def operator_only(handler):
+    def guarded(server, user, command):
+        if user.usertype != 'operator':
+            user.socket.sendall("\nError, only operators can use {0}, see /oper\n".format(command.name).encode('utf8'))
+            return
+        return handler(server, user, command)
+    return guarded
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=socket.gethostbyname('localhost'), help='Specify the address to bind: --host [hostname]')
+    parser.add_argument('--port', type=int, default=50000, help='Specify the server port: --port [port]')
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded', help='threaded - one thread per client, asyncio - every client in one event loop')
+    parser.add_argument('--backlog', type=int, default=None, help='Specify the listen backlog: --backlog [size]')
+    parser.add_argument('--framing', choices=sorted(Framing.DECODERS), default='raw', help='raw - one message per read, line - CRLF/LF terminated, length - 4 byte length prefix')
+    parser.add_argument('--max-message-length', type=int, default=Framing.MAX_MESSAGE_LENGTH, help='Longest accepted message in bytes')
+    parser.add_argument('--send-queue-high', type=int, default=OutboundQueue.HIGH_WATERMARK, help='Bytes queued for a client before the slow consumer policy applies')
+    parser.add_argument('--send-queue-low', type=int, default=OutboundQueue.LOW_WATERMARK, help='Bytes a queue is trimmed down to by drop-oldest and coalesce')
+    parser.add_argument('--slow-consumer', choices=OutboundQueue.POLICIES, default=OutboundQueue.DROP_OLDEST, help='What to do with clients that do not keep up')
+    parser.add_argument('--server-name', default=None, help='Name of this server towards linked servers, host:port by default')
+    parser.add_argument('--link-port', type=int, default=None, help='Accept links from other servers (/connect) on this port')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics over HTTP on this port (GET /metrics)')
+    parser.add_argument('--metrics-socket', default=None, help='Serve Prometheus metrics on this Unix socket')
+    parser.add_argument('--log-dir', default=None, help='Keep the history of every channel in this directory and replay it on /join')
+    parser.add_argument('--log-segment-size', type=int, default=ChannelLog.SEGMENT_SIZE, help='Bytes per channel log segment')
+    parser.add_argument('--log-retain-segments', type=int, default=0, help='Segments kept per channel, 0 keeps all of them')
+    parser.add_argument('--log-fsync-interval', type=float, default=ChannelLog.FSYNC_INTERVAL, help='Seconds channel log appends are grouped into one fsync')
+    parser.add_argument('--search', action='store_true', help='Index everything said in the channels in memory for /search')
+    parser.add_argument('--search-dir', default=None, help='Like --search, but written out to segments in this directory that survive restarts')
+    parser.add_argument('--search-segment-size', type=int, default=SearchIndex.SEGMENT_DOCUMENTS, help='Messages indexed in memory before they are written out as a segment')
+    parser.add_argument('--log-replay', type=int, default=ChannelLog.REPLAY_COUNT, help='Messages replayed on /join without a count')
+    parser.add_argument('--ping-interval', type=float, default=Keepalive.PING_INTERVAL, help='Seconds of silence before the server pings a client, 0 turns the keepalive off')
+    parser.add_argument('--ping-timeout', type=float, default=Keepalive.PING_TIMEOUT, help='Seconds a pinged client has to answer before it is disconnected')
+    parser.add_argument('--compression', choices=('deflate', 'off'), default='deflate', help='deflate - binary mode clients may ask for compressed frames')
+    parser.add_argument('--link-compression', action='store_true', help='Compress the links to other servers that have it turned on as well')
+    parser.add_argument('--link-password', default=None, help='Password every linked server sends in its hello, needed for --link-port and /connect')
+    parser.add_argument('--oper', action='append', default=[], metavar='NAME:PASSWORD', help='An operator login for /oper, can be repeated; chat input is lowercased, so NAME and PASSWORD are too')
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='NAME=RATE[/BURST]',
+                        help='Messages per second and burst of one of {0}, 0 turns it off, can be repeated'.format(', '.join(RateLimit.DEFAULT_LIMITS)))
+    parser.add_argument('--workers', type=int, default=1, help='Run N worker processes that share the port and the chat state')
+    parser.add_argument('--worker-id', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--bus', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--restore-fd', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    try:
+        rateLimits = dict(RateLimit.parse_limit(limit) for limit in args.rate_limit)
+    except ValueError as error:
+        parser.error("--rate-limit: {0}".format(error))
+    operPasswords = {}
+    for oper in args.oper:
+        name, separator, password = oper.partition(':')
+        if not name or not separator:
+            parser.error("--oper: expected NAME:PASSWORD, got {0}".format(oper))
+        operPasswords[name.lower()] = password.lower() # compared against the lowercased /oper line
+
+    if args.link_port is not None and not args.link_password:
+        parser.error("--link-port needs --link-password")
 
+    if args.workers > 1:
+        if args.link_port is not None:
+            parser.error("--link-port can not be combined with --workers")
+        print("\nStarting {0} workers on port {1}".format(args.workers, args.port))
+        WorkerBus.run_workers(args.workers, WorkerBus.strip_option(sys.argv[1:], '--workers'), __file__)
+        return
 
-    chatServer = Server()
+    serverId = args.server_name if args.worker_id is None else 'worker-{0}'.format(args.worker_id)
+    listenSocket = linkSocket = None
+    if args.restore_fd is not None:
+        # started by /restart, the old server passes its listening sockets, connections and state
+        state, listeners, clientSockets, handoverSocket = WarmRestart.receive_state(args.restore_fd)
+        listenSocket = listeners[0]
+        linkSocket = listeners[1] if len(listeners) > 1 else None
+    chatServer = Server(args.host, args.port, framing=args.framing, maxMessageLength=args.max_message_length,
+                        outboundHighWater=args.send_queue_high, outboundLowWater=args.send_queue_low, slowConsumerPolicy=args.slow_consumer,
+                        reusePort=args.bus is not None, serverId=serverId, listenSocket=listenSocket,
+                        rateLimits=rateLimits, pingInterval=args.ping_interval, pingTimeout=args.ping_timeout,
+                        compression=args.compression == 'deflate', operPasswords=operPasswords)
+    chatServer.links.compression = args.link_compression
+    chatServer.links.password = args.link_password or None
+    if args.restore_fd is not None:
+        WarmRestart.restore(chatServer, state, clientSockets, handoverSocket)
+    if args.worker_id is None:
+        chatServer.restartCommand = [sys.executable, os.path.abspath(__file__)] + WorkerBus.strip_option(sys.argv[1:], '--restore-fd')
+    if args.bus is not None:
+        chatServer.connect_bus(args.bus)
+    if args.link_port is not None:
+        chatServer.links.listen(args.host, args.link_port, linkSocket)
+    if args.metrics_port is not None:
+        # every worker gets its own port after the given one, after /restart the old server may still be on its way out
+        Metrics.serve_http(chatServer.metrics, args.host, args.metrics_port + (args.worker_id or 0), retryFor=WarmRestart.HANDOVER_TIMEOUT if args.restore_fd is not None else 0)
+    if args.metrics_socket is not None:
+        Metrics.serve_unix(chatServer.metrics, args.metrics_socket if args.worker_id is None else '{0}.{1}'.format(args.metrics_socket, args.worker_id))
+    if args.log_dir is not None:
+        # workers keep separate copies of the history, each of them sees every message
+        logDirectory = args.log_dir if args.worker_id is None else os.path.join(args.log_dir, 'worker-{0}'.format(args.worker_id))
+        chatServer.channelLog = ChannelLog.ChannelLog(logDirectory, args.log_segment_size, args.log_fsync_interval, args.log_retain_segments)
+        chatServer.replayCount = args.log_replay
+    if args.search or args.search_dir is not None:
+        # like the logs, every worker indexes every message on its own
+        searchDirectory = args.search_dir
+        if searchDirectory is not None and args.worker_id is not None:
+            searchDirectory = os.path.join(searchDirectory, 'worker-{0}'.format(args.worker_id))
+        chatServer.searchIndex = SearchIndex.SearchIndex(searchDirectory, args.search_segment_size)
 
     print("\nListening on port {0}".format(chatServer.address[1]))
     print("Waiting for connections...\n")
 
-    chatServer.start_listening()
+    if args.mode == 'asyncio':
+        chatServer.start_event_loop(args.backlog)
+    else:
+        chatServer.start_listening(backlog=args.backlog)
     chatServer.server_shutdown()
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+# What a client makes of a text message from the server. Shared by the Tk window
+# (chatWindow.py) and the headless sessions of AsyncClient.py, so both react to
+# the server the same way.
+import re
+
+QUIT = 'quit' # the server disconnected us
+SQUIT = 'squit' # the server was shut down
+JOINED = 'joined' # value: (notice, usernames of the channel)
+LEFT = 'left' # value: (notice, username)
+PING = 'ping' # keepalive of the server, answer with /pong
+PONG = 'pong' # answer to our /ping
+TEXT = 'text' # anything else, to be shown as it is
+
+# the notice Channel.remove_user_from_channel sends to the members who stay
+DEPARTURE = re.compile(r'\n*> (\S+) has left the channel (\S+)\n')
+
+# in text mode the server ends /ping, /pong, /quit and /squit with a newline, a read
+# may hold them together with chat lines, so they only count as a line of their own
+CONTROL_LINE = re.compile(r'(?:^|(?<=\n))(/ping|/pong|/quit|/squit)(?:\n|$)')
+
+
+# splits one read into its control messages and the text around them, in order
+def split(message):
+    parts = CONTROL_LINE.split(message)
+    return [part for part in parts if part]
+
+
+# returns (kind, value) for one part of split(), value is the message itself unless the kind says otherwise
+def interpret(message):
+    if message == '/quit':
+        return QUIT, message
+    if message == '/squit':
+        return SQUIT, message
+    if 'joined' in message and '|' in message:
+        notice, _, names = message.partition('|')
+        return JOINED, (notice, [name.strip() for name in names.split(' ') if name.strip()])
+    departure = DEPARTURE.match(message)
+    if departure is not None:
+        return LEFT, (message, departure.group(1))
+    if message == '/ping':
+        return PING, message
+    if message == '/pong':
+        return PONG, message
+    return TEXT, message
@@ -0,0 +1,61 @@
+# Command parsing and dispatch for the chat server.
+#
+# A chat line is parsed once: if its first token starts with '/' it is looked up
+# in a dict of registered commands, otherwise it is ordinary chat text.
+
+
+class ParsedCommand:
+    __slots__ = ('name', 'args', 'text')
+
+    def __init__(self, name, args, text):
+        self.name = name # e.g. '/join'
+        self.args = args # the remaining whitespace separated tokens
+        self.text = text # the full original line
+
+    def rest(self, start=0):
+        # everything after the first `start` arguments, keeping the original spacing of the text
+        parts = self.text.split(None, start + 1)
+        return parts[start + 1] if len(parts) > start + 1 else ''
+
+
+# returns None for ordinary chat text so that chat lines pay for a single startswith()
+def parse(chatMessage):
+    if not chatMessage.lstrip().startswith('/'):
+        return None
+    tokens = chatMessage.split()
+    return ParsedCommand(tokens[0].lower(), tokens[1:], chatMessage)
+
+
+# '/Join' and 'join' both name the '/join' command
+def command_name(name):
+    name = name.lower()
+    return name if name.startswith('/') else '/' + name
+
+
+class Command:
+    __slots__ = ('name', 'handler')
+
+    # handler(server, user, parsedCommand) -> False closes the connection, anything else keeps it open
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+
+    def __call__(self, server, user, parsedCommand):
+        return self.handler(server, user, parsedCommand)
+
+
+class CommandRegistry:
+    def __init__(self):
+        self.commands = {} # '/name' -> Command
+
+    def register(self, name, handler):
+        name = command_name(name)
+        command = Command(name, handler)
+        self.commands[name] = command
+        return command
+
+    def unregister(self, name):
+        self.commands.pop(command_name(name), None)
+
+    def lookup(self, name):
+        return self.commands.get(name)
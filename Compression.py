@@ -0,0 +1,128 @@
+# Deflate compression for client connections in binary mode and for server links.
+#
+# Client connections compress every frame on its own (raw deflate, primed with
+# DICTIONARY), not as one stream per connection. That costs some ratio, but a
+# compressed frame means the same to every client, so a broadcast or a cached
+# /users page is compressed once and the same bytes go into every send queue.
+# Frames with less than THRESHOLD bytes of payload are sent as they are, and so
+# are the ones that would not shrink. The last CACHE_ENTRIES results are kept, the
+# notices Channel sends to each member and repeated /list pages hit that cache.
+#
+# A server link is point to point, so it compresses the whole stream with one
+# context and a sync flush per write.
+import collections
+import threading
+import time
+import zlib
+
+LEVEL = 6
+WBITS = 12 # 4 KB window, a context per frame has to be cheap to set up
+MEM_LEVEL = 4
+THRESHOLD = 256 # bytes of payload below which a frame is not compressed
+CACHE_ENTRIES = 32
+
+# strings that come up in what the server sends, both sides prime their contexts with it
+DICTIONARY = ''.join((
+    "\n> Welcome to our chat app!!!\n", "\n> Press SEND\n", "type /help for a list of helpful commands.\n",
+    "User name = ", "\nUser nickname = ", "\nStatus = Online on ", "\nStatus = Online\n\n", "\nReal name = ",
+    "\n\n> Current channels available are: \n", "    \n", ": 1 user(s)", " user(s)", "Type /list ", " for the next page\n",
+    " has joined the channel ", "\n\n> You have joined the channel ", "!\n|", "\n> ", " has left the channel ",
+    "> Last ", " message(s) in ", "> End of history\n", " user(s) matching ", "> End of /who\n", " (no nickname) - Online",
+    "Server version = ", "\nServer start time = ", "\nServer name = ", "\nLinked servers = ", "Signed on = ", " second(s)\n",
+    '{"type":"message","channel":"', '","payload":"', '","username":"', '","text":"', '","origin":"',
+    '{"type":"join","username":"', '{"type":"user_online","username":"', '","nickname":', ',"signon":',
+)).encode('utf8')
+
+
+# Compression ratio and CPU time, shared by all the compressors of a server.
+class CompressionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = {} # path -> messages compressed
+        self.bytesIn = {} # path -> bytes before compression
+        self.bytesOut = {} # path -> bytes after compression
+        self.seconds = {} # path -> CPU seconds spent compressing
+        self.reused = 0 # frames taken from the cache instead of being compressed again
+
+    def add(self, path, bytesIn, bytesOut, seconds):
+        with self.lock:
+            self.messages[path] = self.messages.get(path, 0) + 1
+            self.bytesIn[path] = self.bytesIn.get(path, 0) + bytesIn
+            self.bytesOut[path] = self.bytesOut.get(path, 0) + bytesOut
+            self.seconds[path] = self.seconds.get(path, 0.0) + seconds
+
+    def add_reused(self):
+        with self.lock:
+            self.reused += 1
+
+    def ratio(self):
+        with self.lock:
+            bytesIn = sum(self.bytesIn.values())
+            return sum(self.bytesOut.values()) / bytesIn if bytesIn else 1.0
+
+
+def new_compressor(level=LEVEL):
+    return zlib.compressobj(level, zlib.DEFLATED, -WBITS, MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+
+
+# Compresses frame payloads, one context per payload.
+class Deflater:
+    def __init__(self, stats, level=LEVEL, threshold=THRESHOLD):
+        self.stats = stats
+        self.level = level
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict() # payload -> deflated payload, or None if it does not shrink
+
+    # the deflated payload, None when it is not worth it
+    def compress(self, data):
+        if len(data) < self.threshold:
+            return None
+        with self.lock:
+            if data in self.cache:
+                self.cache.move_to_end(data)
+                self.stats.add_reused()
+                return self.cache[data]
+
+        start = time.thread_time()
+        compressor = new_compressor(self.level)
+        deflated = compressor.compress(data) + compressor.flush()
+        self.stats.add('client', len(data), min(len(deflated), len(data)), time.thread_time() - start)
+        if len(deflated) >= len(data):
+            deflated = None
+
+        with self.lock:
+            self.cache[data] = deflated
+            if len(self.cache) > CACHE_ENTRIES:
+                self.cache.popitem(last=False)
+        return deflated
+
+
+# the payload of a compressed frame, None if it is broken or inflates to more than maxLength bytes
+def inflate(data, maxLength):
+    decompressor = zlib.decompressobj(-WBITS, DICTIONARY)
+    try:
+        inflated = decompressor.decompress(data, maxLength)
+    except zlib.error:
+        return None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        return None
+    return inflated
+
+
+# One direction of a compressed server link.
+class StreamCompressor:
+    def __init__(self, stats, level=LEVEL):
+        self.stats = stats
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+
+    # called under the send lock of the link, so the chunks leave in the order they were compressed
+    def compress(self, data):
+        start = time.thread_time()
+        deflated = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.stats.add('link', len(data), len(deflated), time.thread_time() - start)
+        return deflated
+
+
+def new_stream_decompressor():
+    return zlib.decompressobj(-zlib.MAX_WBITS, DICTIONARY)
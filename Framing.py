@@ -0,0 +1,167 @@
+# Incremental decoders that turn the byte stream of a connection into chat messages.
+#
+# TCP does not keep message boundaries, so a single recv can hold several messages
+# or only part of one. Each decoder keeps the leftover bytes of a connection and
+# yields complete messages as they become available:
+#
+#   raw    - every recv is one message (what the GUI client sends today), only the
+#            UTF-8 decoding is incremental so characters split across reads survive
+#   line   - messages end with LF or CRLF
+#   length - every message is prefixed with its size as a 4 byte big-endian integer
+import codecs
+import struct
+
+MAX_MESSAGE_LENGTH = 8192
+RECV_BUFFER_SIZE = 65536
+IDLE_RECV_BUFFER_SIZE = 8192 # what a connection reads into until it sends more than that at once
+
+LENGTH_PREFIX = struct.Struct('!I')
+
+
+class RawDecoder:
+    __slots__ = ('decoder', 'dropped')
+
+    def __init__(self, maxLength=MAX_MESSAGE_LENGTH):
+        self.decoder = None # incremental UTF-8 decoder, only kept while a character is split across reads
+        self.dropped = 0
+
+    def feed(self, data):
+        decoder = self.decoder
+        if decoder is None:
+            try:
+                message = str(data, 'utf8')
+            except UnicodeDecodeError:
+                decoder = self.decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        if decoder is not None:
+            message = decoder.decode(data)
+            if not decoder.getstate()[0]:
+                self.decoder = None
+        if message:
+            yield message
+
+    # bytes received but not turned into a message yet, feeding them to a new decoder restores this one
+    def pending(self):
+        return self.decoder.getstate()[0] if self.decoder is not None else b''
+
+
+class LineDecoder:
+    __slots__ = ('buffer', 'maxLength', 'discarding', 'dropped', 'consumed')
+
+    def __init__(self, maxLength=MAX_MESSAGE_LENGTH):
+        self.buffer = bytearray()
+        self.maxLength = maxLength
+        self.discarding = False # inside a line that was already too long
+        self.dropped = 0 # number of lines thrown away for exceeding maxLength
+        self.consumed = 0 # bytes at the start of buffer that were already handed out
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        start = 0
+
+        while True:
+            end = buffer.find(b'\n', start)
+            if end == -1:
+                break
+            if self.discarding:
+                self.discarding = False
+                start = self.consumed = end + 1
+            else:
+                line = buffer[start:end]
+                start = self.consumed = end + 1
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                if len(line) > self.maxLength:
+                    self.dropped += 1
+                else:
+                    # LF never occurs inside a UTF-8 multi-byte sequence, so every line decodes on its own
+                    yield line.decode('utf8', errors='replace')
+
+        del buffer[:start]
+        self.consumed = 0
+
+        if len(buffer) > self.maxLength:
+            if not self.discarding:
+                self.dropped += 1
+            self.discarding = True
+            del buffer[:]
+
+    def pending(self):
+        return bytes(self.buffer[self.consumed:])
+
+
+class LengthPrefixDecoder:
+    __slots__ = ('buffer', 'maxLength', 'dropped', 'skip', 'consumed')
+
+    def __init__(self, maxLength=MAX_MESSAGE_LENGTH):
+        self.buffer = bytearray()
+        self.maxLength = maxLength
+        self.dropped = 0
+        self.skip = 0 # bytes still to be skipped from a message that was too long
+        self.consumed = 0 # bytes at the start of buffer that were already handed out
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+
+        if self.skip:
+            skipped = min(self.skip, len(buffer))
+            del buffer[:skipped]
+            self.skip -= skipped
+
+        view = memoryview(buffer)
+        offset = 0
+        try:
+            while len(buffer) - offset >= LENGTH_PREFIX.size:
+                (length,) = LENGTH_PREFIX.unpack_from(view, offset)
+                if length > self.maxLength:
+                    self.dropped += 1
+                    available = len(buffer) - offset - LENGTH_PREFIX.size
+                    if length > available:
+                        self.skip = length - available
+                        offset = len(buffer)
+                        break
+                    offset += LENGTH_PREFIX.size + length
+                    continue
+
+                end = offset + LENGTH_PREFIX.size + length
+                if end > len(buffer):
+                    break
+                message = str(view[offset + LENGTH_PREFIX.size:end], 'utf8', errors='replace')
+                offset = self.consumed = end
+                yield message
+        finally:
+            view.release()
+
+        del buffer[:offset]
+        self.consumed = 0
+
+    def pending(self):
+        return bytes(self.buffer[self.consumed:])
+
+
+DECODERS = {
+    'raw': RawDecoder,
+    'line': LineDecoder,
+    'length': LengthPrefixDecoder,
+}
+
+
+def create_decoder(framing='raw', maxLength=MAX_MESSAGE_LENGTH):
+    try:
+        return DECODERS[framing](maxLength)
+    except KeyError:
+        raise ValueError("Unknown framing {0}, expected one of {1}".format(framing, ', '.join(DECODERS)))
+
+
+def encode_length_prefixed(message):
+    payload = message.encode('utf8')
+    return LENGTH_PREFIX.pack(len(payload)) + payload
+
+
+# the bytes that a decoder of the given framing turns back into message
+def encode_message(framing, message):
+    if framing == 'length':
+        return encode_length_prefixed(message)
+    payload = message.encode('utf8')
+    return payload + b'\n' if framing == 'line' else payload
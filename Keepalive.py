@@ -0,0 +1,167 @@
+# Server initiated keepalive: a connection that stays silent for --ping-interval
+# seconds is sent /ping, and if nothing at all arrives within --ping-timeout seconds
+# after that it is aborted. The thread or transport that owns it then cleans it up
+# through Server.remove_user, as if the client had left.
+#
+# The deadlines live in a hierarchical timer wheel (Varghese & Lauck): LEVELS
+# wheels of SLOTS slots, each slot of a level spanning a whole turn of the level
+# below. Scheduling and cancelling are O(1), a tick only looks at one slot of the
+# lowest wheel, and a timer moves down at most LEVELS - 1 times before it fires.
+# Input does not touch the wheel, it only records the time of the last activity;
+# when a timer fires early because of that it is simply scheduled again.
+import threading
+import time
+
+TICK = 0.1 # seconds per slot of the lowest wheel
+SLOTS = 64 # slots per wheel
+LEVELS = 4 # wheels, they cover SLOTS ** LEVELS ticks (about 19 days)
+PING_INTERVAL = 60 # seconds of silence before a connection is pinged, 0 turns the keepalive off
+PING_TIMEOUT = 30 # seconds a pinged connection has to send anything
+
+
+class Timer:
+    __slots__ = ('deadline', 'slot')
+
+    def __init__(self):
+        self.deadline = 0.0
+        self.slot = None # the set it waits in, None when it is not scheduled
+
+
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=SLOTS, levels=LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.spans = [slots ** level for level in range(levels + 1)] # ticks per slot of every level, and of all of them
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.current = int(time.monotonic() / tick) # number of the last tick that was processed
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    # earliest: the first tick the timer may land in, deadlines past the last wheel fire early at its end
+    def insert(self, timer, earliest):
+        # the first tick at or after the deadline, so a timer never fires early
+        target = min(max(-int(-timer.deadline // self.tick), earliest), self.current + self.spans[-1] - 1)
+        delta = target - self.current
+        level = 0
+        while delta >= self.spans[level + 1]:
+            level += 1
+        slot = self.wheels[level][target // self.spans[level] % self.slots]
+        slot.add(timer)
+        timer.slot = slot
+
+    def unlink(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def schedule(self, timer, deadline):
+        with self.lock:
+            self.unlink(timer)
+            timer.deadline = deadline
+            self.insert(timer, self.current + 1)
+            self.count += 1
+
+    def cancel(self, timer):
+        with self.lock:
+            self.unlink(timer)
+
+    # moves the wheels forward to `now`, returns the timers that are due
+    def advance(self, now):
+        target = int(now / self.tick)
+        expired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                # every time a wheel completes a turn, the next slot of the wheel above is spread over it
+                for level in range(1, len(self.wheels)):
+                    if self.current % self.spans[level]:
+                        break
+                    index = self.current // self.spans[level] % self.slots
+                    timers, self.wheels[level][index] = self.wheels[level][index], set()
+                    for timer in timers:
+                        self.insert(timer, self.current)
+                index = self.current % self.slots
+                timers, self.wheels[0][index] = self.wheels[0][index], set()
+                for timer in timers:
+                    timer.slot = None
+                self.count -= len(timers)
+                expired.extend(timers)
+        return expired
+
+
+# The keepalive state of one connection.
+class SessionTimer(Timer):
+    __slots__ = ('user', 'lastActivity', 'pingSent')
+
+    def __init__(self, user, now):
+        Timer.__init__(self)
+        self.user = user
+        self.lastActivity = now # monotonic time of the last input, set by Server.receive
+        self.pingSent = 0.0 # when the unanswered /ping went out, 0 if there is none
+
+
+class Keepalive:
+    def __init__(self, server, interval=PING_INTERVAL, timeout=PING_TIMEOUT, tick=TICK):
+        self.server = server
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick)
+        self.loop = None
+
+    def watch(self, user):
+        now = time.monotonic()
+        user.keepalive = SessionTimer(user, now)
+        if self.interval > 0:
+            self.wheel.schedule(user.keepalive, now + self.interval)
+
+    def forget(self, user):
+        timer = getattr(user, 'keepalive', None)
+        if timer is not None:
+            self.wheel.cancel(timer)
+
+    # threaded mode ticks on its own thread, asyncio mode on the event loop
+    def start(self, loop=None):
+        if self.interval <= 0:
+            return
+        if loop is not None:
+            self.loop = loop
+            loop.call_later(self.wheel.tick, self.tick_async)
+        else:
+            threading.Thread(target=self.tick_loop, name='Keepalive', daemon=True).start()
+
+    def tick_loop(self):
+        while not self.server.exit_signal.is_set():
+            time.sleep(self.wheel.tick)
+            self.tick()
+
+    def tick_async(self):
+        self.tick()
+        if not self.server.exit_signal.is_set():
+            self.loop.call_later(self.wheel.tick, self.tick_async)
+
+    def tick(self):
+        now = time.monotonic()
+        for timer in self.wheel.advance(now):
+            self.expire(timer, now)
+
+    def expire(self, timer, now):
+        user = timer.user
+        if user not in self.server.users:
+            return
+        if timer.pingSent:
+            if timer.lastActivity < timer.pingSent:
+                self.server.reap_user(user)
+                return
+            timer.pingSent = 0.0
+        due = timer.lastActivity + self.interval
+        if due > now:
+            self.wheel.schedule(timer, due)
+            return
+        timer.pingSent = now
+        self.server.metrics.keepalivePings.inc()
+        self.server.send_control(user, '/ping')
+        self.wheel.schedule(timer, now + self.timeout)
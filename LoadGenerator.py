@@ -0,0 +1,318 @@
+# Headless load generator for ChatServer.
+#
+# Opens many simulated clients on one asyncio loop. They speak the same protocol
+# as the GUI: wait for "Press SEND", send a username, /join a channel, then chat
+# or send commands. Every chat line carries its send time, so receivers can
+# measure delivery latency. With --protocol binary they negotiate the frames of
+# Protocol.py first and send everything framed, which the server then parses.
+#
+#   python LoadGenerator.py --scenario big-channel --clients 2000 --spawn
+#   python LoadGenerator.py --scenario join-storm --port 50000 --save before.json
+#   python LoadGenerator.py --scenario join-storm --port 50000 --baseline before.json
+#
+# Scenarios:
+#   join-storm      every client connects, registers and joins one channel at once
+#   big-channel     all clients in one channel, --senders of them chat
+#   small-channels  clients split into channels of --channel-size, everyone chats
+#   command-flood   every client sends --command as fast as the replies come back
+#
+# With --spawn the server is started by this script (extra server options go after
+# --) and its memory and CPU use per connection is reported as well. The threaded
+# server listens with a backlog of 15 by default, pass `-- --backlog 1024` to it
+# before opening more connections than that at once, and `-- --rate-limit command=0`
+# (or chat=0, channel=0) to measure past the default rate limits of the server.
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+import Protocol
+
+MARKER = re.compile(rb'lg(\d+)t(\d+)e')
+SCENARIOS = ('join-storm', 'big-channel', 'small-channels', 'command-flood')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class ProcessUsage:
+    def __init__(self, pid):
+        self.pid = pid
+        self.clockTicks = os.sysconf('SC_CLK_TCK')
+
+    def rss(self):
+        with open('/proc/{0}/status'.format(self.pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def cpu_seconds(self):
+        with open('/proc/{0}/stat'.format(self.pid)) as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.clockTicks
+
+
+class SimulatedClient:
+    def __init__(self, index, stats, framing, protocol='text'):
+        self.index = index
+        self.name = 'lg{0}x{1}'.format(index, random.randint(0, 99999))
+        self.stats = stats
+        self.framing = framing
+        self.protocol = protocol
+        self.binary = False # set once the server agreed to the binary protocol
+        self.reader = None
+        self.writer = None
+        self.tail = b''
+        self.pongs = 0
+
+    async def send(self, text):
+        if self.binary:
+            data = Protocol.encode_client_message(text)
+        else:
+            data = text.encode('utf8')
+            if self.framing == 'line':
+                data += b'\n'
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def wait_for(self, token):
+        buffer = b''
+        while token not in buffer:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            buffer += data
+            self.stats['bytes_in'] += len(data)
+        return buffer
+
+    async def handshake(self, host, port, channel):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        await self.wait_for(b'Press SEND')
+        if self.protocol == 'binary':
+            await self.send(Protocol.OFFER)
+            reply = await self.wait_for(Protocol.NEGOTIATE.encode('utf8'))
+            if (Protocol.OFFER + '\n').encode('utf8') not in reply:
+                raise ConnectionError("the server does not speak the binary protocol")
+            self.binary = True
+        await self.send(self.name)
+        await self.wait_for(b'Welcome ' + self.name.encode('utf8'))
+        if channel is not None:
+            await self.send('/join ' + channel)
+            await self.wait_for(b'joined the channel')
+
+    # returns False if the client could not connect, register and join within `timeout` seconds
+    async def connect(self, host, port, channel, timeout):
+        try:
+            await asyncio.wait_for(self.handshake(host, port, channel), timeout)
+            return True
+        except (OSError, asyncio.TimeoutError):
+            self.close()
+            return False
+
+    # reads until stopped, counting the chat lines and pongs it sees
+    async def listen(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.stats['bytes_in'] += len(data)
+                now = time.perf_counter_ns()
+                data = self.tail + data
+                end = 0
+                for match in MARKER.finditer(data):
+                    self.stats['latencies'].append((now - int(match.group(2))) / 1e9)
+                    end = match.end()
+                self.pongs += data.count(b'/pong')
+                if b'/ping' in data:
+                    # keepalive of the server, runs longer than its --ping-interval have to answer it
+                    if self.binary:
+                        self.writer.write(Protocol.encode_frame(Protocol.CONTROL, 0, 0, b'/pong'))
+                    else:
+                        self.writer.write(b'/pong\n' if self.framing == 'line' else b'/pong')
+                self.tail = data[max(end, len(data) - 32):]
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def chat(self, messages, interval):
+        for sequence in range(messages):
+            await self.send('lg{0}t{1}e message {2} from {3}'.format(sequence, time.perf_counter_ns(), sequence, self.name))
+            self.stats['sent'] += 1
+            await asyncio.sleep(interval)
+
+    async def flood(self, command, messages):
+        for sequence in range(messages):
+            start = time.perf_counter()
+            pongs = self.pongs
+            await self.send(command)
+            self.stats['sent'] += 1
+            if command == '/ping':
+                while self.pongs == pongs:
+                    await asyncio.sleep(0.0005)
+                self.stats['latencies'].append(time.perf_counter() - start)
+            else:
+                await asyncio.sleep(0.001)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+# returns the clients that made it through the handshake and the time it took
+async def connect_all(clients, args, channelFor):
+    started = time.perf_counter()
+    connected = []
+    for index in range(0, len(clients), args.connect_batch):
+        batch = clients[index:index + args.connect_batch]
+        results = await asyncio.gather(*(client.connect(args.host, args.port, channelFor(client), args.timeout) for client in batch))
+        connected.extend(client for client, ok in zip(batch, results) if ok)
+    return connected, time.perf_counter() - started
+
+
+async def run_scenario(args, usage):
+    stats = {'sent': 0, 'bytes_in': 0, 'latencies': []}
+    clients = [SimulatedClient(i, stats, args.framing, args.protocol) for i in range(args.clients)]
+    result = {'scenario': args.scenario, 'clients': args.clients}
+
+    if args.scenario in ('join-storm', 'big-channel', 'command-flood'):
+        channelFor = lambda client: 'lgbig'
+    else:
+        channelFor = lambda client: 'lgsmall{0}'.format(client.index // args.channel_size)
+
+    rssBefore = usage.rss() if usage else 0
+    cpuBefore = usage.cpu_seconds() if usage else 0
+    clients, connectTime = await connect_all(clients, args, channelFor)
+    result['failed_connections'] = args.clients - len(clients)
+    if not clients:
+        return result
+    result['connect_seconds'] = connectTime
+    result['joins_per_second'] = len(clients) / connectTime if connectTime else 0.0
+    if usage:
+        result['server_bytes_per_connection'] = (usage.rss() - rssBefore) / len(clients)
+        result['server_cpu_ms_per_connection'] = (usage.cpu_seconds() - cpuBefore) * 1000 / len(clients)
+
+    if args.scenario == 'join-storm':
+        for client in clients:
+            client.close()
+        return result
+
+    listeners = [asyncio.ensure_future(client.listen()) for client in clients]
+    started = time.perf_counter()
+    cpuBefore = usage.cpu_seconds() if usage else 0
+
+    if args.scenario == 'big-channel':
+        senders = clients[:args.senders]
+        await asyncio.gather(*(client.chat(args.messages, 1.0 / args.rate) for client in senders))
+    elif args.scenario == 'small-channels':
+        await asyncio.gather(*(client.chat(args.messages, 1.0 / args.rate) for client in clients))
+    elif args.scenario == 'command-flood':
+        await asyncio.gather(*(client.flood(args.command, args.messages) for client in clients))
+
+    await asyncio.sleep(args.settle)
+    elapsed = time.perf_counter() - started
+    for listener in listeners:
+        listener.cancel()
+    for client in clients:
+        client.close()
+
+    latencies = stats['latencies']
+    result['messages_sent'] = stats['sent']
+    result['deliveries'] = len(latencies)
+    result['deliveries_per_second'] = len(latencies) / elapsed
+    result['latency_p50_ms'] = percentile(latencies, 0.50) * 1000
+    result['latency_p99_ms'] = percentile(latencies, 0.99) * 1000
+    result['bytes_received'] = stats['bytes_in']
+    if usage:
+        result['server_cpu_ms_per_delivery'] = (usage.cpu_seconds() - cpuBefore) * 1000 / max(1, len(latencies))
+    return result
+
+
+def print_result(result, baseline=None):
+    print("\n{0} with {1} clients".format(result['scenario'], result['clients']))
+    for key, value in result.items():
+        if key in ('scenario', 'clients'):
+            continue
+        line = "  {0:<32} {1:>14.3f}".format(key, value) if isinstance(value, float) else "  {0:<32} {1:>14}".format(key, value)
+        if baseline and isinstance(baseline.get(key), (int, float)) and baseline[key]:
+            line += "   ({0:+.1f}% vs baseline)".format((value - baseline[key]) * 100.0 / baseline[key])
+        print(line)
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("The server did not start listening on {0}:{1}".format(host, port))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50000)
+    parser.add_argument('--scenario', choices=SCENARIOS, default='big-channel')
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--senders', type=int, default=10, help='clients that chat in big-channel')
+    parser.add_argument('--channel-size', type=int, default=10, help='members per channel in small-channels')
+    parser.add_argument('--messages', type=int, default=20, help='messages sent by every active client')
+    parser.add_argument('--rate', type=float, default=10, help='messages per second per chatting client')
+    parser.add_argument('--command', default='/ping', help='command sent in command-flood')
+    parser.add_argument('--connect-batch', type=int, default=200, help='connections opened concurrently')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds a client may take to connect, register and join')
+    parser.add_argument('--framing', choices=('raw', 'line'), default='raw', help='must match the --framing of the server')
+    parser.add_argument('--protocol', choices=('text', 'binary'), default='text', help='binary negotiates the frames of Protocol.py')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds to wait for the last deliveries')
+    parser.add_argument('--spawn', action='store_true', help='start ChatServer.py on --port, arguments after -- are passed to it')
+    parser.add_argument('--server-pid', type=int, default=None, help='report memory and CPU of an already running server')
+    parser.add_argument('--save', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare against results saved with --save')
+    argv = sys.argv[1:]
+    serverArgs = []
+    if '--' in argv:
+        serverArgs = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+
+    server = None
+    pid = args.server_pid
+    if args.spawn:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ChatServer.py')
+        server = subprocess.Popen([sys.executable, script, '--host', args.host, '--port', str(args.port), '--framing', args.framing] + serverArgs,
+                                  stdout=subprocess.DEVNULL)
+        pid = server.pid
+        wait_for_port(args.host, args.port)
+    usage = ProcessUsage(pid) if pid is not None and os.path.exists('/proc/{0}'.format(pid)) else None
+
+    try:
+        result = asyncio.run(run_scenario(args, usage))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        if baseline.get('scenario') != result['scenario'] or baseline.get('clients') != result['clients']:
+            sys.stderr.write("The baseline was recorded with {0} and {1} clients\n".format(baseline.get('scenario'), baseline.get('clients')))
+    print_result(result, baseline)
+    if args.save:
+        with open(args.save, 'w') as saveFile:
+            json.dump(result, saveFile, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# Counters, gauges and histograms for the chat server, rendered in the Prometheus
+# text format. They are cheap enough to stay on all the time: an update is a
+# lock, an addition and for histograms a bisect over a short list of buckets.
+#
+# The same text is served by /stats, over HTTP (--metrics-port, GET /metrics)
+# and on a Unix socket (--metrics-socket, connect and read).
+import bisect
+import http.server
+import os
+import socket
+import threading
+import time
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in labels) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelName=None):
+        self.name = name
+        self.help = help
+        self.labelName = labelName
+        self.lock = threading.Lock()
+        self.values = {} # label value (None without a label) -> count
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        if not values and self.labelName is None:
+            values[None] = 0
+        for label, value in sorted(values.items(), key=lambda item: str(item[0])):
+            labels = () if label is None else ((self.labelName, label),)
+            yield self.name, labels, value
+
+
+# reads its value from a callback when the metrics are rendered, kind='counter' for totals kept elsewhere;
+# with a labelName the callback returns a dict of label value -> value
+class Gauge:
+    def __init__(self, name, help, read, kind='gauge', labelName=None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+        self.labelName = labelName
+
+    def samples(self):
+        if self.labelName is None:
+            yield self.name, (), self.read()
+            return
+        for label, value in sorted(self.read().items()):
+            yield self.name, ((self.labelName, label),), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(buckets) + 1) # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # context manager that observes the time spent inside the with block
+    def time(self):
+        return Timer(self)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucketCount in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucketCount
+            yield self.name + '_bucket', (('le', bound),), cumulative
+        yield self.name + '_sum', (), total
+        yield self.name + '_count', (), count
+
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelName=None):
+        return self.add(Counter(name, help, labelName))
+
+    def gauge(self, name, help, read, kind='gauge', labelName=None):
+        return self.add(Gauge(name, help, read, kind, labelName))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics of one Server.
+class ServerMetrics:
+    def __init__(self, server):
+        self.registry = MetricsRegistry()
+        registry = self.registry
+        self.accepts = registry.counter('chat_accepts_total', 'Connections accepted')
+        self.messages = registry.counter('chat_messages_total', 'Messages handled by command', 'command')
+        self.dispatch = registry.histogram('chat_dispatch_seconds', 'Time to handle one message')
+        self.broadcast = registry.histogram('chat_broadcast_seconds', 'Time to fan a message out to a channel')
+        self.search = registry.histogram('chat_search_seconds', 'Time to answer a /search')
+        self.bytesIn = registry.counter('chat_received_bytes_total', 'Bytes received from clients')
+        self.keepalivePings = registry.counter('chat_keepalive_pings_total', 'Keepalive pings sent to silent clients')
+        self.reaped = registry.counter('chat_keepalive_reaped_total', 'Clients disconnected for not answering a keepalive ping')
+        self.rateLimited = registry.counter('chat_rate_limited_total', 'Messages and connections held back by the rate limits', 'action')
+        stats = server.outboundStats
+        registry.gauge('chat_sent_bytes_total', 'Bytes written to clients', lambda: stats.sentBytes, 'counter')
+        registry.gauge('chat_send_queue_bytes', 'Bytes waiting in the send queues', lambda: stats.queuedBytes)
+        registry.gauge('chat_send_dropped_messages_total', 'Messages dropped by the slow consumer policy', lambda: stats.droppedMessages, 'counter')
+        registry.gauge('chat_send_overflow_disconnects_total', 'Clients disconnected by the slow consumer policy', lambda: stats.disconnects, 'counter')
+        compression = server.compressionStats
+        registry.gauge('chat_compressed_messages_total', 'Frames and link writes that were compressed', lambda: dict(compression.messages), 'counter', 'path')
+        registry.gauge('chat_compression_input_bytes_total', 'Bytes before compression', lambda: dict(compression.bytesIn), 'counter', 'path')
+        registry.gauge('chat_compression_output_bytes_total', 'Bytes after compression', lambda: dict(compression.bytesOut), 'counter', 'path')
+        registry.gauge('chat_compression_cpu_seconds_total', 'CPU time spent compressing', lambda: dict(compression.seconds), 'counter', 'path')
+        registry.gauge('chat_compression_reused_total', 'Compressed frames reused instead of compressed again', lambda: compression.reused, 'counter')
+        registry.gauge('chat_compression_ratio', 'Bytes after compression per byte before it', compression.ratio)
+        registry.gauge('chat_connections', 'Connected clients', lambda: len(server.users))
+        registry.gauge('chat_channels', 'Channels on this server', lambda: len(server.channels))
+        registry.gauge('chat_threads', 'Active threads', threading.active_count)
+
+    def render(self):
+        return self.registry.render()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# retryFor: seconds to keep trying while the port is still held by the process this one replaces
+def serve_http(metrics, host, port, retryFor=0):
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'metrics': metrics})
+    deadline = time.time() + retryFor
+    while True:
+        try:
+            httpServer = http.server.ThreadingHTTPServer((host, port), handler)
+            break
+        except OSError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.05)
+    httpServer.daemon_threads = True
+    threading.Thread(target=httpServer.serve_forever, name='MetricsHTTP', daemon=True).start()
+    return httpServer
+
+
+# every connection to the socket gets the current metrics and is closed
+def serve_unix(metrics, path):
+    if os.path.exists(path):
+        os.unlink(path)
+    listenSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listenSocket.bind(path)
+    listenSocket.listen(8)
+
+    def accept_loop():
+        while True:
+            try:
+                sock, _ = listenSocket.accept()
+            except OSError:
+                break
+            with sock:
+                try:
+                    sock.sendall(metrics.render().encode('utf8'))
+                except OSError:
+                    pass
+
+    threading.Thread(target=accept_loop, name='MetricsUnix', daemon=True).start()
+    return listenSocket
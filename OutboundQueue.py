@@ -0,0 +1,340 @@
+# Bounded per-connection outbound queues.
+#
+# Replies and broadcasts are appended to the queue of the receiving connection and
+# the I/O layer writes them out when the socket is writable, so a client on a slow
+# link no longer blocks the thread that is talking to it. When a queue grows past
+# its high watermark the slow consumer policy decides what happens:
+#
+#   drop-oldest - drop the oldest queued messages until the queue is below the low watermark
+#   coalesce    - like drop-oldest, but the dropped messages are replaced by a single notice
+#   disconnect  - close the connection
+import collections
+import selectors
+import socket
+import threading
+
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+HIGH_WATERMARK = 1024 * 1024
+LOW_WATERMARK = 256 * 1024
+MAX_WRITE_BATCH = 64 # buffers handed to one sendmsg call
+
+SKIPPED_NOTICE = "\n> {0} message(s) were skipped because your connection is too slow\n"
+
+
+# Totals across all the queues of a server.
+class QueueStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queuedBytes = 0
+        self.sentBytes = 0
+        self.droppedMessages = 0
+        self.droppedBytes = 0
+        self.disconnects = 0
+
+    def add(self, queued=0, sent=0, droppedMessages=0, droppedBytes=0, disconnects=0):
+        with self.lock:
+            self.queuedBytes += queued
+            self.sentBytes += sent
+            self.droppedMessages += droppedMessages
+            self.droppedBytes += droppedBytes
+            self.disconnects += disconnects
+
+    def snapshot(self):
+        with self.lock:
+            return {'queued_bytes': self.queuedBytes, 'sent_bytes': self.sentBytes, 'dropped_messages': self.droppedMessages,
+                    'dropped_bytes': self.droppedBytes, 'disconnects': self.disconnects}
+
+
+class NoLock:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_LOCK = NoLock()
+
+
+class OutboundQueue:
+    __slots__ = ('chunks', 'queuedBytes', 'highWater', 'lowWater', 'policy', 'stats', 'lock',
+                 'dropped', 'droppedBytes', 'skipped', 'overflowed', 'framer', 'gate')
+
+    # threadSafe=False is for queues that are only touched from the event loop thread
+    def __init__(self, highWater=HIGH_WATERMARK, lowWater=LOW_WATERMARK, policy=DROP_OLDEST, stats=None, threadSafe=True):
+        if policy not in POLICIES:
+            raise ValueError("Unknown slow consumer policy {0}, expected one of {1}".format(policy, ', '.join(POLICIES)))
+        if lowWater > highWater:
+            raise ValueError("The low watermark can not be above the high watermark")
+        self.chunks = None # deque of the queued buffers, only allocated while there are any
+        self.queuedBytes = 0
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.policy = policy
+        self.stats = stats if stats is not None else QueueStats()
+        self.lock = threading.Lock() if threadSafe else NO_LOCK
+        self.dropped = 0 # messages dropped from this queue
+        self.droppedBytes = 0
+        self.skipped = 0 # dropped messages not yet reported by a coalesce notice
+        self.overflowed = False # the disconnect policy fired
+        self.framer = None # wraps the coalesce notice for connections in binary mode, see Protocol.py
+        self.gate = None # threading.Event pushes wait for while /restart takes the queue over, see close()
+
+    # returns False when the connection has to be closed
+    def push(self, data):
+        with self.lock:
+            gate = self.gate
+            if gate is None:
+                return self._append(data)
+        gate.wait() # only set once a failed restart has reopened the queue
+        return self.push(data)
+
+    def _append(self, data):
+        if self.overflowed:
+            return False
+
+        size = len(data)
+        if self.queuedBytes + size > self.highWater:
+            if self.policy == DISCONNECT:
+                self.overflowed = True
+                self.stats.add(queued=-self.queuedBytes, disconnects=1)
+                self.chunks = None
+                self.queuedBytes = 0
+                return False
+            self._shed(size)
+
+        chunks = self.chunks
+        if chunks is None:
+            # an empty deque still holds a 64 slot block, idle connections go without one
+            chunks = self.chunks = collections.deque()
+        chunks.append(data)
+        self.queuedBytes += size
+        stats = self.stats
+        with stats.lock:
+            stats.queuedBytes += size
+        return True
+
+    # drop the oldest messages until `incoming` more bytes fit under the low watermark
+    def _shed(self, incoming):
+        droppedMessages = droppedBytes = 0
+        while self.chunks and self.queuedBytes + incoming > self.lowWater:
+            chunk = self.chunks.popleft()
+            self.queuedBytes -= len(chunk)
+            droppedMessages += 1
+            droppedBytes += len(chunk)
+
+        self.dropped += droppedMessages
+        self.droppedBytes += droppedBytes
+        if self.policy == COALESCE:
+            self.skipped += droppedMessages
+        self.stats.add(queued=-droppedBytes, droppedMessages=droppedMessages, droppedBytes=droppedBytes)
+
+    # removes and returns up to maxChunks buffers in the order they were queued
+    def take(self, maxChunks=MAX_WRITE_BATCH):
+        with self.lock:
+            chunks = []
+            if self.skipped:
+                notice = SKIPPED_NOTICE.format(self.skipped).encode('utf8')
+                chunks.append(notice if self.framer is None else self.framer(notice))
+                self.skipped = 0
+            size = 0
+            queued = self.chunks
+            while queued and len(chunks) < maxChunks:
+                chunk = queued.popleft()
+                size += len(chunk)
+                chunks.append(chunk)
+            if queued is not None and not queued:
+                self.chunks = None
+            self.queuedBytes -= size
+            stats = self.stats
+            with stats.lock:
+                stats.queuedBytes -= size
+            return chunks
+
+    # /restart: pushes wait for `gate` from now on, so a take() after this gets everything that was
+    # ever queued. A successful restart exits the process, a failed one reopens the queue first.
+    def close(self, gate):
+        with self.lock:
+            self.gate = gate
+
+    def reopen(self):
+        with self.lock:
+            self.gate = None
+
+    def __len__(self):
+        return len(self.chunks or ()) + (1 if self.skipped else 0)
+
+
+# Socket wrapper used in threaded mode: the client thread keeps reading from the
+# real socket while everything sent to it goes through the queue to a SocketWriter.
+class QueuedSocket:
+    __slots__ = ('socket', 'queue', 'writer', 'pending', 'closing')
+
+    def __init__(self, sock, queue, writer):
+        self.socket = sock
+        self.queue = queue
+        self.writer = writer
+        self.pending = None # buffers of a vectored write that was only partly sent
+        self.closing = False
+
+    def sendall(self, data):
+        if self.closing:
+            return
+        if type(data) is not bytes:
+            data = bytes(data)
+        # bytes are immutable, so a broadcast payload is shared by every queue it is pushed to
+        if self.queue.push(data):
+            self.writer.notify(self)
+        else:
+            self.abort()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def recv(self, size):
+        return self.socket.recv(size)
+
+    def recv_into(self, buffer, size=0):
+        return self.socket.recv_into(buffer, size)
+
+    # the socket is closed by the writer once everything queued has been sent,
+    # shutting down the read side wakes up a client thread blocked in recv
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            try:
+                self.socket.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        self.writer.notify(self)
+
+    # drop the connection now, this also wakes up a thread blocked in recv
+    def abort(self):
+        self.closing = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.writer.notify(self)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def getpeername(self):
+        return self.socket.getpeername()
+
+    def settimeout(self, timeout):
+        self.socket.settimeout(timeout)
+
+
+# what is left of a vectored write after `sent` bytes went out, without copying the buffers
+def unsent_buffers(chunks, sent):
+    for index, chunk in enumerate(chunks):
+        if sent < len(chunk):
+            return [memoryview(chunk)[sent:]] + chunks[index + 1:]
+        sent -= len(chunk)
+    return None
+
+
+# Single thread that drains the queues of every QueuedSocket with non-blocking vectored writes.
+class SocketWriter(threading.Thread):
+    SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+
+    def __init__(self, stats=None):
+        threading.Thread.__init__(self, name='SocketWriter', daemon=True)
+        self.stats = stats if stats is not None else QueueStats()
+        self.selector = selectors.DefaultSelector()
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+        self.wakeupWriter.setblocking(False)
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.ready = set() # sockets with new data or a pending close
+        self.waiting = set() # sockets registered for EVENT_WRITE
+        self.stopped = threading.Event()
+
+    def notify(self, queuedSocket):
+        with self.lock:
+            wake = not self.ready
+            self.ready.add(queuedSocket)
+        if wake:
+            try:
+                self.wakeupWriter.send(b'\0')
+            except (BlockingIOError, OSError):
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        try:
+            self.wakeupWriter.send(b'\0')
+        except OSError:
+            pass
+
+    def run(self):
+        while not self.stopped.is_set():
+            for key, events in self.selector.select(timeout=1):
+                if key.fileobj is self.wakeupReader:
+                    try:
+                        while self.wakeupReader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.flush(key.data)
+
+            with self.lock:
+                ready, self.ready = self.ready, set()
+            for queuedSocket in ready:
+                self.flush(queuedSocket)
+
+    def flush(self, queuedSocket):
+        sock = queuedSocket.socket
+        try:
+            while True:
+                if queuedSocket.pending is None:
+                    chunks = queuedSocket.queue.take()
+                    if not chunks:
+                        break
+                else:
+                    chunks = queuedSocket.pending
+                    queuedSocket.pending = None
+
+                total = sum(len(chunk) for chunk in chunks)
+                sent = sock.sendmsg(chunks, [], self.SEND_FLAGS)
+                self.stats.add(sent=sent)
+                if sent < total:
+                    queuedSocket.pending = unsent_buffers(chunks, sent)
+                    self.wait_writable(queuedSocket)
+                    return
+        except BlockingIOError:
+            queuedSocket.pending = chunks
+            self.wait_writable(queuedSocket)
+            return
+        except OSError:
+            # the peer is gone, nothing queued can be delivered any more
+            queuedSocket.queue.take(maxChunks=len(queuedSocket.queue))
+            queuedSocket.pending = None
+            queuedSocket.closing = True
+
+        self.stop_waiting(queuedSocket)
+        if queuedSocket.closing:
+            sock.close()
+
+    def wait_writable(self, queuedSocket):
+        if queuedSocket not in self.waiting:
+            self.waiting.add(queuedSocket)
+            self.selector.register(queuedSocket.socket, selectors.EVENT_WRITE, queuedSocket)
+
+    def stop_waiting(self, queuedSocket):
+        if queuedSocket in self.waiting:
+            self.waiting.discard(queuedSocket)
+            try:
+                self.selector.unregister(queuedSocket.socket)
+            except (KeyError, ValueError):
+                pass
@@ -0,0 +1,250 @@
+# Compact binary protocol, negotiated per connection on top of the text protocol.
+#
+# A client that speaks it sends "/protocol binary 1" as its first message, before
+# its username, in the framing the server was started with. The server answers
+# "/protocol binary 1\n" as text if it agrees, or "/protocol text\n", and in the
+# first case both directions use frames from the next byte on:
+#
+#   length (4 bytes) | type (1 byte) | channel id (4 bytes) | sender id (4 bytes) | payload
+#
+# all big-endian, the length counting everything after itself. Channel and user
+# names are interned to ids by the server. It sends a CHANNEL or NAME frame the
+# first time a connection needs an id, and ids are never reused, so a client only
+# keeps two dicts and never parses text to find out what happened. Replies to
+# commands and notices such as "... has joined the channel" still come as TEXT
+# frames meant to be shown as they are, the member lists are kept from the JOIN,
+# PART and MEMBERS frames only. A CHAT or NOTICE frame with channel id 0 was sent
+# to this connection alone by /privmsg or /notice. A client sends CHAT, COMMAND and
+# CONTROL frames with both ids 0, chat lines go to its current channel as in text mode.
+#
+# Options follow the version in the offer, the server echoes the ones it accepts:
+# with "deflate" it may set the COMPRESSED bit of the type and send the payload
+# deflated, see Compression.py. Either side may send compressed frames then.
+import struct
+import threading
+import Compression
+
+VERSION = 1
+NEGOTIATE = '/protocol'
+OFFER = '{0} binary {1}'.format(NEGOTIATE, VERSION) # sent by the client, and back by the server if it agrees
+REFUSAL = NEGOTIATE + ' text'
+DEFLATE = 'deflate'
+
+HEADER = struct.Struct('!IBII') # length, type, channel id, sender id
+MEMBER = struct.Struct('!I')
+
+TEXT = 0 # server: something to show as it is
+CHAT = 1 # server: a chat line of sender in channel, client: a chat line
+COMMAND = 2 # client: a command line
+JOIN = 3 # server: sender joined channel
+PART = 4 # server: sender left channel, or you did when sender is yourself
+MEMBERS = 5 # server: the ids of the members of channel, 4 bytes each, after you joined it
+NAME = 6 # server: the username behind the sender id
+CHANNEL = 7 # server: the name behind the channel id
+CONTROL = 8 # both: /ping, /pong, /quit and /squit
+NOTICE = 9 # server: a /notice of sender, nothing should answer it automatically
+COMPRESSED = 0x80 # flag in the type, the payload is deflated
+
+
+def encode_frame(kind, channel=0, sender=0, payload=b''):
+    return HEADER.pack(HEADER.size - 4 + len(payload), kind, channel, sender) + payload
+
+
+def text_frame(data, deflater=None):
+    deflated = deflater.compress(data) if deflater is not None else None
+    if deflated is not None:
+        return encode_frame(TEXT | COMPRESSED, 0, 0, deflated)
+    return encode_frame(TEXT, 0, 0, bytes(data))
+
+
+# the frame with its payload deflated, or the frame itself if that does not pay off
+def compress_frame(frame, deflater):
+    if len(frame) - HEADER.size < deflater.threshold:
+        return frame
+    length, kind, channel, sender = HEADER.unpack_from(frame)
+    deflated = deflater.compress(frame[HEADER.size:])
+    if deflated is None:
+        return frame
+    return encode_frame(kind | COMPRESSED, channel, sender, deflated)
+
+
+def make_offer(options=()):
+    return ' '.join((OFFER,) + tuple(options))
+
+
+# the options of an offer (or of the server's answer to it), None if it is not an offer of this version
+def parse_offer(text):
+    tokens = text.split()
+    if tokens[:3] != OFFER.split():
+        return None
+    return tokens[3:]
+
+
+# what a client sends for a line it would send in text mode
+def encode_client_message(text):
+    return encode_frame(COMMAND if text.lstrip().startswith('/') else CHAT, 0, 0, text.encode('utf8'))
+
+
+# Names handed out as ids, shared by all connections of a server.
+class Interner:
+    def __init__(self, names=()):
+        self.lock = threading.Lock()
+        self.names = [''] # id -> name, 0 means none
+        self.ids = {}
+        for name in names[1:]:
+            self.intern(name)
+
+    def intern(self, name):
+        nameId = self.ids.get(name)
+        if nameId is None:
+            with self.lock:
+                nameId = self.ids.get(name)
+                if nameId is None:
+                    nameId = self.ids[name] = len(self.names)
+                    self.names.append(name)
+        return nameId
+
+    def name(self, nameId):
+        return self.names[nameId] if 0 < nameId < len(self.names) else None
+
+
+# The ids a connection in binary mode was told about, and whether it takes compressed frames.
+class Session:
+    __slots__ = ('names', 'channels', 'compress')
+
+    def __init__(self, names=(), channels=(), compress=False):
+        self.names = set(names)
+        self.channels = set(channels)
+        self.compress = compress
+
+
+# Replaces the socket of a connection once it switched to binary: every reply that is
+# sent as bytes becomes a TEXT frame, typed frames go through send_frame unchanged.
+# Everything else is the wrapped socket's.
+class FramedSocket:
+    __slots__ = ('wrapped', 'deflater')
+
+    # deflater compresses the replies that are long enough, None leaves them alone
+    def __init__(self, wrapped, deflater=None):
+        object.__setattr__(self, 'wrapped', wrapped)
+        object.__setattr__(self, 'deflater', deflater)
+        wrapped.queue.framer = text_frame # the notice about dropped messages of the coalesce policy
+
+    def sendall(self, data):
+        self.wrapped.sendall(text_frame(data, self.deflater))
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def send_frame(self, frame):
+        self.wrapped.sendall(frame)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.wrapped, name, value)
+
+
+# Splits the byte stream of a connection into frames, with the interface of the
+# decoders in Framing.py so the server reads binary connections the same way.
+class FrameDecoder:
+    __slots__ = ('buffer', 'maxLength', 'dropped', 'skip', 'data', 'consumed')
+
+    def __init__(self, maxLength):
+        self.buffer = bytearray() # the start of a frame that has not arrived completely
+        self.maxLength = maxLength # longest payload
+        self.dropped = 0
+        self.skip = 0 # bytes still to be skipped from a frame that was too long
+        self.data = b'' # the read being split
+        self.consumed = 0 # bytes at the start of data that were already handed out
+
+    # yields (type, channel id, sender id, payload bytes), the frames are cut straight out of the read
+    def frames(self, data):
+        if self.buffer:
+            self.buffer += data
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        elif type(data) is not bytes:
+            data = bytes(data) # a view of the receive buffer, that is reused by the next read
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            data = data[skipped:]
+            self.skip -= skipped
+
+        self.data = data
+        self.consumed = offset = 0
+        size = len(data)
+        headerSize = HEADER.size
+        unpack = HEADER.unpack_from
+        try:
+            while size - offset >= headerSize:
+                length, kind, channel, sender = unpack(data, offset)
+                end = offset + 4 + length
+                if length < headerSize - 4 or length - headerSize + 4 > self.maxLength:
+                    self.dropped += 1
+                    if end > size:
+                        self.skip = end - size
+                        offset = size
+                        break
+                    offset = end
+                    continue
+                if end > size:
+                    break
+                payload = data[offset + headerSize:end]
+                offset = self.consumed = end
+                if kind & COMPRESSED:
+                    payload = Compression.inflate(payload, self.maxLength)
+                    if payload is None:
+                        self.dropped += 1
+                        continue
+                    kind &= ~COMPRESSED
+                yield kind, channel, sender, payload
+        finally:
+            self.buffer += data[offset:]
+            self.data = b''
+            self.consumed = 0
+
+    # what the server reads: the text of chat, command and control frames
+    def feed(self, data):
+        for kind, channel, sender, payload in self.frames(data):
+            if kind == CHAT or kind == COMMAND or kind == CONTROL:
+                yield payload.decode('utf8', errors='replace')
+
+    def pending(self):
+        return bytes(self.buffer) + self.data[self.consumed:]
+
+
+# The client side: turns frames into events and keeps the names and members they refer to.
+class ClientState:
+    def __init__(self, username=None):
+        self.username = username # our own, a PART of it means we left the channel
+        self.names = {} # sender id -> username
+        self.channels = {} # channel id -> channel name
+        self.members = {} # channel name -> set of usernames
+
+    # returns (type, channel name, username, text); text is None for JOIN, PART and MEMBERS,
+    # which update self.members, and for NAME and CHANNEL, which update the ids
+    def apply(self, kind, channel, sender, payload):
+        if kind == CHAT:
+            return kind, self.channels.get(channel), self.names.get(sender), payload.decode('utf8', errors='replace')
+        if kind == NAME:
+            self.names[sender] = payload.decode('utf8', errors='replace')
+            return kind, None, self.names[sender], None
+        if kind == CHANNEL:
+            self.channels[channel] = payload.decode('utf8', errors='replace')
+            return kind, self.channels[channel], None, None
+        channelName = self.channels.get(channel)
+        username = self.names.get(sender)
+        if kind == MEMBERS:
+            self.members[channelName] = {self.names.get(memberId) for (memberId,) in MEMBER.iter_unpack(payload)}
+        elif kind == JOIN:
+            self.members.setdefault(channelName, set()).add(username)
+        elif kind == PART and username == self.username:
+            self.members.pop(channelName, None)
+        elif kind == PART:
+            self.members.get(channelName, set()).discard(username)
+        else:
+            return kind, channelName, username, payload.decode('utf8', errors='replace')
+        return kind, channelName, username, None
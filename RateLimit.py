@@ -0,0 +1,165 @@
+# Token bucket rate limits for what clients send.
+#
+# Every message passes two buckets of its connection: the one for the whole
+# connection and the one for its command class (chat lines, cheap commands, and
+# heavy commands that build large replies). Chat lines also pass the bucket of
+# their channel, shared by all its members, and new connections can be limited
+# per source address. Each check is a few float operations, no matter how many
+# users or channels there are.
+#
+# A connection that runs out of tokens collects penalty points, which drain at
+# PENALTY_DECAY points per second. A few points only delay the connection (it is
+# not read and the rest of its last read waits until a token is available), more
+# points drop its messages and at disconnectPenalty points it is disconnected.
+import threading
+import time
+
+# name -> (tokens per second, bucket size), a rate of 0 turns the limit off
+DEFAULT_LIMITS = {
+    'connection': (50, 100), # every message of a connection
+    'chat': (10, 20), # chat lines
+    'command': (20, 40), # commands
+    'heavy': (1, 5), # commands with large replies
+    'channel': (200, 400), # chat lines into one channel, from all its members together
+    'accept': (0, 0), # new connections per source address
+}
+HEAVY_COMMANDS = frozenset(('/users', '/list', '/who', '/stats', '/info', '/connect', '/restart', '/search'))
+CHAT_COMMANDS = frozenset(('/privmsg', '/notice')) # commands that carry a chat line, they count as chat
+DELAY_PENALTY = 5 # penalty points from which messages are dropped instead of delayed
+DISCONNECT_PENALTY = 20 # penalty points from which the connection is closed
+PENALTY_DECAY = 0.2 # penalty points forgiven per second, slower than a delay so a steady flood escalates
+MAX_DELAY = 1.0 # longest a connection is not read for at a time
+MAX_ADDRESSES = 10000 # source addresses tracked before idle ones are forgotten
+MAX_CHANNELS = 10000 # channels tracked before idle ones are forgotten
+
+ADMIT = 'admit'
+DELAY = 'delay'
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now):
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return True
+        self.tokens = tokens
+        return False
+
+    # seconds until the next token
+    def wait(self):
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+# The buckets and penalty of one connection, only touched by the thread that reads it.
+class ConnectionLimits:
+    __slots__ = ('connection', 'classes', 'penalty', 'penaltyStamp', 'warned', 'deferred')
+
+    def __init__(self, connection, classes):
+        self.connection = connection
+        self.classes = classes # command class -> TokenBucket, made when the class is first used
+        self.penalty = 0.0
+        self.penaltyStamp = 0.0
+        self.warned = False # told about dropped messages since the last admitted one
+        self.deferred = None # message waiting for its delay, the rest of its read waits in the decoder
+
+
+def parse_limit(text):
+    name, _, value = text.partition('=')
+    rate, _, burst = value.partition('/')
+    if name not in DEFAULT_LIMITS:
+        raise ValueError("unknown rate limit {0}, expected one of {1}".format(name, ', '.join(DEFAULT_LIMITS)))
+    rate = float(rate)
+    return name, (rate, float(burst) if burst else max(1.0, rate))
+
+
+def classify(chatMessage):
+    if chatMessage[:1] != '/':
+        return 'chat'
+    name = chatMessage.split(None, 1)[0]
+    if name in HEAVY_COMMANDS:
+        return 'heavy'
+    return 'chat' if name in CHAT_COMMANDS else 'command'
+
+
+# a full bucket behaves like a new one, so forgetting it changes nothing
+def forget_idle(buckets, now):
+    for idle in [key for key, value in buckets.items() if value.full(now)]:
+        del buckets[idle]
+
+
+class RateLimiter:
+    def __init__(self, limits=None, delayPenalty=DELAY_PENALTY, disconnectPenalty=DISCONNECT_PENALTY):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.delayPenalty = delayPenalty
+        self.disconnectPenalty = disconnectPenalty
+        self.lock = threading.Lock()
+        self.channels = {} # channel name -> TokenBucket
+        self.addresses = {} # source address -> TokenBucket
+
+    def bucket(self, name, now):
+        rate, burst = self.limits[name]
+        return TokenBucket(rate, burst, now) if rate > 0 else None
+
+    def for_connection(self):
+        return ConnectionLimits(self.bucket('connection', time.monotonic()), {})
+
+    # returns (action, seconds to delay) for the next message of a connection
+    def check(self, limits, chatMessage):
+        now = time.monotonic()
+        kind = classify(chatMessage)
+        try:
+            bucket = limits.classes[kind]
+        except KeyError:
+            # an unused bucket would be full by now anyway, so idle connections go without them
+            bucket = limits.classes[kind] = self.bucket(kind, now)
+        if (bucket is None or bucket.take(now)) and (limits.connection is None or limits.connection.take(now)):
+            limits.warned = False
+            return ADMIT, 0
+
+        penalty = max(0.0, limits.penalty - (now - limits.penaltyStamp) * PENALTY_DECAY) + 1
+        limits.penalty, limits.penaltyStamp = penalty, now
+        if penalty >= self.disconnectPenalty:
+            return DISCONNECT, 0
+        if penalty >= self.delayPenalty:
+            return DROP, 0
+        empty = bucket if bucket is not None and bucket.tokens < 1 else limits.connection
+        return DELAY, min(MAX_DELAY, empty.wait())
+
+    def admit_channel(self, channelName):
+        if self.limits['channel'][0] <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.channels.get(channelName)
+            if bucket is None:
+                if len(self.channels) >= MAX_CHANNELS:
+                    forget_idle(self.channels, now)
+                bucket = self.channels[channelName] = self.bucket('channel', now)
+            return bucket.take(now)
+
+    def admit_address(self, address):
+        if self.limits['accept'][0] <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.addresses.get(address)
+            if bucket is None:
+                if len(self.addresses) >= MAX_ADDRESSES:
+                    forget_idle(self.addresses, now)
+                bucket = self.addresses[address] = self.bucket('accept', now)
+            return bucket.take(now)
@@ -0,0 +1,62 @@
+# Ready-to-send responses for the informational commands (/list, /users, /info, ...).
+#
+# The server keeps a generation counter for every part of its state a response can
+# depend on ('channels', 'users', 'links', ...) and bumps it on every change. A cached
+# response remembers the generations it was built from and is rebuilt only when one
+# of them moved on, so a flood of /list or /users costs a dict lookup and a send.
+import threading
+
+PAGE_SIZE = 100 # entries per page of a long /list or /users reply
+
+
+class ResponseCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generations = {} # state name -> generation counter
+        self.entries = {} # key -> (generations it was built from, value)
+
+    def bump(self, *names):
+        with self.lock:
+            for name in names:
+                self.generations[name] = self.generations.get(name, 0) + 1
+
+    def generation(self, name):
+        return self.generations.get(name, 0)
+
+    # returns the cached value for key, calling build() again if any of `depends` changed since it was built
+    def get(self, key, depends, build):
+        current = tuple(self.generations.get(name, 0) for name in depends)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == current:
+            return entry[1]
+        value = build()
+        self.entries[key] = (current, value)
+        return value
+
+
+# splits `entries` (strings) into encoded pages, the header goes on top of every page
+def paginate(header, entries, command, footer='\n', pageSize=PAGE_SIZE):
+    pageCount = max(1, (len(entries) + pageSize - 1) // pageSize)
+    pages = []
+    for index in range(pageCount):
+        text = header + ''.join(entries[index * pageSize:(index + 1) * pageSize]) + footer
+        if pageCount > 1:
+            text += "\n> Page {0} of {1}".format(index + 1, pageCount)
+            if index + 1 < pageCount:
+                text += ", type {0} {1} for more".format(command, index + 2)
+            text += "\n"
+        pages.append(text.encode('utf8'))
+    return pages
+
+
+# the page number asked for in e.g. '/list 3', pages count from 1
+def page_number(parsedCommand):
+    if parsedCommand.args and parsedCommand.args[0].isdigit():
+        return max(1, int(parsedCommand.args[0]))
+    return 1
+
+
+def select_page(pages, number):
+    if number > len(pages):
+        return "\n> There are only {0} page(s)\n".format(len(pages)).encode('utf8')
+    return pages[number - 1]
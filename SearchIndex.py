@@ -0,0 +1,544 @@
+# Full-text search over what is said in the channels (/search, --search).
+#
+# Every chat line that is broadcast goes into an inverted index: its words, its
+# channel ('#' + name) and its author ('@' + username) are terms, and every term
+# maps to the ids of the messages that contain it. Ids are handed out in order,
+# so every postings list is sorted and the newest matches come first.
+#
+# New messages go into an in-memory segment. Once it holds segmentDocuments
+# messages it is frozen and a background thread writes it out as an immutable
+# segment, a file read through mmap with --search-dir, an encoded buffer in
+# memory without it. Whenever MERGE_FACTOR segments of the same level have piled
+# up the thread merges them into one of the next level, so a query visits a
+# logarithmic number of segments.
+#
+# A segment is a header followed by its sections, in native byte order. They
+# are written in one pass, so the tables come after what they point into:
+#
+#   times           f64 per message, ascending, a time range is found by bisection
+#   records         channel and author length (u16 each), channel, author, text
+#   recordOffsets   u64 per record and one past the last
+#   postings        per term and block of BLOCK_SIZE ids: the first id of every
+#                   block (u32), the offset (u32) and byte width of its gaps, then
+#                   the gaps between the ids of each block packed at that width
+#   terms           the terms sorted as UTF-8 bytes, searched by bisection in place
+#   termOffsets     u64 per term and one past the last
+#   postingOffsets  u64 per term, where its list starts
+#   postingCounts   u32 per term, the number of ids in its list
+#
+# Packing the gaps of a block at one width keeps the list of a common word at
+# about a byte per message and decodes a block with array() and accumulate() in
+# C instead of a Python loop over variable length integers. Queries intersect
+# the lists newest first by leapfrogging: each list jumps straight to the block
+# that can hold the next candidate, so a rare word in a busy channel only
+# decodes the blocks it lands in.
+#
+# A clean shutdown and /restart write the in-memory segment out, a crash loses
+# the messages in it.
+import array
+import bisect
+import heapq
+import io
+import itertools
+import mmap
+import operator
+import os
+import re
+import struct
+import threading
+import time
+import ChannelLog
+
+SEGMENT_DOCUMENTS = 65536 # messages in the in-memory segment before it is written out
+MERGE_FACTOR = 8 # segments of one level that are merged into one of the next level
+BLOCK_SIZE = 128 # ids per postings block
+RESULT_LIMIT = 20 # messages /search returns
+
+MAGIC = b'CSIX'
+VERSION = 1
+HEADER = struct.Struct('=4sIIIQQQ8Q') # magic, version, level, padding, base, messages, terms, section offsets
+RECORD_HEADER = struct.Struct('=HH')
+SECTIONS = ('times', 'records', 'recordOffsets', 'postings', 'terms', 'termOffsets', 'postingOffsets', 'postingCounts')
+GAP_TYPES = {1: 'B', 2: 'H', 4: 'I'} # byte width -> array type code
+WORD = re.compile(r'\w+')
+QUERY_TOKEN = re.compile(r'"[^"]*"?|\S+')
+
+
+def words(text):
+    return WORD.findall(text.casefold())
+
+
+def channel_term(name):
+    return '#' + name.casefold()
+
+
+def author_term(name):
+    return '@' + name.casefold()
+
+
+def encode_record(channelName, author, text):
+    channelBytes, authorBytes = channelName.encode('utf8'), author.encode('utf8')
+    return RECORD_HEADER.pack(len(channelBytes), len(authorBytes)) + channelBytes + authorBytes + text.encode('utf8')
+
+
+# (channel, author, text) of an encoded record
+def decode_record(record):
+    channelLength, authorLength = RECORD_HEADER.unpack_from(record)
+    start = RECORD_HEADER.size
+    middle = start + channelLength
+    end = middle + authorLength
+    return str(record[start:middle], 'utf8'), str(record[middle:end], 'utf8'), str(record[end:], 'utf8')
+
+
+# What /search asks for: every term has to match, the phrases have to appear as
+# they are written and the time limits are inclusive.
+class Query:
+    __slots__ = ('terms', 'phrases', 'since', 'until')
+
+    def __init__(self):
+        self.terms = [] # words, channel and author terms, no duplicates
+        self.phrases = [] # lists of two or more words that must follow each other
+        self.since = None
+        self.until = None
+
+    def add_term(self, term):
+        if term not in self.terms:
+            self.terms.append(term)
+
+
+# 'words "a phrase" from:name since:hh:mm until:hh:mm', raises ValueError naming what is wrong
+def parse_query(text, channelName=None):
+    query = Query()
+    if channelName is not None:
+        query.add_term(channel_term(channelName))
+    for token in QUERY_TOKEN.findall(text):
+        if token[0] == '"':
+            phrase = words(token.strip('"'))
+            for word in phrase:
+                query.add_term(word)
+            if len(phrase) > 1:
+                query.phrases.append(phrase)
+            continue
+        name, separator, value = token.partition(':')
+        if separator and name in ('from', 'since', 'until'):
+            if not value:
+                raise ValueError("{0}: needs a value".format(name))
+            if name == 'from':
+                query.add_term(author_term(value))
+                continue
+            timestamp = ChannelLog.parse_time(value)
+            if timestamp is None:
+                raise ValueError("{0}:{1} is not hh:mm, hh:mm:ss or a unix time".format(name, value))
+            if name == 'since':
+                query.since = timestamp
+            else:
+                query.until = timestamp
+            continue
+        for word in words(token):
+            query.add_term(word)
+    return query
+
+
+def contains_phrase(tokens, phrase):
+    length = len(phrase)
+    return any(tokens[index:index + length] == phrase for index in range(len(tokens) - length + 1))
+
+
+# Postings of the in-memory segment, a growing array of ids.
+class ArrayPostings:
+    __slots__ = ('ids', 'count')
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.count = len(ids)
+
+    # the largest id that is not above doc, -1 if there is none
+    def floor(self, doc):
+        index = bisect.bisect_right(self.ids, doc) - 1
+        return self.ids[index] if index >= 0 else -1
+
+
+# Postings of a written segment, decoded one block at a time.
+class BlockPostings:
+    __slots__ = ('view', 'count', 'firsts', 'offsets', 'widths', 'gapStart', 'block', 'decoded')
+
+    def __init__(self, view, start, count):
+        blocks = (count + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.view = view
+        self.count = count
+        self.firsts = view[start:start + 4 * blocks].cast('I')
+        start += 4 * blocks
+        self.offsets = view[start:start + 4 * blocks].cast('I')
+        start += 4 * blocks
+        self.widths = view[start:start + blocks]
+        self.gapStart = start + blocks
+        self.block = -1
+        self.decoded = None
+
+    def decode(self, block):
+        width = self.widths[block]
+        gapCount = min(BLOCK_SIZE, self.count - block * BLOCK_SIZE) - 1
+        start = self.gapStart + self.offsets[block]
+        gaps = array.array(GAP_TYPES[width])
+        gaps.frombytes(self.view[start:start + width * gapCount])
+        return list(itertools.accumulate(gaps, initial=self.firsts[block]))
+
+    def floor(self, doc):
+        block = bisect.bisect_right(self.firsts, doc) - 1
+        if block < 0:
+            return -1
+        if block != self.block:
+            self.decoded = self.decode(block)
+            self.block = block
+        ids = self.decoded
+        return ids[bisect.bisect_right(ids, doc) - 1]
+
+    def all_ids(self):
+        return list(itertools.chain.from_iterable(self.decode(block) for block in range(len(self.firsts))))
+
+
+def encode_postings(ids):
+    firsts, offsets, widths, gaps = array.array('I'), array.array('I'), bytearray(), bytearray()
+    for start in range(0, len(ids), BLOCK_SIZE):
+        block = ids[start:start + BLOCK_SIZE]
+        deltas = array.array('I', map(operator.sub, block[1:], block[:-1]))
+        widest = max(deltas, default=0)
+        width = 1 if widest < 1 << 8 else 2 if widest < 1 << 16 else 4
+        firsts.append(block[0])
+        offsets.append(len(gaps))
+        widths.append(width)
+        gaps += deltas if width == 4 else array.array(GAP_TYPES[width], deltas)
+    gaps += bytes(-len(gaps) % 4) # the next list starts aligned
+    return b''.join((firsts.tobytes(), offsets.tobytes(), widths, gaps))
+
+
+# The segment new messages go to, the only one that changes.
+class MemorySegment:
+    def __init__(self, base):
+        self.base = base # id of the first message
+        self.level = 0
+        self.times = array.array('d')
+        self.records = []
+        self.postings = {} # term -> array of ids relative to base
+
+    def add(self, timestamp, record, terms):
+        local = len(self.times)
+        for term in terms:
+            ids = self.postings.get(term)
+            if ids is None:
+                ids = self.postings[term] = array.array('I')
+            ids.append(local)
+        self.records.append(record)
+        self.times.append(timestamp) # last, queries only look at the messages counted here
+
+    def __len__(self):
+        return len(self.times)
+
+    def posting_list(self, term):
+        ids = self.postings.get(term)
+        return ArrayPostings(ids) if ids is not None else None
+
+    def record(self, local):
+        return self.records[local]
+
+    # (UTF-8 term, ids) sorted by term, what a written segment is made of
+    def sorted_postings(self):
+        return sorted((term.encode('utf8'), ids) for term, ids in self.postings.items())
+
+    def all_records(self):
+        return self.records
+
+
+# A written segment, over the mmap of its file or over the bytes it was encoded to.
+class Segment:
+    def __init__(self, data, path=None):
+        self.path = path
+        self.view = memoryview(data)
+        magic, version, self.level, _, self.base, self.count, self.termCount, *offsets = HEADER.unpack_from(self.view)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a search index segment")
+        sections = dict(zip(SECTIONS, offsets))
+        count, terms = self.count, self.termCount
+        self.times = self.view[sections['times']:sections['times'] + 8 * count].cast('d')
+        self.recordOffsets = self.view[sections['recordOffsets']:sections['recordOffsets'] + 8 * (count + 1)].cast('Q')
+        self.recordStart = sections['records']
+        self.termOffsets = self.view[sections['termOffsets']:sections['termOffsets'] + 8 * (terms + 1)].cast('Q')
+        self.termStart = sections['terms']
+        self.postingOffsets = self.view[sections['postingOffsets']:sections['postingOffsets'] + 8 * terms].cast('Q')
+        self.postingCounts = self.view[sections['postingCounts']:sections['postingCounts'] + 4 * terms].cast('I')
+
+    def __len__(self):
+        return self.count
+
+    def term(self, index):
+        return bytes(self.view[self.termStart + self.termOffsets[index]:self.termStart + self.termOffsets[index + 1]])
+
+    def posting_list(self, term):
+        key = term.encode('utf8')
+        low, high = 0, self.termCount
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.termCount or self.term(low) != key:
+            return None
+        return BlockPostings(self.view, self.postingOffsets[low], self.postingCounts[low])
+
+    def record(self, local):
+        return self.view[self.recordStart + self.recordOffsets[local]:self.recordStart + self.recordOffsets[local + 1]]
+
+    def sorted_postings(self):
+        for index in range(self.termCount):
+            yield self.term(index), BlockPostings(self.view, self.postingOffsets[index], self.postingCounts[index]).all_ids()
+
+    def all_records(self):
+        return (self.record(local) for local in range(self.count))
+
+
+# writes a segment to out in one pass: times is an array of the message times, records
+# and postings ((UTF-8 term, ids relative to base) sorted by term) can be generators
+def write_segment(out, base, level, times, records, postings):
+    sections = {}
+    position = 0
+
+    def write(data):
+        nonlocal position
+        data = memoryview(data)
+        out.write(data)
+        position += data.nbytes
+
+    def start(name):
+        write(bytes(-position % 8))
+        sections[name] = position
+
+    write(bytes(HEADER.size))
+    start('times')
+    write(times)
+    start('records')
+    recordOffsets = array.array('Q', [0])
+    for record in records:
+        write(record)
+        recordOffsets.append(recordOffsets[-1] + len(record))
+    start('recordOffsets')
+    write(recordOffsets)
+
+    start('postings')
+    terms, postingOffsets, postingCounts = [], array.array('Q'), array.array('I')
+    for term, ids in postings:
+        terms.append(term)
+        postingOffsets.append(position)
+        postingCounts.append(len(ids))
+        write(encode_postings(ids))
+    start('terms')
+    write(b''.join(terms))
+    start('termOffsets')
+    write(array.array('Q', itertools.accumulate(map(len, terms), initial=0)))
+    start('postingOffsets')
+    write(postingOffsets)
+    start('postingCounts')
+    write(postingCounts)
+
+    out.seek(0)
+    out.write(HEADER.pack(MAGIC, VERSION, level, 0, base, len(times), len(terms), *(sections[name] for name in SECTIONS)))
+
+
+# the postings of one segment with its ids made relative to an earlier base
+def shifted_postings(segment, shift):
+    for term, ids in segment.sorted_postings():
+        yield term, ids, shift
+
+
+# the postings of consecutive segments as one list per term, merged as they are read
+def merged_postings(segments):
+    base = segments[0].base
+    streams = [shifted_postings(segment, segment.base - base) for segment in segments]
+    # equal terms come out in the order of the segments, so the ids stay sorted
+    for term, group in itertools.groupby(heapq.merge(*streams, key=operator.itemgetter(0)), operator.itemgetter(0)):
+        ids = array.array('I')
+        for _, segmentIds, shift in group:
+            ids.extend(map(shift.__add__, segmentIds) if shift else segmentIds)
+        yield term, ids
+
+
+def open_segment(path):
+    with open(path, 'rb') as segmentFile:
+        return Segment(mmap.mmap(segmentFile.fileno(), 0, access=mmap.ACCESS_READ), path)
+
+
+class SearchIndex:
+    def __init__(self, directory=None, segmentDocuments=SEGMENT_DOCUMENTS, mergeFactor=MERGE_FACTOR):
+        self.directory = directory # None keeps the written segments in memory
+        self.segmentDocuments = segmentDocuments
+        self.mergeFactor = mergeFactor
+        self.lock = threading.Lock()
+        self.segments = [] # written segments, oldest first, their levels never go up along the list
+        self.frozen = [] # full in-memory segments the thread has not written yet
+        self.lastTime = 0.0
+        self.ready = threading.Event()
+        self.closed = False
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.load()
+        base = self.segments[-1].base + len(self.segments[-1]) if self.segments else 0
+        self.active = MemorySegment(base)
+        self.thread = threading.Thread(target=self.write_loop, name='SearchIndex', daemon=True)
+        self.thread.start()
+
+    def segment_path(self, base):
+        return os.path.join(self.directory, '{0}.seg'.format(base))
+
+    # a merge that was cut short leaves segments behind that the merged one covers
+    def load(self):
+        paths = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                os.unlink(path)
+            elif name.endswith('.seg') and name[:-4].isdigit():
+                paths.append((int(name[:-4]), path))
+        end = 0
+        for base, path in sorted(paths):
+            if base < end:
+                os.unlink(path)
+                continue
+            segment = open_segment(path)
+            self.segments.append(segment)
+            end = segment.base + len(segment)
+            if len(segment):
+                self.lastTime = max(self.lastTime, segment.times[-1])
+
+    def add(self, channelName, author, text):
+        if self.closed:
+            return
+        terms = set(words(text))
+        terms.add(channel_term(channelName))
+        terms.add(author_term(author))
+        record = encode_record(channelName, author, text)
+        with self.lock:
+            # keep the times in order so a time range is a range of ids
+            timestamp = self.lastTime = max(time.time(), self.lastTime)
+            self.active.add(timestamp, record, terms)
+            if len(self.active) >= self.segmentDocuments:
+                self.frozen.append(self.active)
+                self.active = MemorySegment(self.active.base + len(self.active))
+                self.ready.set()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(segment) for segment in self.segments + self.frozen) + len(self.active)
+
+    # returns up to limit (time, channel, author, text) that match, newest first;
+    # readable(channelName) can leave out the channels the asking user may not see
+    def search(self, query, limit=RESULT_LIMIT, readable=None):
+        with self.lock:
+            segments = [(segment, len(segment)) for segment in self.segments + self.frozen + [self.active]]
+        results = []
+        for segment, count in reversed(segments):
+            for local in self.matches(segment, count, query):
+                channelName, author, text = decode_record(segment.record(local))
+                if query.phrases:
+                    tokens = words(text)
+                    if not all(contains_phrase(tokens, phrase) for phrase in query.phrases):
+                        continue
+                if readable is not None and not readable(channelName):
+                    continue
+                results.append((segment.times[local], channelName, author, text))
+                if len(results) >= limit:
+                    return results
+        return results
+
+    # ids (relative to the segment) of the messages with every term, newest first
+    def matches(self, segment, count, query):
+        low, high = 0, count
+        if query.since is not None:
+            low = bisect.bisect_left(segment.times, query.since, 0, count)
+        if query.until is not None:
+            high = bisect.bisect_right(segment.times, query.until, 0, count)
+        lists = []
+        for term in query.terms:
+            postings = segment.posting_list(term)
+            if postings is None:
+                return
+            lists.append(postings)
+        if not lists:
+            yield from range(high - 1, low - 1, -1)
+            return
+
+        lists.sort(key=lambda postings: postings.count) # the rarest term proposes the candidates
+        doc = high - 1
+        while doc >= low:
+            for postings in lists:
+                found = postings.floor(doc)
+                if found != doc:
+                    doc = found # no list has anything between found and doc
+                    break
+            else:
+                yield doc
+                doc -= 1
+
+    def write_loop(self):
+        while not self.closed:
+            self.ready.wait()
+            self.ready.clear()
+            self.write_frozen()
+
+    # merging after every segment keeps the levels from going up along the list
+    def write_frozen(self, merge=True):
+        while True:
+            with self.lock:
+                if not self.frozen:
+                    return
+                memorySegment = self.frozen[0]
+            segment = self.write(memorySegment.base, 0, memorySegment.times, memorySegment.all_records(), memorySegment.sorted_postings())
+            with self.lock:
+                self.segments.append(segment)
+                self.frozen.pop(0)
+            if merge:
+                self.merge()
+
+    # merges the newest segments while mergeFactor of them share a level
+    def merge(self):
+        while True:
+            with self.lock:
+                tail = self.segments[-self.mergeFactor:]
+            if len(tail) < self.mergeFactor or any(segment.level != tail[0].level for segment in tail):
+                return
+            times = array.array('d')
+            for segment in tail:
+                times.frombytes(segment.times.cast('B'))
+            records = itertools.chain.from_iterable(segment.all_records() for segment in tail)
+            merged = self.write(tail[0].base, tail[0].level + 1, times, records, merged_postings(tail))
+            with self.lock:
+                self.segments[-len(tail):] = [merged]
+            if self.directory is not None:
+                for segment in tail[1:]:
+                    os.unlink(segment.path) # mapped views of it stay valid until the last query lets go
+
+    def write(self, base, level, times, records, postings):
+        if self.directory is None:
+            out = io.BytesIO()
+            write_segment(out, base, level, times, records, postings)
+            return Segment(out.getbuffer())
+        path = self.segment_path(base)
+        with open(path + '.tmp', 'w+b') as out:
+            write_segment(out, base, level, times, records, postings)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(path + '.tmp', path) # a merge replaces its first segment, open mappings keep the old file
+        return open_segment(path)
+
+    # writes everything out when there is a directory, nothing is indexed afterwards
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        self.thread.join()
+        if self.directory is not None:
+            with self.lock:
+                if len(self.active):
+                    self.frozen.append(self.active)
+                    self.active = MemorySegment(self.active.base + len(self.active))
+            self.write_frozen(merge=False) # merges can wait for the next start
@@ -0,0 +1,252 @@
+# Server-to-server links for /CONNECT.
+#
+# Servers are joined into a tree by persistent TCP links that carry the same JSON
+# line events as the worker bus (see WorkerBus.py). Every event is applied locally
+# and forwarded on all the other links, so it reaches each server exactly once as
+# long as the links form a tree. A link that would close a loop is refused: every
+# server announces the servers behind it and a name that is already reachable
+# through another link ends the new link.
+#
+# Events used only between linked servers:
+#
+#   hello        {origin, password, [compress]}
+#                                          first event on a link, names the peer, compress: 'deflate'
+#                                          if the sender can read a compressed link
+#   server       {origin, name}            `name` is reachable through the sender
+#   server_lost  {origin, name}            `name` is no longer reachable
+#   connect      {origin, target, host, port}
+#                                          asks server `target` to link to host:port
+#   error        {origin, reason}          sent before a link is closed
+#   collide      {origin, target, username, keeper, signon}
+#                                          server `target` drops its user `username`, who lost the
+#                                          name to the user who signed on at `signon` on `keeper`
+#
+# Of the worker bus events a link only carries those in LINK_EVENTS: die and kill
+# stay on the server (and its workers) whose operator sent them.
+#
+# Every server of a tree is started with the same --link-password. A hello without
+# it ends the link before any other event of the peer is looked at, and a server
+# without a password neither accepts links nor opens them.
+#
+# When both ends run with --link-compression, each of them sends a 'compress' event
+# once it has the hello of the other one and deflates everything after it.
+#
+# Nickname collisions: when a user_online event names a user that already exists,
+# the one who signed on first keeps the name and the other one is disconnected.
+# The server of the loser checks the claim against its own user before it does so.
+import hmac
+import socket
+import sys
+import threading
+import WorkerBus
+
+BATCH_INTERVAL = 0.005 # seconds events are collected before they are written to a link
+LINK_EVENTS = frozenset(('user_online', 'user_offline', 'rename', 'nick', 'join', 'part', 'message', 'invite', 'privmsg', 'wallops'))
+
+
+class LinkManager:
+    def __init__(self, server, batchInterval=BATCH_INTERVAL, compression=False, password=None):
+        self.server = server
+        self.batchInterval = batchInterval
+        self.compression = compression # offer and accept compressed links
+        self.password = password # shared by every server of the tree, sent in the hello
+        self.lock = threading.RLock()
+        self.links = [] # EventConnections to the directly linked servers
+        self.routes = {} # server name -> the link it is reachable through
+        self.listenSocket = None
+
+    # listenSocket is the already listening socket handed over by /restart
+    def listen(self, host, port, listenSocket=None):
+        if listenSocket is None:
+            listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listenSocket.bind((host, port))
+        self.listenSocket = listenSocket
+        self.listenSocket.listen(16)
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listenSocket.accept()
+            except OSError:
+                break
+            self.start_link(sock)
+
+    def connect(self, host, port):
+        if self.password is None:
+            raise OSError("no --link-password is set")
+        sock = socket.create_connection((host, port), timeout=5)
+        sock.settimeout(None)
+        return self.start_link(sock)
+
+    def start_link(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = WorkerBus.EventConnection(sock, self.on_event, self.on_close, self.batchInterval)
+        link.peer = None
+        with self.lock:
+            self.links.append(link)
+        link.start()
+        hello = {'type': 'hello', 'origin': self.server.serverId, 'password': self.password or ''}
+        if self.compression:
+            hello['compress'] = 'deflate'
+        link.send(hello)
+        return link
+
+    def close(self):
+        if self.listenSocket is not None:
+            self.listenSocket.close()
+        with self.lock:
+            links = list(self.links)
+        for link in links:
+            link.close()
+
+    # sends an event to every link except the one it came from
+    def forward(self, event, source=None):
+        if event['type'] in ('die', 'kill'):
+            return # /die and /kill only act on this server (and its workers)
+        data = WorkerBus.encode_event(event)
+        with self.lock:
+            targets = [link for link in self.links if link is not source and link.peer is not None]
+        for link in targets:
+            link.send_raw(data)
+
+    def add_route(self, link, name):
+        with self.lock:
+            if name == self.server.serverId or name in self.routes:
+                return False
+            self.routes[name] = link
+        self.server.responses.bump('links')
+        return True
+
+    def accepts(self, password):
+        if self.password is None or not isinstance(password, str):
+            return False
+        return hmac.compare_digest(password.encode('utf8'), self.password.encode('utf8'))
+
+    def refuse(self, link, reason):
+        sys.stderr.write("Closing server link: {0}\n".format(reason))
+        link.write(WorkerBus.encode_event({'type': 'error', 'origin': self.server.serverId, 'reason': reason}))
+        link.close()
+
+    def on_event(self, link, event):
+        kind = event['type']
+
+        if kind == 'hello':
+            if link.peer is not None:
+                return
+            if not self.accepts(event.get('password')):
+                self.refuse(link, "{0} sent a wrong link password".format(event['origin']))
+                return
+            if not self.add_route(link, event['origin']):
+                self.refuse(link, "{0} is already linked".format(event['origin']))
+                return
+            link.peer = event['origin']
+            if self.compression and event.get('compress') == 'deflate':
+                link.start_compression(self.server.compressionStats)
+            self.burst(link)
+            self.forward({'type': 'server', 'origin': self.server.serverId, 'name': link.peer}, link)
+            return
+
+        if link.peer is None:
+            return
+
+        if kind == 'server':
+            if not self.add_route(link, event['name']):
+                self.refuse(link, "linking would create a loop through {0}".format(event['name']))
+                return
+            self.forward(event, link)
+        elif kind == 'server_lost':
+            self.lose_server(event['name'], link)
+        elif kind == 'connect':
+            if event['target'] == self.server.serverId:
+                self.server.call_soon(self.connect_quietly, event['host'], event['port'])
+            else:
+                self.forward(event, link)
+        elif kind == 'error':
+            sys.stderr.write("Server link to {0} refused: {1}\n".format(link.peer, event.get('reason')))
+        elif kind == 'collide':
+            if event['target'] == self.server.serverId:
+                self.server.call_soon(self.drop_collided, event)
+            else:
+                self.forward(event, link)
+        elif kind not in LINK_EVENTS:
+            sys.stderr.write("Ignoring {0} event from server {1}\n".format(kind, link.peer))
+        elif kind == 'user_online' and not self.resolve_collision(link, event):
+            return # lost a nickname collision, its owner was told to drop the user
+        else:
+            self.server.call_soon(self.server.apply_remote_event, event)
+            self.forward(event, link)
+
+    # the user who signed on first keeps a contested name, returns False when the announced user loses
+    def resolve_collision(self, link, event):
+        server = self.server
+        name = event['username']
+        local = server.users.get_by_username(name)
+        if local is not None and local.registered:
+            existing = (local.signon, server.serverId, local.nickname)
+        else:
+            record = server.remote.get_user(name)
+            if record is None or record[0] == event['origin']:
+                return True
+            existing = (record[3], record[0], record[2])
+
+        if (event.get('signon', 0), event['origin']) < existing[:2]:
+            if local is not None and local.registered:
+                server.call_soon(server.disconnect_user, local)
+            return True
+
+        # drop the newcomer and announce the user who keeps the name on that side of the tree again
+        link.send({'type': 'collide', 'origin': server.serverId, 'target': event['origin'], 'username': name, 'keeper': existing[1], 'signon': existing[0]})
+        link.send({'type': 'user_online', 'origin': existing[1], 'username': name, 'nickname': existing[2], 'signon': existing[0]})
+        return False
+
+    # the local user only goes if it really signed on after the one that keeps the name
+    def drop_collided(self, event):
+        server = self.server
+        local = server.users.get_by_username(event['username'])
+        if local is not None and local.registered and (event['signon'], event['keeper']) < (local.signon, server.serverId):
+            server.disconnect_user(local)
+
+    def connect_quietly(self, host, port):
+        try:
+            self.connect(host, port)
+        except OSError as errorMessage:
+            sys.stderr.write("Failed to link to {0}:{1}. Error - {2}\n".format(host, port, errorMessage))
+
+    # sends the new peer everything it needs to know about this side of the tree
+    def burst(self, link):
+        origin = self.server.serverId
+        with self.lock:
+            behindUs = [name for name, route in self.routes.items() if route is not link]
+        for name in behindUs:
+            link.send({'type': 'server', 'origin': origin, 'name': name})
+        for event in self.server.local_burst_events():
+            link.send(event)
+        for event in self.server.remote.burst_events(origins=set(behindUs)):
+            link.send(event)
+
+    def lose_server(self, name, source=None):
+        with self.lock:
+            if self.routes.get(name) is not source:
+                return
+            del self.routes[name]
+        self.server.responses.bump('links')
+        self.server.call_soon(self.server.forget_origin, name)
+        self.forward({'type': 'server_lost', 'origin': self.server.serverId, 'name': name}, source)
+
+    def on_close(self, link):
+        with self.lock:
+            if link in self.links:
+                self.links.remove(link)
+            lost = [name for name, route in self.routes.items() if route is link]
+        for name in lost:
+            self.lose_server(name, link)
+
+    def linked_servers(self):
+        with self.lock:
+            return sorted(self.routes)
+
+    def route_to(self, name):
+        with self.lock:
+            return self.routes.get(name)
@@ -0,0 +1,81 @@
+# The user list of the GUI client, kept apart from the Listbox that shows it.
+#
+# Names are kept sorted in a list, with a set as the hash index, so a join or a
+# leave costs a membership test and a bisect instead of reading the whole Listbox
+# back. Every change is recorded with its position; flush() replays them on the
+# Listbox, or refills it in one call once more than REBUILD_THRESHOLD changes
+# piled up (a /join of a big channel, a reconnect). ChatWindow flushes once per
+# frame, so the joins and leaves that arrive in between are applied as one batch.
+import bisect
+
+REBUILD_THRESHOLD = 64 # pending changes from which the Listbox is refilled instead of patched
+
+
+class UserListModel:
+    def __init__(self):
+        self.names = [] # sorted
+        self.index = set()
+        self.changes = [] # ('insert', position, name) or ('delete', position) since the last flush
+        self.rebuild = False # the Listbox has to be refilled, changes is empty then
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    # both return False when there was nothing to do, a name is never listed twice
+    def add(self, name):
+        if not name or name in self.index:
+            return False
+        position = bisect.bisect_left(self.names, name)
+        self.names.insert(position, name)
+        self.index.add(name)
+        self.record(('insert', position, name))
+        return True
+
+    def remove(self, name):
+        if name not in self.index:
+            return False
+        position = bisect.bisect_left(self.names, name)
+        del self.names[position]
+        self.index.discard(name)
+        self.record(('delete', position))
+        return True
+
+    def update(self, joined=(), left=()):
+        for name in left:
+            self.remove(name)
+        for name in joined:
+            self.add(name)
+
+    def clear(self):
+        self.names = []
+        self.index = set()
+        self.changes = []
+        self.rebuild = True
+
+    def record(self, change):
+        if not self.rebuild:
+            self.changes.append(change)
+            if len(self.changes) > REBUILD_THRESHOLD:
+                self.changes = []
+                self.rebuild = True
+
+    # brings a Listbox (or anything with its insert(index, *items) and delete(first, last)) up to date
+    def flush(self, listbox):
+        if self.rebuild:
+            listbox.delete(0, 'end')
+            if self.names:
+                listbox.insert(0, *self.names)
+        else:
+            for change in self.changes:
+                if change[0] == 'insert':
+                    listbox.insert(change[1], change[2])
+                else:
+                    listbox.delete(change[1])
+        self.changes = []
+        self.rebuild = False
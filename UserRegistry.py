@@ -0,0 +1,195 @@
+# Indexed collection of the users connected to the server.
+#
+# Users are kept in insertion order and indexed by username, nickname and socket
+# file descriptor, so every lookup, add and remove is O(1). Name keys are
+# case-insensitive. Renames check and update the index under a lock so two
+# clients cannot claim the same name at the same time. The member sets of the
+# channels, the lock stripes that guard joins and parts and the slotted record of
+# a connection live here as well.
+import fnmatch
+import functools
+import re
+import sys
+import threading
+
+MASK_CACHE_SIZE = 256 # compiled /who masks kept around
+LOCK_STRIPES = 64 # locks shared out over the users and over the channels of a server
+
+
+def name_key(name):
+    return name.casefold()
+
+
+def is_mask(text):
+    return '*' in text or '?' in text
+
+
+# '*' matches any run of characters and '?' one character, like IRC masks; the
+# compiled patterns are cached so repeated /who queries skip the regex compiler
+@functools.lru_cache(maxsize=MASK_CACHE_SIZE)
+def mask_pattern(mask):
+    return re.compile(fnmatch.translate(mask), re.IGNORECASE)
+
+
+# A fixed pool of locks, a key always gets the same one. Keys that share a lock
+# only wait for each other, so the server needs no lock per channel or user and
+# no global one. A thread may hold one lock of each pool at most, and takes the
+# lock of a user before the one of a channel.
+class LockStripes:
+    __slots__ = ('locks',)
+
+    def __init__(self, count=LOCK_STRIPES):
+        self.locks = tuple(threading.Lock() for _ in range(count))
+
+    def __call__(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+
+# The members of one channel, replaces the list Channel starts with. It keeps the
+# join order and the list methods Channel uses, while membership tests and
+# removals are O(1).
+class MemberSet:
+    __slots__ = ('members', 'snapshot', 'lock')
+
+    def __init__(self, users=()):
+        self.members = dict.fromkeys(users)
+        self.snapshot = None # tuple of the members, made on the first iteration after a change
+        self.lock = threading.Lock()
+
+    def append(self, user):
+        with self.lock:
+            self.members[user] = None
+            self.snapshot = None
+
+    def remove(self, user):
+        with self.lock:
+            try:
+                del self.members[user]
+            except KeyError:
+                raise ValueError("user is not a member")
+            self.snapshot = None
+
+    def discard(self, user):
+        with self.lock:
+            if self.members.pop(user, self) is not self:
+                self.snapshot = None
+
+    def __contains__(self, user):
+        return user in self.members
+
+    def __iter__(self):
+        # members can join and leave while a broadcast walks the channel, so it walks a
+        # snapshot; broadcasts between two changes share it instead of copying the members
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshot
+                if snapshot is None:
+                    snapshot = self.snapshot = tuple(self.members)
+        return iter(snapshot)
+
+    def __len__(self):
+        return len(self.members)
+
+
+# The record of one connection: the attributes of User.User and the ones the server
+# keeps per connection, all in slots. It does not derive from User.User, a base
+# without __slots__ would give every connection an attribute dict again.
+class ConnectedUser:
+    __slots__ = ('socket', 'username', 'password', 'nickname', 'usertype', 'status', 'realname',
+                 'registered', 'channel', 'decoder', 'session', 'limits', 'keepalive', 'signon', 'resume')
+
+    def __init__(self, socket, username='', password='', nickname='', usertype='', status='', realname=''):
+        self.socket = socket
+        self.username = username
+        self.password = password
+        self.nickname = nickname
+        self.usertype = usertype
+        self.status = status
+        self.realname = realname
+
+
+class UserRegistry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.all = {} # User -> None, a dict keeps insertion order and removes in O(1)
+        self.by_username = {} # casefolded username -> User
+        self.by_nickname = {} # casefolded nickname -> User
+        self.by_fd = {} # socket file descriptor -> User
+        self.fds = {} # User -> file descriptor it was registered under
+
+    def add(self, user):
+        with self.lock:
+            self.all[user] = None
+            try:
+                fd = user.socket.fileno()
+            except (OSError, AttributeError):
+                fd = -1
+            if fd >= 0:
+                self.by_fd[fd] = user
+                self.fds[user] = fd
+            if user.username:
+                self.by_username[name_key(user.username)] = user
+            if user.nickname:
+                self.by_nickname[name_key(user.nickname)] = user
+
+    def remove(self, user):
+        with self.lock:
+            if user not in self.all:
+                return False
+            del self.all[user]
+            fd = self.fds.pop(user, None)
+            if fd is not None and self.by_fd.get(fd) is user:
+                del self.by_fd[fd]
+            self._unindex(self.by_username, user.username, user)
+            self._unindex(self.by_nickname, user.nickname, user)
+            return True
+
+    def _unindex(self, index, name, user):
+        if name:
+            key = name_key(name)
+            if index.get(key) is user:
+                del index[key]
+
+    # usernames and nicknames share one namespace, so a nickname can never stand in for someone else's username
+    def _rename(self, index, other, attribute, user, newName):
+        newName = sys.intern(newName) # the name is repeated in events, channel logs and replies
+        key = name_key(newName)
+        with self.lock:
+            for owner in (index.get(key), other.get(key)):
+                if owner is not None and owner is not user:
+                    return False
+            self._unindex(index, getattr(user, attribute), user)
+            setattr(user, attribute, newName)
+            if user in self.all:
+                index[key] = user
+            return True
+
+    # both return False without changing anything when the name is someone else's username or nickname
+    def rename_username(self, user, newName):
+        return self._rename(self.by_username, self.by_nickname, 'username', user, newName)
+
+    def rename_nickname(self, user, newName):
+        return self._rename(self.by_nickname, self.by_username, 'nickname', user, newName)
+
+    def get_by_username(self, name):
+        return self.by_username.get(name_key(name))
+
+    def get_by_nickname(self, name):
+        return self.by_nickname.get(name_key(name))
+
+    def get_by_fd(self, fd):
+        return self.by_fd.get(fd)
+
+    def has_username(self, name):
+        return name_key(name) in self.by_username
+
+    def __contains__(self, user):
+        return user in self.all
+
+    def __iter__(self):
+        # iterate over a snapshot so that users can leave while we walk the list
+        return iter(list(self.all))
+
+    def __len__(self):
+        return len(self.all)
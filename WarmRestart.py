@@ -0,0 +1,350 @@
+# /RESTART without dropping a connection.
+#
+# The running server starts a new copy of itself and hands everything over on a
+# Unix socket pair:
+#
+#   1. old: stops reading from the clients and accepting (asyncio: lets the transports flush),
+#           threaded mode closes the outbound queues, so whatever is sent to a client from
+#           then on waits and nothing is queued after the queue was taken for the snapshot
+#   2. old: sends the snapshot (channels, topics, modes, users, whatever is still
+#           queued for or received from each client), then the listening socket
+#           and every client socket as SCM_RIGHTS ancillary data
+#   3. new: rebuilds the state and answers 'ok'
+#   4. old: sends the input that arrived while the snapshot was on its way and the
+#           connections accepted in the meantime, then exits without closing them
+#   5. new: resumes every session and starts serving
+#
+# The snapshot is compact JSON compressed with zlib, prefixed with its length. If
+# the new process fails before step 4, the old one simply carries on serving.
+#
+# Only the local clients are carried over. The --link-port listener is handed over,
+# but the links to other servers, in either direction, are closed with the old
+# process, and the users and memberships they announced are forgotten. Links that
+# this server opened with /connect have to be opened again, the peers forget the
+# users of this server as for any lost link, and both sides exchange their users
+# anew once linked.
+import asyncio
+import base64
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+import ChannelLog
+import ChatEventLoop
+import Framing
+import Protocol
+import SearchIndex
+import OutboundQueue
+import UserRegistry
+
+SNAPSHOT_VERSION = 1
+HANDOVER_TIMEOUT = 10 # seconds the new process gets to take over
+DRAIN_TIMEOUT = 0.5 # seconds the asyncio transports get to flush, their buffers can not be handed over
+FDS_PER_MESSAGE = 200 # file descriptors per SCM_RIGHTS message, the kernel allows 253
+LENGTH = struct.Struct('!I')
+
+
+def encode_bytes(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode_bytes(text):
+    return base64.b64decode(text)
+
+
+def send_message(sock, message, fds=()):
+    data = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf8'))
+    sock.sendall(LENGTH.pack(len(data)) + data + LENGTH.pack(len(fds)))
+    for start in range(0, len(fds), FDS_PER_MESSAGE):
+        socket.send_fds(sock, [b'F'], fds[start:start + FDS_PER_MESSAGE])
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("the other server went away during the handover")
+        data += chunk
+    return bytes(data)
+
+
+# returns the message and the sockets that came with it
+def receive_message(sock):
+    (length,) = LENGTH.unpack(receive_exactly(sock, LENGTH.size))
+    message = json.loads(zlib.decompress(receive_exactly(sock, length)))
+    (count,) = LENGTH.unpack(receive_exactly(sock, LENGTH.size))
+    fds = []
+    while len(fds) < count:
+        data, received, flags, address = socket.recv_fds(sock, 1, FDS_PER_MESSAGE)
+        if not data:
+            raise ConnectionError("the other server went away during the handover")
+        fds.extend(received)
+    return message, [socket.socket(fileno=fd) for fd in fds]
+
+
+def raw_socket(user):
+    wrapped = user.socket
+    if hasattr(wrapped, 'transport'):
+        return wrapped.transport.get_extra_info('socket')
+    return wrapped.socket
+
+
+def snapshot(server, users, carried):
+    channels = []
+    positions = {user: index for index, user in enumerate(users)}
+    for channel in list(server.channels.values()):
+        members = [positions[user] for user in channel.users if user in positions]
+        channels.append({'name': channel.channel_name, 'topic': channel.topic, 'mode': channel.mode, 'modes': sorted(channel.modes), 'members': members, 'invited': sorted(channel.invited),
+                         'creator': positions.get(channel.creator)})
+    records = []
+    for user in users:
+        output, pendingInput = carried.get(user, (b'', b''))
+        pendingInput = user.decoder.pending() + pendingInput
+        if user.limits.deferred is not None:
+            # held back by the rate limits, it comes before the rest of its read that still waits in the decoder
+            if user.session is None:
+                pendingInput = Framing.encode_message(server.framing, user.limits.deferred) + pendingInput
+            else:
+                pendingInput = Protocol.encode_client_message(user.limits.deferred) + pendingInput
+        session = user.session
+        records.append({'username': user.username, 'nickname': user.nickname, 'password': user.password, 'usertype': user.usertype,
+                        'status': user.status, 'realname': user.realname, 'registered': user.registered, 'signon': getattr(user, 'signon', 0), 'channel': user.channel,
+                        'output': encode_bytes(output), 'input': encode_bytes(pendingInput),
+                        'protocol': Protocol.VERSION if session is not None else 0,
+                        'knownNames': sorted(session.names) if session is not None else [],
+                        'knownChannels': sorted(session.channels) if session is not None else [],
+                        'compress': session is not None and session.compress})
+    return {'version': SNAPSHOT_VERSION, 'serverId': server.serverId, 'channels': channels, 'users': records,
+            'userIds': server.userIds.names, 'channelIds': server.channelIds.names,
+            'linkListener': server.links.listenSocket is not None}
+
+
+# Old side of a restart, created by /restart and gone with the process once it succeeded.
+class Handover:
+    def __init__(self, server, command):
+        self.server = server
+        self.command = command # argv of the new process
+        self.lock = threading.Lock()
+        self.held = {} # User -> bytes read by a client thread after the handover started
+        self.accepted = [] # sockets accepted after the handover started
+        self.resumed = threading.Event()
+        self.process = None
+        self.channel = None
+        self.listenSocket = server.serverSocket
+
+    # called by a client thread with the bytes it just read, returns them again if the restart failed
+    def hold(self, user, data):
+        with self.lock:
+            self.held[user] = self.held.get(user, b'') + bytes(data)
+        self.resumed.wait() # a successful restart never wakes us up, the process exits
+        with self.lock:
+            return self.held.pop(user, b'')
+
+    def accept(self, clientSocket):
+        with self.lock:
+            self.accepted.append(clientSocket)
+
+    def spawn(self):
+        self.channel, childEnd = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.process = subprocess.Popen(self.command + ['--restore-fd', str(childEnd.fileno())], pass_fds=[childEnd.fileno()])
+        childEnd.close()
+        self.channel.settimeout(HANDOVER_TIMEOUT)
+
+    def send_state(self, users, carried):
+        server = self.server
+        with self.lock:
+            for user, data in self.held.items():
+                output, pendingInput = carried.get(user, (b'', b''))
+                carried[user] = (output, pendingInput + data)
+            self.held.clear()
+        fds = [raw_socket(user).fileno() for user in users]
+        listeners = [self.listenSocket.fileno()]
+        if server.links.listenSocket is not None:
+            listeners.append(server.links.listenSocket.fileno())
+        send_message(self.channel, snapshot(server, users, carried), listeners + fds)
+        if receive_exactly(self.channel, 2) != b'ok':
+            raise ConnectionError("the new server did not take over")
+
+        # nobody reads or accepts any more: what arrived since the snapshot goes last
+        with self.lock:
+            positions = {user: index for index, user in enumerate(users)}
+            late = {str(positions[user]): encode_bytes(data) for user, data in self.held.items() if user in positions}
+            accepted = [sock.fileno() for sock in self.accepted]
+            send_message(self.channel, {'input': late}, accepted)
+        sys.stdout.flush()
+        os._exit(0) # the connections live on in the new process, they must not be shut down here
+
+    # the new server reads the logs and the search segments back, an index kept in memory is not handed over
+    def close_log(self):
+        log = self.server.channelLog
+        if log is not None:
+            log.close()
+        index = self.server.searchIndex
+        if index is not None and index.directory is not None:
+            index.close()
+
+    def reopen_log(self):
+        log = self.server.channelLog
+        if log is not None and log.closed:
+            self.server.channelLog = ChannelLog.ChannelLog(log.directory, log.segmentSize, log.fsyncInterval, log.retainSegments, log.maxOpenJournals)
+        index = self.server.searchIndex
+        if index is not None and index.closed:
+            self.server.searchIndex = SearchIndex.SearchIndex(index.directory, index.segmentDocuments, index.mergeFactor)
+
+    def abandon(self, error):
+        sys.stderr.write("Restart failed, carrying on. Error - {0}\n".format(error))
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+        if self.channel is not None:
+            self.channel.close()
+        self.reopen_log()
+        self.server.handover = None
+
+    # whatever could not be sent before the handover goes out again after a failed restart, and the
+    # reads send_state() took from the held input go back to the client threads waiting in hold()
+    def requeue(self, carried):
+        for user in self.server.users:
+            output, pendingInput = carried.get(user, (b'', b''))
+            if pendingInput:
+                with self.lock:
+                    self.held[user] = pendingInput + self.held.get(user, b'')
+            if output:
+                if user.session is None:
+                    user.socket.sendall(output)
+                else:
+                    user.socket.send_frame(output) # framed already
+
+    # threaded mode, runs on the client thread of the user who asked for the restart
+    def run(self):
+        server = self.server
+        carried = {}
+        try:
+            self.spawn()
+            # no need to wait for the queues to drain, whatever is still in them moves along with the snapshot
+            writer = server.socketWriter
+            writer.stop()
+            writer.join()
+
+            users = list(server.users)
+            for user in users:
+                # client, keepalive and link threads that send to the user from now on wait for the outcome
+                user.socket.queue.close(self.resumed)
+                chunks = list(user.socket.pending or []) + user.socket.queue.take(maxChunks=len(user.socket.queue) + 1)
+                user.socket.pending = None
+                carried[user] = (b''.join(bytes(chunk) for chunk in chunks), b'')
+            self.close_log()
+            self.send_state(users, carried)
+        except (OSError, ValueError) as error:
+            self.abandon(error)
+            if not server.socketWriter.is_alive():
+                server.socketWriter = OutboundQueue.SocketWriter(server.outboundStats)
+                server.socketWriter.start()
+                for user in server.users:
+                    user.socket.writer = server.socketWriter
+            for user in server.users:
+                user.socket.queue.reopen()
+            self.requeue(carried)
+            self.resumed.set()
+            with self.lock:
+                accepted, self.accepted = self.accepted, []
+            for clientSocket in accepted:
+                server.accept_client(clientSocket)
+
+    # asyncio mode, runs as a task on the event loop
+    async def run_async(self):
+        server = self.server
+        loop = asyncio.get_running_loop()
+        users = list(server.users)
+        for user in users:
+            user.socket.transport.pause_reading()
+        # closing the asyncio server stops accepting and closes its socket, the copy goes to the new process
+        self.listenSocket = server.serverSocket.dup()
+        server.listener.close()
+        carried = {}
+        try:
+            self.spawn()
+            deadline = time.time() + DRAIN_TIMEOUT
+            while time.time() < deadline and any(user.socket.transport.get_write_buffer_size() or len(user.socket.queue) for user in users):
+                await asyncio.sleep(0.01)
+
+            users = [user for user in server.users if not user.socket.transport.is_closing()]
+            for user in users:
+                carried[user] = (b''.join(user.socket.queue.take(maxChunks=len(user.socket.queue) + 1)), b'')
+            self.close_log()
+            await loop.run_in_executor(None, self.send_state, users, carried)
+        except (OSError, ValueError) as error:
+            self.abandon(error)
+            server.serverSocket = self.listenSocket
+            server.listener = await loop.create_server(lambda: ChatEventLoop.ClientProtocol(server), sock=self.listenSocket)
+            self.requeue(carried)
+            for user in server.users:
+                # connections with a deferred message resume once it was handled
+                if not user.socket.transport.is_closing() and user.limits.deferred is None:
+                    user.socket.transport.resume_reading()
+
+
+# New side, first step: the snapshot, the listening sockets and the client sockets
+# sent by the old process. The listening sockets are needed to create the Server.
+def receive_state(fd):
+    channel = socket.socket(fileno=fd)
+    state, sockets = receive_message(channel)
+    if state.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("unknown snapshot version {0}".format(state.get('version')))
+    listenerCount = 2 if state['linkListener'] else 1
+    return state, sockets[:listenerCount], sockets[listenerCount:], channel
+
+
+# Second step: rebuilds the channels and users. Every restored user gets a `resume`
+# attribute (output still to send, input still to process) that Server.resume_user
+# consumes once the connection is served again.
+def restore(server, state, clientSockets, channel):
+    # the ids of the binary protocol stay the same, clients in binary mode keep using them
+    server.userIds = Protocol.Interner(state.get('userIds', ()))
+    server.channelIds = Protocol.Interner(state.get('channelIds', ()))
+    users = []
+    for record, clientSocket in zip(state['users'], clientSockets):
+        user = UserRegistry.ConnectedUser(clientSocket, record['username'], record['password'], record['nickname'], record['usertype'], record['status'], record['realname'])
+        user.registered = record['registered']
+        user.signon = record['signon']
+        user.channel = record.get('channel')
+        if record.get('protocol'):
+            compress = record.get('compress', False) and server.deflater is not None
+            user.session = Protocol.Session(record['knownNames'], record['knownChannels'], compress)
+            user.decoder = Protocol.FrameDecoder(server.maxMessageLength)
+        else:
+            user.session = None
+            user.decoder = Framing.create_decoder(server.framing, server.maxMessageLength)
+        user.limits = server.rateLimiter.for_connection()
+        server.keepalive.watch(user)
+        user.resume = (decode_bytes(record['output']), decode_bytes(record['input']))
+        server.users.add(user)
+        if user.usertype == 'operator':
+            server.operators.append(user)
+        users.append(user)
+
+    for record in state['channels']:
+        restored = server.get_channel(record['name'])
+        restored.topic = record['topic']
+        restored.mode = record['mode']
+        restored.modes = set(record.get('modes', ()))
+        restored.invited.update(record.get('invited', ()))
+        if record.get('creator') is not None:
+            restored.creator = users[record['creator']]
+        for index in record['members']:
+            server.add_membership(users[index], restored)
+    server.responses.bump('users', 'channels')
+
+    channel.sendall(b'ok')
+    final, accepted = receive_message(channel)
+    for index, data in final['input'].items():
+        output, pendingInput = users[int(index)].resume
+        users[int(index)].resume = (output, pendingInput + decode_bytes(data))
+    server.adopted = accepted
+    channel.close()
+    print("Resumed {0} connection(s) and {1} channel(s)\n".format(len(users), len(server.channels)))
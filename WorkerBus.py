@@ -0,0 +1,409 @@
+# Multi-process mode: N worker processes accept on the same port (SO_REUSEPORT) and
+# share users, channel membership and channel messages through a local bus.
+#
+# The parent process runs a BusHub on a Unix socket. Every worker connects to it and
+# publishes events about its own users; the hub keeps the global state and relays
+# every event to the other workers. Events are JSON objects, one per line:
+#
+#   hello        {origin}                          first event of every connection
+#   user_online  {origin, username, nickname, signon}
+#   user_offline {origin, username}
+#   rename       {origin, username, new}           /setname
+#   nick         {origin, username, nickname}      /nick
+#   join         {origin, username, channel}       a user joins a channel, it stays in the others
+#   part         {origin, username, channel}       /part
+#   invite       {origin, username, channel, by}   /invite, the owner of `username` delivers it
+#   message      {origin, channel, payload, username, text}
+#                                                  a line broadcast to a channel, `username` and `text`
+#                                                  are its author and words for typed frames and /search
+#   kill         {origin, username}                asks the worker that owns a user to remove it
+#   privmsg      {origin, from, targets, text, notice}
+#                                                  /privmsg or /notice, the owners of the usernames in `targets` deliver it
+#   wallops      {origin, from, text}              /wallops, every server tells its operators
+#   die          {origin}                          /die, every worker shuts down
+#   compress     {}                                everything after it on the connection is deflated
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import Compression
+import Framing
+
+MAX_EVENT_LENGTH = 1 << 24
+
+
+def encode_event(event):
+    return (json.dumps(event, separators=(',', ':')) + '\n').encode('utf8')
+
+
+# JSON line events over a stream socket, read by a background thread. With a
+# batchInterval the events sent within that many seconds go out in one write.
+# After a 'compress' event the rest of what a side sends is one deflate stream.
+class EventConnection:
+    def __init__(self, sock, onEvent, onClose=None, batchInterval=0):
+        self.socket = sock
+        self.onEvent = onEvent # onEvent(connection, event)
+        self.onClose = onClose # onClose(connection)
+        self.origin = None # set from the hello event
+        self.sendLock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.read_loop, daemon=True)
+        self.batchInterval = batchInterval
+        self.batch = []
+        self.batchReady = threading.Event()
+        self.compressor = None # Compression.StreamCompressor once start_compression was called
+        if batchInterval:
+            self.flushThread = threading.Thread(target=self.flush_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        if self.batchInterval:
+            self.flushThread.start()
+        return self
+
+    def send(self, event):
+        self.send_raw(encode_event(event))
+
+    def send_raw(self, data):
+        if self.batchInterval:
+            with self.sendLock:
+                self.batch.append(data)
+            self.batchReady.set()
+            return
+        self.write(data)
+
+    def write(self, data):
+        with self.sendLock:
+            self.write_locked(data)
+
+    def write_locked(self, data):
+        try:
+            if self.compressor is not None:
+                data = self.compressor.compress(data)
+            self.socket.sendall(data)
+        except OSError:
+            self.close()
+
+    def flush_loop(self):
+        while not self.closed:
+            self.batchReady.wait()
+            time.sleep(self.batchInterval) # let more events pile up
+            # the batch is written under the lock, so nothing can overtake it
+            with self.sendLock:
+                batch, self.batch = self.batch, []
+                self.batchReady.clear()
+                if batch:
+                    self.write_locked(b''.join(batch))
+
+    # everything sent from now on is compressed, the peer has to support it
+    def start_compression(self, stats):
+        with self.sendLock:
+            batch, self.batch = self.batch, []
+            batch.append(encode_event({'type': 'compress'}))
+            self.write_locked(b''.join(batch))
+            self.compressor = Compression.StreamCompressor(stats)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.batchReady.set()
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def read_loop(self):
+        decoder = Framing.LineDecoder(MAX_EVENT_LENGTH)
+        decompressor = None
+        try:
+            while True:
+                data = self.socket.recv(Framing.RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                if decompressor is not None:
+                    # never more than one event's worth at a time, the decoder drops longer lines
+                    data = decompressor.decompress(data, MAX_EVENT_LENGTH)
+                while data:
+                    rest = b''
+                    for line in decoder.feed(data):
+                        event = json.loads(line)
+                        if event.get('type') == 'compress':
+                            # the peer compresses the rest, including what came along with this event
+                            decompressor = Compression.new_stream_decompressor()
+                            rest = decompressor.decompress(decoder.pending(), MAX_EVENT_LENGTH)
+                            decoder = Framing.LineDecoder(MAX_EVENT_LENGTH)
+                            break
+                        if event.get('type') == 'hello':
+                            self.origin = event['origin']
+                        self.onEvent(self, event)
+                    else:
+                        if decompressor is not None and decompressor.unconsumed_tail:
+                            rest = decompressor.decompress(decompressor.unconsumed_tail, MAX_EVENT_LENGTH)
+                    data = rest
+        except (OSError, ValueError, zlib.error):
+            pass
+        finally:
+            self.closed = True
+            self.socket.close()
+            if self.onClose is not None:
+                self.onClose(self)
+
+
+# What one node knows about the users and channel members that live elsewhere.
+class RemoteState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {} # casefolded username -> [origin, username, nickname, signon time]
+        self.members = {} # channel name -> set of casefolded usernames
+        self.user_channels = {} # casefolded username -> set of channel names
+        self.nicknames = {} # casefolded nickname -> casefolded username
+
+    def apply(self, event):
+        kind = event['type']
+        with self.lock:
+            if kind == 'user_online':
+                key = event['username'].casefold()
+                old = self.users.get(key)
+                if old is not None:
+                    self._unindex(key, old[2])
+                self.users[key] = [event['origin'], event['username'], event.get('nickname', ''), event.get('signon', 0)]
+                self._index(key, self.users[key][2])
+            elif kind == 'user_offline':
+                key = event['username'].casefold()
+                record = self.users.get(key)
+                # a user that lost a name collision must not take the winner's record with it
+                if record is not None and record[0] == event['origin']:
+                    self._forget(key)
+            elif kind == 'rename':
+                old = event['username'].casefold()
+                record = self.users.pop(old, None)
+                if record is not None:
+                    record[1] = event['new']
+                    self._unindex(old, record[2])
+                    self.users[event['new'].casefold()] = record
+                    self._index(event['new'].casefold(), record[2])
+                    channels = self.user_channels.pop(old, None)
+                    if channels is not None:
+                        for channel in channels:
+                            self.members[channel].discard(old)
+                            self.members[channel].add(event['new'].casefold())
+                        self.user_channels[event['new'].casefold()] = channels
+            elif kind == 'nick':
+                key = event['username'].casefold()
+                record = self.users.get(key)
+                if record is not None:
+                    self._unindex(key, record[2])
+                    record[2] = event['nickname']
+                    self._index(key, record[2])
+            elif kind == 'join':
+                key = event['username'].casefold()
+                self.members.setdefault(event['channel'], set()).add(key)
+                self.user_channels.setdefault(key, set()).add(event['channel'])
+            elif kind == 'part':
+                self._part(event['username'].casefold(), event['channel'])
+
+    def _index(self, key, nickname):
+        if nickname:
+            self.nicknames[nickname.casefold()] = key
+
+    # only drops the entry if it still points at this user
+    def _unindex(self, key, nickname):
+        if nickname and self.nicknames.get(nickname.casefold()) == key:
+            del self.nicknames[nickname.casefold()]
+
+    def _part(self, key, channel):
+        channels = self.user_channels.get(key)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.user_channels[key]
+        members = self.members.get(channel)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self.members[channel]
+
+    # O(number of channels the user is in)
+    def _forget(self, key):
+        for channel in list(self.user_channels.get(key, ())):
+            self._part(key, channel)
+        record = self.users.pop(key, None)
+        if record is not None:
+            self._unindex(key, record[2])
+
+    # removes everything owned by a node that went away, returns the usernames it had
+    def drop_origin(self, origin):
+        with self.lock:
+            gone = [record[1] for record in self.users.values() if record[0] == origin]
+            for username in gone:
+                self._forget(username.casefold())
+            return gone
+
+    def has_user(self, name):
+        return name.casefold() in self.users
+
+    def has_nickname(self, name):
+        return self.get_by_nickname(name) is not None
+
+    # a remote user has it as username or nickname
+    def name_taken(self, name):
+        return self.has_user(name) or self.has_nickname(name)
+
+    def get_user(self, name):
+        return self.users.get(name.casefold())
+
+    def get_by_nickname(self, name):
+        with self.lock:
+            key = self.nicknames.get(name.casefold())
+            record = self.users.get(key) if key is not None else None
+            return tuple(record) if record is not None else None
+
+    def channels_of(self, name):
+        with self.lock:
+            return sorted(self.user_channels.get(name.casefold(), ()))
+
+    # [origin, username, nickname, signon] of the remote members of a channel
+    def channel_members(self, channel):
+        with self.lock:
+            return [tuple(self.users[key]) for key in self.members.get(channel, ()) if key in self.users]
+
+    def channel_counts(self):
+        with self.lock:
+            return {channel: len(members) for channel, members in self.members.items()}
+
+    def user_records(self):
+        with self.lock:
+            return [tuple(record) for record in self.users.values()]
+
+    # events that recreate this state on a node that just connected, optionally only for some origins
+    def burst_events(self, exclude=None, origins=None):
+        with self.lock:
+            events = []
+            for key, (origin, username, nickname, signon) in self.users.items():
+                if origin == exclude or (origins is not None and origin not in origins):
+                    continue
+                events.append({'type': 'user_online', 'origin': origin, 'username': username, 'nickname': nickname, 'signon': signon})
+                for channel in self.user_channels.get(key, ()):
+                    events.append({'type': 'join', 'origin': origin, 'username': username, 'channel': channel})
+            return events
+
+
+# Runs in the parent process and relays events between the workers.
+class BusHub:
+    def __init__(self, path):
+        self.path = path
+        self.state = RemoteState()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.listenSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listenSocket.bind(path)
+        self.listenSocket.listen(64)
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.listenSocket.accept()
+            except OSError:
+                break
+            connection = EventConnection(sock, self.on_event, self.on_close)
+            with self.lock:
+                self.connections.append(connection)
+            connection.start()
+
+    def on_event(self, connection, event):
+        if event['type'] == 'hello':
+            for burstEvent in self.state.burst_events(exclude=connection.origin):
+                connection.send(burstEvent)
+            return
+        if event['type'] in ('user_online', 'user_offline', 'rename', 'nick', 'join', 'part'):
+            self.state.apply(event)
+        self.relay(event, connection)
+
+    def relay(self, event, source):
+        data = encode_event(event)
+        with self.lock:
+            targets = [c for c in self.connections if c is not source]
+        for target in targets:
+            target.send_raw(data)
+
+    def on_close(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        if connection.origin is not None:
+            for username in self.state.drop_origin(connection.origin):
+                self.relay({'type': 'user_offline', 'origin': connection.origin, 'username': username}, connection)
+
+    def close(self):
+        self.listenSocket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+# Worker side of the bus: publishes the events of the local server and applies the remote ones.
+class BusClient:
+    def __init__(self, server, path):
+        self.server = server
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.connection = EventConnection(sock, self.on_event, self.on_close)
+
+    def start(self):
+        self.connection.start()
+        self.connection.send({'type': 'hello', 'origin': self.server.serverId})
+        return self
+
+    def publish(self, event):
+        self.connection.send(event)
+
+    def on_event(self, connection, event):
+        self.server.call_soon(self.server.apply_remote_event, event)
+
+    def on_close(self, connection):
+        sys.stderr.write("Lost the connection to the worker bus\n")
+
+
+def strip_option(argv, option):
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + '='):
+            stripped.append(arg)
+    return stripped
+
+
+# starts the hub and `workers` copies of this server, every one of them started with `argv` plus its worker id
+def run_workers(workers, argv, script):
+    path = os.path.join(tempfile.mkdtemp(prefix='chatbus-'), 'bus.sock')
+    hub = BusHub(path).start()
+    processes = [subprocess.Popen([sys.executable, script] + argv + ['--worker-id', str(i), '--bus', path]) for i in range(workers)]
+
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
+    finally:
+        hub.close()
+        os.rmdir(os.path.dirname(path))
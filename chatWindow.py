@@ -3,9 +3,16 @@ from tkinter import messagebox
 import ChatClient as client
 import BaseDialog as dialog
 import BaseEntry as entry
+import ClientEvents
+import UserListModel
 import threading
 import argparse
 import configparser
+import queue
+
+FRAME_MS = 16 # the queue from the socket thread is drained about once per frame
+MAX_BATCH = 2000 # messages rendered per frame at most, the rest wait for the next frame
+SCROLLBACK_LINES = 5000 # lines kept in the chat window, older ones are trimmed
 
 
 class mem: pass
@@ -20,33 +27,44 @@ class SocketThreadedTask(threading.Thread):
     def run(self):
         while True:
             try:
-                message = self.socket.receive()
-
-                if message == '/quit':
-                    self.callbacks['clear_chat_window']()
-                    self.callbacks['update_chat_window']('\n> You have been disconnected from the server.\n')
-                    self.socket.disconnect()
-                    break
-                elif message == '/squit':
-                    self.callbacks['clear_chat_window']()
-                    self.callbacks['update_chat_window']('\n> The server was forcibly shutdown. No further messages are able to be sent\n')
-                    self.socket.disconnect()
-                    break
-                elif 'joined' in message:
-                    split_message = message.split('|')
-                    self.callbacks['clear_chat_window']()
-                    self.callbacks['update_chat_window'](split_message[0])
-                    self.callbacks['update_user_list'](split_message[1])
-                elif 'left' in message:
-                    self.callbacks['update_chat_window'](message)
-                    self.callbacks['remove_user_from_list'](message.split(' ')[2])
-                # response to ping request and a /pong command is sent back
-                elif '/pong' in message:
-                    self.callbacks['update_chat_window']('The server is running\n')
-                else:
-                    self.callbacks['update_chat_window'](message)
+                messages = ClientEvents.split(self.socket.receive())
             except OSError:
                 break
+            if not all(self.handle(message) for message in messages):
+                break
+
+    # returns False once the server ended the session or the connection failed
+    def handle(self, message):
+        kind, value = ClientEvents.interpret(message)
+        try:
+            if kind == ClientEvents.QUIT:
+                self.callbacks['clear_chat_window']()
+                self.callbacks['update_chat_window']('\n> You have been disconnected from the server.\n')
+                self.socket.disconnect()
+                return False
+            elif kind == ClientEvents.SQUIT:
+                self.callbacks['clear_chat_window']()
+                self.callbacks['update_chat_window']('\n> The server was forcibly shutdown. No further messages are able to be sent\n')
+                self.socket.disconnect()
+                return False
+            elif kind == ClientEvents.JOINED:
+                self.callbacks['clear_chat_window']()
+                self.callbacks['update_chat_window'](value[0])
+                self.callbacks['update_user_list'](' '.join(value[1]))
+            elif kind == ClientEvents.LEFT:
+                self.callbacks['update_chat_window'](value[0])
+                self.callbacks['remove_user_from_list'](value[1])
+            # keepalive from the server, it disconnects clients that do not answer
+            elif kind == ClientEvents.PING:
+                self.socket.send('/pong')
+            # response to ping request and a /pong command is sent back
+            elif kind == ClientEvents.PONG:
+                self.callbacks['update_chat_window']('The server is running\n')
+            else:
+                self.callbacks['update_chat_window'](message)
+        except OSError:
+            return False
+        return True
 
 class ChatDialog(dialog.BaseDialog): # need to pass the value of local host and port number
     def body(self, master):
@@ -81,7 +99,13 @@ class ChatWindow(tk.Frame):
     def __init__(self, parent):
         tk.Frame.__init__(self, parent)
 
+        # Tk is not thread safe: the socket thread only queues (callback, args) and the
+        # main loop renders them in batches, all chat text of a batch in one insert
+        self.pending = queue.SimpleQueue()
+        # the users of the channel, the Listbox is brought up to date once per batch
+        self.userList = UserListModel.UserListModel()
         self.initUI(parent)
+        self.after(FRAME_MS, self.drain)
 
     def initUI(self, parent):
         self.messageTextArea = tk.Text(parent, bg="white smoke", state=tk.DISABLED, wrap=tk.WORD)
@@ -101,22 +125,56 @@ class ChatWindow(tk.Frame):
         self.send_message_button = tk.Button(parent, text="Send", width=10, bg="#CACACA", activebackground="#CACACA")
         self.send_message_button.grid(row=1, column=1, padx=5, sticky="we")
 
+    # callbacks for SocketThreadedTask that can be called from the socket thread
+    def socket_callbacks(self):
+        return {'update_chat_window': lambda message: self.post(self.update_chat_window, message),
+                'update_user_list': lambda message: self.post(self.update_user_list, message),
+                'clear_chat_window': lambda: self.post(self.clear_chat_window),
+                'remove_user_from_list': lambda user: self.post(self.remove_user_from_list, user)}
+
+    def post(self, callback, *args):
+        self.pending.put((callback, args))
+
+    # runs on the Tk main loop every FRAME_MS, consecutive chat messages become one insert
+    def drain(self):
+        text = []
+        try:
+            for _ in range(MAX_BATCH):
+                callback, args = self.pending.get_nowait()
+                if callback == self.update_chat_window:
+                    text.append(args[0])
+                    continue
+                if text:
+                    self.update_chat_window(''.join(text))
+                    text = []
+                callback(*args)
+        except queue.Empty:
+            pass
+        if text:
+            self.update_chat_window(''.join(text))
+        self.userList.flush(self.usersListBox)
+        self.after(FRAME_MS, self.drain)
+
     def update_chat_window(self, message):
+        following = self.messageTextArea.yview()[1] >= 1.0 # only scroll along if the user is at the bottom
         self.messageTextArea.configure(state='normal')
         self.messageTextArea.insert(tk.END, message)
+        self.trim_scrollback()
         self.messageTextArea.configure(state='disabled')
+        if following:
+            self.messageTextArea.see(tk.END)
 
-    def update_user_list(self, user_message):
-        users = user_message.split(' ')
+    def trim_scrollback(self):
+        lines = int(self.messageTextArea.index('end-1c').split('.')[0])
+        if lines > SCROLLBACK_LINES:
+            self.messageTextArea.delete('1.0', '{0}.0'.format(lines - SCROLLBACK_LINES + 1))
 
-        for user in users:
-            if user not in self.usersListBox.get(0, tk.END):
-                self.usersListBox.insert(tk.END, user)
+    def update_user_list(self, user_message):
+        for user in user_message.split(' '):
+            self.userList.add(user.strip())
 
     def remove_user_from_list(self, user):
-        print(user)
-        index = self.usersListBox.get(0, tk.END).index(user)
-        self.usersListBox.delete(index)
+        self.userList.remove(user.strip())
 
     def clear_chat_window(self):
         if not self.messageTextArea.compare("end-1c", "==", "1.0"):
@@ -124,8 +182,7 @@ class ChatWindow(tk.Frame):
             self.messageTextArea.delete('1.0', tk.END)
             self.messageTextArea.configure(state='disabled')
 
-        if self.usersListBox.size() > 0:
-            self.usersListBox.delete(0, tk.END)
+        self.userList.clear()
 
     def send_message(self, **callbacks):
         message = self.entryField.get()
@@ -203,10 +260,7 @@ class ChatGUI(tk.Frame):
 
                 if self.clientSocket.isClientConnected:
                     self.ChatWindow.clear_chat_window()
-                    SocketThreadedTask(self.clientSocket, update_chat_window=self.ChatWindow.update_chat_window,
-                                       update_user_list=self.ChatWindow.update_user_list,
-                                       clear_chat_window=self.ChatWindow.clear_chat_window,
-                                       remove_user_from_list=self.ChatWindow.remove_user_from_list, ).start()
+                    SocketThreadedTask(self.clientSocket, **self.ChatWindow.socket_callbacks()).start()
                     return
                 else:
                     tk.messagebox.showwarning("Error", "Unable to connect to the server.")
@@ -217,10 +271,7 @@ class ChatGUI(tk.Frame):
 
             if self.clientSocket.isClientConnected:
                 self.ChatWindow.clear_chat_window()
-                SocketThreadedTask(self.clientSocket, update_chat_window=self.ChatWindow.update_chat_window,
-                                                      update_user_list=self.ChatWindow.update_user_list,
-                                                      clear_chat_window=self.ChatWindow.clear_chat_window,
-                                                      remove_user_from_list=self.ChatWindow.remove_user_from_list,).start()
+                SocketThreadedTask(self.clientSocket, **self.ChatWindow.socket_callbacks()).start()
             else:
                 tk.messagebox.showwarning("Error", "Unable to connect to the server.")
 #
@@ -0,0 +1,27 @@
+# The modules live at the top of the repository, next to ChatServer.py.
+#
+#   python -m pytest tests
+#
+# Tests that need a Server skip themselves when Channel, User and Util, which come
+# with the chat client and not with this repository, can not be imported.
+import itertools
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# a Server that never listens, its users are added with fake sockets
+@pytest.fixture
+def server():
+    pytest.importorskip('Channel')
+    import ChatServer
+    chatServer = ChatServer.Server('127.0.0.1', 0)
+    chatServer.serverSocket.close()
+    return chatServer
+
+
+@pytest.fixture
+def fds():
+    return itertools.count(100)
@@ -0,0 +1,78 @@
+import struct
+import pytest
+import Framing
+
+
+def feed_all(decoder, chunks):
+    messages = []
+    for chunk in chunks:
+        messages.extend(decoder.feed(chunk))
+    return messages
+
+
+def test_line_decoder_joins_partial_reads():
+    decoder = Framing.LineDecoder()
+    assert feed_all(decoder, [b'hel', b'lo\nwor', b'ld\r', b'\n']) == ['hello', 'world']
+    assert decoder.pending() == b''
+
+
+def test_line_decoder_splits_coalesced_reads():
+    decoder = Framing.LineDecoder()
+    assert list(decoder.feed(b'one\ntwo\r\nthree')) == ['one', 'two']
+    assert decoder.pending() == b'three'
+    assert list(decoder.feed(b'\n')) == ['three']
+
+
+def test_line_decoder_drops_overlong_lines_only():
+    decoder = Framing.LineDecoder(maxLength=8)
+    assert feed_all(decoder, [b'x' * 6, b'x' * 6, b'x' * 6, b'\nshort\n']) == ['short']
+    assert decoder.dropped == 1
+    # the buffer never holds more than one line's worth of a line that is too long
+    assert len(decoder.buffer) == 0
+
+
+def test_line_decoder_keeps_characters_split_across_reads():
+    encoded = 'grüße\n'.encode('utf8')
+    decoder = Framing.LineDecoder()
+    assert feed_all(decoder, [encoded[:3], encoded[3:]]) == ['grüße']
+
+
+def test_length_decoder_waits_for_the_whole_message():
+    data = Framing.encode_length_prefixed('hello') + Framing.encode_length_prefixed('again')
+    decoder = Framing.LengthPrefixDecoder()
+    assert feed_all(decoder, [data[:2], data[2:7], data[7:]]) == ['hello', 'again']
+    assert decoder.pending() == b''
+
+
+def test_length_decoder_skips_oversized_messages_across_reads():
+    decoder = Framing.LengthPrefixDecoder(maxLength=4)
+    oversized = struct.pack('!I', 10) + b'0123456789'
+    messages = feed_all(decoder, [oversized[:6], oversized[6:], Framing.encode_length_prefixed('ok')])
+    assert messages == ['ok']
+    assert decoder.dropped == 1
+
+
+def test_raw_decoder_keeps_characters_split_across_reads():
+    encoded = 'grüße'.encode('utf8')
+    decoder = Framing.RawDecoder()
+    assert feed_all(decoder, [encoded[:3], encoded[3:]]) == ['gr', 'üße']
+    assert decoder.pending() == b''
+
+
+def test_raw_decoder_pending_restores_a_split_character():
+    encoded = 'ü'.encode('utf8')
+    decoder = Framing.RawDecoder()
+    assert feed_all(decoder, [encoded[:1]]) == []
+    restored = Framing.RawDecoder()
+    assert feed_all(restored, [decoder.pending(), encoded[1:]]) == ['ü']
+
+
+@pytest.mark.parametrize('framing', sorted(Framing.DECODERS))
+def test_encode_message_round_trips(framing):
+    decoder = Framing.create_decoder(framing)
+    assert list(decoder.feed(Framing.encode_message(framing, '/join lobby'))) == ['/join lobby']
+
+
+def test_unknown_framing_is_rejected():
+    with pytest.raises(ValueError):
+        Framing.create_decoder('morse')
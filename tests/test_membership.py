@@ -0,0 +1,78 @@
+import random
+import threading
+import Commands
+from Benchmarks import FakeSocket
+
+
+def new_user(server, fds, name=None):
+    user = server.add_user(FakeSocket(next(fds)))
+    server.users.rename_username(user, name or 'user{0}'.format(user.socket.fd))
+    user.registered = True
+    return user
+
+
+# both directions of the membership index agree and only name users that are connected
+def assert_consistent(server):
+    for name, channel in list(server.channels.items()):
+        for member in channel.users:
+            assert member in server.users, (name, member.username)
+            assert name in server.users_channels_map.get(member, ()), (name, member.username)
+    for user, joined in server.users_channels_map.items():
+        assert user in server.users, user.username
+        for name in joined:
+            assert user in server.channels[name].users, (name, user.username)
+
+
+def test_join_part_and_disconnect(server, fds):
+    alice = new_user(server, fds, 'alice')
+    bob = new_user(server, fds, 'bob')
+    server.join(alice, Commands.parse('/join #one'))
+    server.join(alice, Commands.parse('/join #two'))
+    server.join(bob, Commands.parse('/join #one'))
+    assert set(server.users_channels_map[alice]) == {'#one', '#two'}
+    assert list(server.channels['#one'].users) == [alice, bob]
+
+    server.part(alice, Commands.parse('/part #one'))
+    assert alice not in server.channels['#one'].users
+    assert set(server.users_channels_map[alice]) == {'#two'}
+
+    server.disconnect_user(alice)
+    assert alice not in server.channels['#two'].users
+    assert alice not in server.users_channels_map
+    assert_consistent(server)
+
+
+def test_membership_stays_consistent_under_churn(server, fds, threads=8, operations=2000, population=100):
+    names = ['#churn{0}'.format(index) for index in range(6)]
+    people = [new_user(server, fds) for _ in range(population)]
+    errors = []
+
+    def worker(seed):
+        generator = random.Random(seed)
+        try:
+            for _ in range(operations):
+                index = generator.randrange(len(people))
+                user = people[index]
+                action = generator.random()
+                if action < 0.4:
+                    server.join(user, Commands.parse('/join ' + generator.choice(names)))
+                elif action < 0.7:
+                    server.part(user, Commands.parse('/part ' + generator.choice(names)))
+                elif action < 0.95:
+                    server.send_message(user, 'hello\n')
+                else:
+                    server.disconnect_user(user)
+                    people[index] = new_user(server, fds)
+        except Exception as error:
+            errors.append(error)
+
+    workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    assert errors == []
+    assert_consistent(server)
+    # two threads may replace the same person, so there can be more users than people
+    assert all(user in server.users for user in people)
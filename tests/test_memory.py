@@ -0,0 +1,21 @@
+import pytest
+import Benchmarks
+import OutboundQueue
+import UserRegistry
+from Benchmarks import FakeSocket
+
+
+def test_connection_records_have_no_attribute_dict():
+    user = UserRegistry.ConnectedUser(FakeSocket(10), username='alice')
+    assert not hasattr(user, '__dict__')
+    with pytest.raises(AttributeError):
+        user.anything = 1
+
+
+def test_idle_connection_stays_within_the_memory_budget():
+    pytest.importorskip('Channel')
+    perConnection, server, users, growth = Benchmarks.measure_connection_memory(200)
+    assert len(server.users) == len(users)
+    assert all(user.registered for user in users)
+    assert all(not hasattr(user, '__dict__') and isinstance(user.socket, OutboundQueue.QueuedSocket) for user in users)
+    assert perConnection <= Benchmarks.MEMORY_BUDGET
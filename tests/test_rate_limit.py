@@ -0,0 +1,97 @@
+import types
+import pytest
+import RateLimit
+
+
+# a clock for RateLimit that only moves when a test says so
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(RateLimit, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_classify():
+    assert RateLimit.classify('hello') == 'chat'
+    assert RateLimit.classify('/privmsg bob hi') == 'chat'
+    assert RateLimit.classify('/ping') == 'command'
+    assert RateLimit.classify('/users') == 'heavy'
+
+
+def test_parse_limit():
+    assert RateLimit.parse_limit('chat=5/10') == ('chat', (5.0, 10.0))
+    assert RateLimit.parse_limit('chat=5') == ('chat', (5.0, 5.0))
+    assert RateLimit.parse_limit('chat=0') == ('chat', (0.0, 1.0))
+    with pytest.raises(ValueError):
+        RateLimit.parse_limit('typing=5')
+
+
+def test_burst_then_delay(clock):
+    limiter = RateLimit.RateLimiter({'chat': (2, 3), 'connection': (0, 0)})
+    limits = limiter.for_connection()
+    for _ in range(3):
+        assert limiter.check(limits, 'hello') == (RateLimit.ADMIT, 0)
+    action, delay = limiter.check(limits, 'hello')
+    assert action == RateLimit.DELAY
+    assert delay == pytest.approx(0.5)
+    clock[0] += delay
+    assert limiter.check(limits, 'hello') == (RateLimit.ADMIT, 0)
+
+
+def test_a_flood_escalates_to_drop_and_disconnect(clock):
+    limiter = RateLimit.RateLimiter({'chat': (1, 1), 'connection': (0, 0)}, delayPenalty=3, disconnectPenalty=6)
+    limits = limiter.for_connection()
+    actions = [limiter.check(limits, 'hello')[0] for _ in range(7)]
+    assert actions == [RateLimit.ADMIT, RateLimit.DELAY, RateLimit.DELAY, RateLimit.DROP, RateLimit.DROP, RateLimit.DROP, RateLimit.DISCONNECT]
+
+
+def test_penalty_decays(clock):
+    limiter = RateLimit.RateLimiter({'chat': (1, 1), 'connection': (0, 0)}, delayPenalty=3, disconnectPenalty=6)
+    limits = limiter.for_connection()
+    for _ in range(4):
+        limiter.check(limits, 'hello')
+    clock[0] += 3 / RateLimit.PENALTY_DECAY
+    assert limiter.check(limits, 'hello') == (RateLimit.ADMIT, 0)
+    assert limiter.check(limits, 'hello')[0] == RateLimit.DELAY
+
+
+def test_classes_have_separate_buckets(clock):
+    limiter = RateLimit.RateLimiter({'chat': (1, 1), 'command': (1, 1), 'connection': (0, 0)})
+    limits = limiter.for_connection()
+    assert limiter.check(limits, 'hello')[0] == RateLimit.ADMIT
+    assert limiter.check(limits, '/time')[0] == RateLimit.ADMIT
+    assert limiter.check(limits, 'again')[0] == RateLimit.DELAY
+
+
+def test_limits_off_admit_everything(clock):
+    limiter = RateLimit.RateLimiter({name: (0, 0) for name in RateLimit.DEFAULT_LIMITS})
+    limits = limiter.for_connection()
+    assert all(limiter.check(limits, '/users')[0] == RateLimit.ADMIT for _ in range(1000))
+    assert all(limiter.admit_channel('lobby') for _ in range(1000))
+    assert all(limiter.admit_address('10.0.0.1') for _ in range(1000))
+
+
+def test_channel_bucket_is_shared(clock):
+    limiter = RateLimit.RateLimiter({'channel': (1, 2)})
+    assert limiter.admit_channel('lobby') and limiter.admit_channel('lobby')
+    assert not limiter.admit_channel('lobby')
+    assert limiter.admit_channel('other')
+
+
+def test_idle_channel_buckets_are_forgotten(clock, monkeypatch):
+    monkeypatch.setattr(RateLimit, 'MAX_CHANNELS', 10)
+    limiter = RateLimit.RateLimiter({'channel': (1, 1)})
+    for index in range(10):
+        limiter.admit_channel('channel{0}'.format(index))
+    clock[0] += 2
+    limiter.admit_channel('busy')
+    assert list(limiter.channels) == ['busy']
+
+
+def test_address_bucket(clock):
+    limiter = RateLimit.RateLimiter({'accept': (1, 2)})
+    assert limiter.admit_address('10.0.0.1') and limiter.admit_address('10.0.0.1')
+    assert not limiter.admit_address('10.0.0.1')
+    assert limiter.admit_address('10.0.0.2')
+    clock[0] += 1
+    assert limiter.admit_address('10.0.0.1')
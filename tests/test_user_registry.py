@@ -0,0 +1,105 @@
+import threading
+import UserRegistry
+from Benchmarks import FakeSocket
+
+
+def make_user(fd, username='', nickname=''):
+    return UserRegistry.ConnectedUser(FakeSocket(fd), username=username, nickname=nickname)
+
+
+def test_lookups_ignore_case():
+    registry = UserRegistry.UserRegistry()
+    alice = make_user(10, 'Alice', 'Al')
+    registry.add(alice)
+    assert registry.get_by_username('ALICE') is alice
+    assert registry.get_by_nickname('al') is alice
+    assert registry.get_by_fd(10) is alice
+    assert registry.has_username('alice')
+
+
+def test_remove_forgets_every_index():
+    registry = UserRegistry.UserRegistry()
+    alice = make_user(10, 'alice', 'al')
+    registry.add(alice)
+    assert registry.remove(alice)
+    assert not registry.remove(alice)
+    assert alice not in registry
+    assert registry.get_by_username('alice') is None
+    assert registry.get_by_nickname('al') is None
+    assert registry.get_by_fd(10) is None
+    assert len(registry) == 0
+
+
+def test_rename_moves_the_index():
+    registry = UserRegistry.UserRegistry()
+    alice = make_user(10, 'alice')
+    registry.add(alice)
+    assert registry.rename_username(alice, 'alicia')
+    assert registry.get_by_username('alice') is None
+    assert registry.get_by_username('ALICIA') is alice
+
+
+def test_names_can_not_shadow_someone_else():
+    registry = UserRegistry.UserRegistry()
+    alice = make_user(10, 'alice')
+    bob = make_user(11, 'bob', 'bee')
+    registry.add(alice)
+    registry.add(bob)
+    assert not registry.rename_nickname(bob, 'ALICE')
+    assert not registry.rename_username(alice, 'Bee')
+    assert not registry.rename_nickname(alice, 'bob')
+    assert bob.nickname == 'bee' and alice.username == 'alice'
+    # a user may take its own username as nickname
+    assert registry.rename_nickname(alice, 'Alice')
+    assert registry.get_by_nickname('alice') is alice
+
+
+def test_concurrent_renames_give_a_name_to_one_user():
+    registry = UserRegistry.UserRegistry()
+    users = [make_user(100 + index, 'user{0}'.format(index)) for index in range(32)]
+    for user in users:
+        registry.add(user)
+    start = threading.Barrier(len(users))
+    winners = []
+
+    def claim(user):
+        start.wait()
+        if registry.rename_nickname(user, 'contested'):
+            winners.append(user)
+
+    threads = [threading.Thread(target=claim, args=(user,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(winners) == 1
+    assert registry.get_by_nickname('contested') is winners[0]
+
+
+def test_iteration_survives_removals():
+    registry = UserRegistry.UserRegistry()
+    users = [make_user(100 + index, 'user{0}'.format(index)) for index in range(10)]
+    for user in users:
+        registry.add(user)
+    for user in registry:
+        registry.remove(user)
+    assert len(registry) == 0
+
+
+def test_member_set_keeps_join_order_and_snapshots():
+    members = UserRegistry.MemberSet()
+    users = [make_user(100 + index) for index in range(5)]
+    for user in users:
+        members.append(user)
+    assert list(members) == users
+    for user in members:
+        members.discard(user) # the iteration runs over a snapshot
+    assert len(members) == 0
+    assert users[0] not in members
+
+
+def test_masks():
+    assert UserRegistry.is_mask('al*') and not UserRegistry.is_mask('alice')
+    pattern = UserRegistry.mask_pattern('a?ice*')
+    assert pattern.match('ALICE') and pattern.match('alice2')
+    assert not pattern.match('bob')